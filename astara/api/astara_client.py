@@ -14,13 +14,20 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import collections
+import threading
+import time
 
 import requests
+from requests import adapters
 
 from oslo_config import cfg
 from oslo_log import log as logging
 from oslo_serialization import jsonutils
 
+from astara.api.config import delta
+from astara.common import metrics
+
 ASTARA_MGT_SERVICE_PORT = 5000
 ASTARA_BASE_PATH = '/v1/'
 
@@ -30,6 +37,18 @@ CONF = cfg.CONF
 AK_CLIENT_OPTS = [
     cfg.IntOpt('alive_timeout', default=3),
     cfg.IntOpt('config_timeout', default=90),
+    cfg.IntOpt('appliance_session_pool_size', default=512,
+               help=('the maximum number of appliances a worker process '
+                     'keeps persistent HTTP sessions open to')),
+    cfg.IntOpt('appliance_connections_per_host', default=4,
+               help=('the maximum number of keep-alive connections kept '
+                     'open to a single appliance')),
+    cfg.IntOpt('appliance_session_idle_timeout', default=120,
+               help=('seconds after which an unused appliance session is '
+                     'closed')),
+    cfg.BoolOpt('appliance_delta_config', default=True,
+                help=('send appliances only the parts of their config that '
+                      'changed since the last update they accepted')),
 ]
 CONF.register_opts(AK_CLIENT_OPTS)
 
@@ -47,12 +66,161 @@ def _get_proxyless_session():
     return s
 
 
+class SessionPool(object):
+    """Persistent HTTP sessions to appliances, keyed by management address.
+
+    Reusing a session keeps its connections to the appliance alive between
+    health checks and config pushes. The pool holds at most
+    appliance_session_pool_size sessions, dropping the least recently used
+    one when it is full, and drops sessions that have not been used for
+    appliance_session_idle_timeout seconds. Every get() must be matched by
+    a release() once the request is done, and a session dropped from the
+    pool is only closed when no other thread is using it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (host, port) -> (last_used, session), least recently used first
+        self._sessions = collections.OrderedDict()
+        # session -> number of requests using it
+        self._in_use = collections.Counter()
+        # sessions dropped from the pool while in use, closed on release
+        self._retired = set()
+        self.created = 0
+        self.reused = 0
+        self.evicted = 0
+        self.discarded = 0
+
+    def _new_session(self):
+        s = _get_proxyless_session()
+        adapter = adapters.HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=CONF.appliance_connections_per_host)
+        s.mount('http://', adapter)
+        return s
+
+    def _retire(self, session, to_close):
+        """Close a session dropped from the pool once it is not in use."""
+        if self._in_use[session]:
+            self._retired.add(session)
+        else:
+            to_close.append(session)
+
+    def _evict_idle(self, now, to_close):
+        idle_timeout = CONF.appliance_session_idle_timeout
+        expired = []
+        for key, (last_used, session) in self._sessions.items():
+            if now - last_used < idle_timeout:
+                break
+            expired.append(key)
+        for key in expired:
+            last_used, session = self._sessions.pop(key)
+            self._record('evicted')
+            LOG.debug('dropping idle appliance session to %s:%s', *key)
+            self._retire(session, to_close)
+
+    def _record(self, event):
+        """Count a session event and export it, with the lock held."""
+        setattr(self, event, getattr(self, event) + 1)
+        metrics.inc('astara_appliance_session_events_total', event=event)
+        metrics.set_gauge('astara_appliance_sessions', len(self._sessions))
+
+    def get(self, host, port):
+        """Return the session for an appliance, creating it if needed.
+
+        The caller must release() the session when it is done with it.
+        """
+        key = (host, port)
+        now = time.time()
+        to_close = []
+        with self._lock:
+            self._evict_idle(now, to_close)
+            entry = self._sessions.pop(key, None)
+            if entry is not None:
+                event = 'reused'
+                session = entry[1]
+            else:
+                event = 'created'
+                session = self._new_session()
+                while (self._sessions and
+                       len(self._sessions) >=
+                       CONF.appliance_session_pool_size):
+                    _, (_, dropped) = self._sessions.popitem(last=False)
+                    self._record('evicted')
+                    self._retire(dropped, to_close)
+            self._sessions[key] = (now, session)
+            self._in_use[session] += 1
+            self._record(event)
+        for dropped in to_close:
+            dropped.close()
+        return session
+
+    def release(self, session):
+        """Give back a session returned by get()."""
+        with self._lock:
+            self._in_use[session] -= 1
+            if self._in_use[session] > 0:
+                return
+            del self._in_use[session]
+            if session not in self._retired:
+                return
+            self._retired.remove(session)
+        session.close()
+
+    def discard(self, host, port):
+        """Drop the session for an appliance whose connection failed."""
+        to_close = []
+        with self._lock:
+            entry = self._sessions.pop((host, port), None)
+            if entry is not None:
+                self._record('discarded')
+                self._retire(entry[1], to_close)
+        for session in to_close:
+            session.close()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'sessions': len(self._sessions),
+                'created': self.created,
+                'reused': self.reused,
+                'evicted': self.evicted,
+                'discarded': self.discarded,
+            }
+
+    def clear(self):
+        to_close = []
+        with self._lock:
+            for _, session in self._sessions.values():
+                self._retire(session, to_close)
+            self._sessions.clear()
+        for session in to_close:
+            session.close()
+
+
+# Shared by all of the threads of a worker process.
+SESSION_POOL = SessionPool()
+
+
+def _request(method, host, port, path, **kwargs):
+    session = SESSION_POOL.get(host, port)
+    try:
+        with metrics.timed_call('appliance', method.upper()):
+            return getattr(session, method)(
+                _mgt_url(host, port, path), **kwargs)
+    except requests.ConnectionError:
+        # The appliance may have rebooted, start over with a new session.
+        SESSION_POOL.discard(host, port)
+        raise
+    finally:
+        SESSION_POOL.release(session)
+
+
 def is_alive(host, port, timeout=None):
     timeout = timeout or cfg.CONF.alive_timeout
     path = ASTARA_BASE_PATH + 'firewall/rules'
     try:
-        s = _get_proxyless_session()
-        r = s.get(_mgt_url(host, port, path), timeout=timeout)
+        r = _request('get', host, port, path, timeout=timeout)
         if r.status_code == 200:
             return True
     except Exception as e:
@@ -62,22 +230,95 @@ def is_alive(host, port, timeout=None):
 
 def get_interfaces(host, port):
     path = ASTARA_BASE_PATH + 'system/interfaces'
-    s = _get_proxyless_session()
-    r = s.get(_mgt_url(host, port, path), timeout=30)
+    r = _request('get', host, port, path, timeout=30)
     return r.json().get('interfaces', [])
 
 
-def update_config(host, port, config_dict):
+# (host, port) -> time at which an appliance answered a delta update with
+# 404 or 405. It is sent full configs until _DELTA_RETRY_INTERVAL seconds
+# have passed, as its address may be reused by an appliance that accepts
+# deltas.
+_DELTA_UNSUPPORTED = {}
+_DELTA_UNSUPPORTED_LOCK = threading.Lock()
+_DELTA_RETRY_INTERVAL = 3600
+
+
+def _delta_supported(host, port):
+    now = time.time()
+    with _DELTA_UNSUPPORTED_LOCK:
+        since = _DELTA_UNSUPPORTED.get((host, port))
+        if since is not None and now - since < _DELTA_RETRY_INTERVAL:
+            return False
+        _DELTA_UNSUPPORTED.pop((host, port), None)
+        return True
+
+
+def _set_delta_unsupported(host, port):
+    now = time.time()
+    with _DELTA_UNSUPPORTED_LOCK:
+        # drop the appliances that are gone along with their entries
+        for key, since in list(_DELTA_UNSUPPORTED.items()):
+            if now - since >= _DELTA_RETRY_INTERVAL:
+                del _DELTA_UNSUPPORTED[key]
+        _DELTA_UNSUPPORTED[(host, port)] = now
+
+
+def _patch_config(host, port, config_dict, base_config):
+    """Send the changes between base_config and config_dict
+
+    :returns: The response, or None if the appliance could not apply the
+              changes and needs the full config.
+    """
     path = ASTARA_BASE_PATH + 'system/config'
     headers = {'Content-type': 'application/json'}
+    body = {
+        'base_version': delta.fingerprint(base_config),
+        'version': delta.fingerprint(config_dict),
+        # base_config may have been through JSON, so compare it with the
+        # JSON form of the new config
+        'changes': delta.diff(base_config,
+                              jsonutils.to_primitive(config_dict)),
+    }
 
-    s = _get_proxyless_session()
-    r = s.put(
-        _mgt_url(host, port, path),
-        data=jsonutils.dump_as_bytes(config_dict),
+    r = _request(
+        'patch', host, port, path,
+        data=jsonutils.dump_as_bytes(body),
         headers=headers,
         timeout=cfg.CONF.config_timeout)
 
+    if r.status_code in (404, 405):
+        LOG.debug('appliance %s does not accept config changes', host)
+        _set_delta_unsupported(host, port)
+        return None
+    if r.status_code == 409:
+        LOG.debug('appliance %s is not running config %s, sending the '
+                  'full config', host, body['base_version'])
+        return None
+    return r
+
+
+def update_config(host, port, config_dict, base_config=None):
+    """Push a config to an appliance
+
+    :param base_config: The last config the appliance accepted. If given,
+                        only the changes from it are sent, and the full
+                        config is sent if the appliance reports that it
+                        runs another config.
+    """
+    r = None
+    if (base_config is not None and cfg.CONF.appliance_delta_config and
+            _delta_supported(host, port)):
+        r = _patch_config(host, port, config_dict, base_config)
+
+    if r is None:
+        path = ASTARA_BASE_PATH + 'system/config'
+        headers = {'Content-type': 'application/json'}
+        r = _request(
+            'put', host, port, path,
+            data=jsonutils.dump_as_bytes(config_dict),
+            headers=headers,
+            timeout=cfg.CONF.config_timeout)
+
     if r.status_code != 200:
         raise Exception('Config update failed: %s' % r.text)
     else:
@@ -86,6 +327,5 @@ def update_config(host, port, config_dict):
 
 def read_labels(host, port):
     path = ASTARA_BASE_PATH + 'firewall/labels'
-    s = _get_proxyless_session()
-    r = s.post(_mgt_url(host, port, path), timeout=30)
+    r = _request('post', host, port, path, timeout=30)
     return r.json().get('labels', [])
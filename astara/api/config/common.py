@@ -22,8 +22,10 @@ from astara.common import constants
 SERVICE_STATIC = 'static'
 
 
-def network_config(client, port, ifname, network_type, network_ports=[]):
-    network = client.get_network_detail(port.network_id)
+def network_config(client, port, ifname, network_type, network_ports=[],
+                   network=None):
+    if network is None:
+        network = client.get_network_detail(port.network_id)
     subnets_dict = dict((s.id, s) for s in network.subnets)
 
     return _make_network_config_dict(
@@ -0,0 +1,181 @@
+# Copyright (c) 2016 Akanda, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Structural differences between two appliance configs.
+
+A delta is a list of changes, each a dict with an ``op`` of ``replace`` or
+``remove`` and the ``path`` of the value it changes.  A path is a list of
+dict keys, except that the items of the lists named in LIST_KEYS are
+selected by a single item dict ``{key: value}`` instead of by position,
+so that a port added to a network only adds one allocation to the delta.
+"""
+
+import copy
+import hashlib
+import zlib
+
+from oslo_serialization import jsonutils
+import six
+
+
+# the key identifying the items of a list, by the name of the list
+LIST_KEYS = {
+    'networks': 'network_id',
+    'subnets': 'id',
+    'allocations': 'mac_address',
+    'floating_ips': 'floating_ip',
+}
+
+
+def fingerprint(config):
+    """Returns a hash of the canonical JSON encoding of a config dict"""
+    return hashlib.sha1(
+        jsonutils.dump_as_bytes(config, sort_keys=True)).hexdigest()
+
+
+def pack(config):
+    """Returns a compact copy of a config to keep as the base of a diff"""
+    return zlib.compress(jsonutils.dump_as_bytes(config, sort_keys=True))
+
+
+def unpack(packed):
+    """Returns the config dict of a pack()ed config"""
+    return jsonutils.loads(zlib.decompress(packed))
+
+
+def diff(old, new):
+    """Returns the changes that turn config old into config new
+
+    :param old: the config the appliance is known to run
+    :param new: the config it should run
+    :returns: a list of changes, empty if the configs are equal
+    """
+    changes = []
+    _diff(old, new, [], changes)
+    return changes
+
+
+def _index(items, key):
+    """Maps the items of a list by key, or returns None if they can't be"""
+    indexed = {}
+    for item in items:
+        if not isinstance(item, dict) or key not in item:
+            return None
+        indexed[item[key]] = item
+    if len(indexed) != len(items):
+        return None
+    return indexed
+
+
+def _diff(old, new, path, changes):
+    if old == new:
+        return
+
+    if isinstance(old, dict) and isinstance(new, dict):
+        for key in sorted(set(old) - set(new)):
+            changes.append({'op': 'remove', 'path': path + [key]})
+        for key in sorted(new):
+            if key in old:
+                _diff(old[key], new[key], path + [key], changes)
+            else:
+                changes.append(
+                    {'op': 'replace', 'path': path + [key],
+                     'value': new[key]})
+        return
+
+    if (isinstance(old, list) and isinstance(new, list) and path and
+            isinstance(path[-1], six.string_types) and
+            path[-1] in LIST_KEYS):
+        key = LIST_KEYS[path[-1]]
+        old_items = _index(old, key)
+        new_items = _index(new, key)
+        if old_items is not None and new_items is not None:
+            old_ids = [item[key] for item in old]
+            new_ids = [item[key] for item in new]
+            # apply() appends new items, so keyed changes only reproduce
+            # the new list if the items it keeps did not move
+            kept = [i for i in old_ids if i in new_items]
+            added = [i for i in new_ids if i not in old_items]
+            if kept + added == new_ids:
+                for i in old_ids:
+                    if i not in new_items:
+                        changes.append(
+                            {'op': 'remove', 'path': path + [{key: i}]})
+                for i in new_ids:
+                    if i in old_items:
+                        _diff(old_items[i], new_items[i],
+                              path + [{key: i}], changes)
+                    else:
+                        changes.append(
+                            {'op': 'replace', 'path': path + [{key: i}],
+                             'value': new_items[i]})
+                return
+
+    changes.append({'op': 'replace', 'path': path, 'value': new})
+
+
+def _find(items, selector):
+    (key, value), = selector.items()
+    for i, item in enumerate(items):
+        if isinstance(item, dict) and item.get(key) == value:
+            return i
+    return None
+
+
+def apply(config, changes):
+    """Returns a copy of config with changes applied
+
+    This is the appliance side of diff(), used to check deltas and by the
+    appliance stand-ins of the tests.
+
+    :raises ValueError: if a change does not match the config
+    """
+    config = copy.deepcopy(config)
+    for change in changes:
+        path = change['path']
+        remove = change['op'] == 'remove'
+        if not path:
+            if remove:
+                raise ValueError('Cannot remove the whole config')
+            config = copy.deepcopy(change['value'])
+            continue
+
+        try:
+            parent = config
+            for item in path[:-1]:
+                if isinstance(item, dict):
+                    index = _find(parent, item)
+                    if index is None:
+                        raise KeyError(item)
+                    item = index
+                parent = parent[item]
+
+            last = path[-1]
+            if isinstance(last, dict):
+                index = _find(parent, last)
+                if remove:
+                    if index is None:
+                        raise KeyError(last)
+                    del parent[index]
+                elif index is None:
+                    parent.append(copy.deepcopy(change['value']))
+                else:
+                    parent[index] = copy.deepcopy(change['value'])
+            elif remove:
+                del parent[last]
+            else:
+                parent[last] = copy.deepcopy(change['value'])
+        except (KeyError, IndexError, TypeError, AttributeError):
+            raise ValueError('Change %r does not apply to config' % change)
+    return config
@@ -124,12 +124,25 @@ def load_provider_rules(path):
 
 
 def generate_network_config(client, router, management_port, iface_map):
+    # Fetch every network, subnet and port the config needs up front with
+    # a fixed number of list calls, rather than a few calls per interface.
+    ports = [management_port]
+    if router.external_port:
+        ports.append(router.external_port)
+    ports.extend(router.internal_ports)
+
+    networks = client.get_network_details(
+        set(p.network_id for p in ports))
+    network_ports = client.get_ports_for_networks(
+        set(p.network_id for p in router.internal_ports))
+
     retval = [
         common.network_config(
             client,
             management_port,
             iface_map[management_port.network_id],
-            MANAGEMENT_NET
+            MANAGEMENT_NET,
+            network=networks.get(management_port.network_id)
         )
     ]
 
@@ -139,7 +152,8 @@ def generate_network_config(client, router, management_port, iface_map):
                 client,
                 router.external_port,
                 iface_map[router.external_port.network_id],
-                EXTERNAL_NET)])
+                EXTERNAL_NET,
+                network=networks.get(router.external_port.network_id))])
 
     retval.extend(
         common.network_config(
@@ -147,7 +161,8 @@ def generate_network_config(client, router, management_port, iface_map):
             p,
             iface_map[p.network_id],
             INTERNAL_NET,
-            client.get_network_ports(p.network_id))
+            network_ports.get(p.network_id, []),
+            network=networks.get(p.network_id))
         for p in router.internal_ports)
 
     return retval
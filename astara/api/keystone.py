@@ -17,13 +17,28 @@ from keystoneclient import session as kssession
 
 from oslo_config import cfg
 
+from astara.common import metrics
+
 
 CONF = cfg.CONF
 
 
+def _timed_request(request, service):
+    def request_wrapper(url, method, **kwargs):
+        with metrics.timed_call(service, method):
+            return request(url, method, **kwargs)
+    return request_wrapper
+
+
 class KeystoneSession(object):
-    def __init__(self):
+    def __init__(self, service=None):
+        """
+        :param service: When given, the latency of every request made
+                        through the session is recorded under this
+                        service name.
+        """
         self._session = None
+        self._service = service
         self.region_name = CONF.auth_region
         ksauth.register_conf_options(CONF, 'keystone_authtoken')
 
@@ -35,4 +50,7 @@ class KeystoneSession(object):
             auth_plugin = ksauth.load_from_conf_options(
                 cfg.CONF, 'keystone_authtoken')
             self._session = kssession.Session(auth=auth_plugin)
+            if self._service:
+                self._session.request = _timed_request(
+                    self._session.request, self._service)
         return self._session
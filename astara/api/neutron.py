@@ -17,6 +17,7 @@
 import collections
 import itertools
 import socket
+import threading
 import time
 import uuid
 
@@ -30,10 +31,10 @@ from oslo_context import context
 from oslo_log import log as logging
 from oslo_utils import importutils
 
-from astara.common.i18n import _, _LI, _LW
+from astara.common.i18n import _, _LE, _LI, _LW
 from astara.common.linux import ip_lib
 from astara.api import keystone
-from astara.common import constants, rpc
+from astara.common import constants, metrics, rpc
 
 LOG = logging.getLogger(__name__)
 CONF = cfg.CONF
@@ -48,6 +49,18 @@ neutron_opts = [
     cfg.StrOpt('interface_driver',
                default='astara.common.linux.interface.OVSInterfaceDriver'),
     cfg.BoolOpt('neutron_port_security_extension_enabled', default=True),
+    cfg.IntOpt('neutron_cache_ttl', default=10,
+               help=_('Number of seconds worker processes cache router, '
+                      'network, subnet and port details fetched from '
+                      'Neutron. Entries are invalidated early when a '
+                      'notification about the cached resource is received. '
+                      'Set to 0 to disable caching.')),
+    cfg.FloatOpt('neutron_status_flush_interval', default=1.0,
+                 help=_('Number of seconds worker processes wait before '
+                        'writing router and load balancer statuses to '
+                        'Neutron. Only the latest status of each resource '
+                        'is written. Set to 0 to write every status change '
+                        'immediately.')),
 
     # legacy_fallback option is deprecated and will be removed in the N-release
     cfg.BoolOpt('legacy_fallback_mode', default=True,
@@ -129,6 +142,376 @@ class ItemCache(collections.defaultdict):
             return ret
 
 
+class _Fetch(object):
+    """A ResponseCache lookup waiting on Neutron.
+
+    Invalidations that race with it are recorded here, so its result is
+    only stored if it cannot be stale.
+    """
+    __slots__ = ('stale', 'networks')
+
+    def __init__(self):
+        self.stale = False
+        # networks dropped while a router was fetched
+        self.networks = set()
+
+    def is_fresh(self, kind, value):
+        if self.stale:
+            return False
+        if kind == 'router' and self.networks:
+            return not any(port.network_id in self.networks
+                           for port in value.ports)
+        return True
+
+
+class ResponseCache(object):
+    """A TTL-bounded cache of Neutron lookups shared by a worker process.
+
+    Entries are keyed by (kind, id) where kind is one of 'router',
+    'network', 'subnets' (the subnets of a network) or 'ports' (the ports
+    on a network). Routers are indexed by the networks they are plugged
+    into so a change to a network, subnet or port also drops the routers
+    whose details embed it.
+
+    Values are fetched without holding the lock, so the fetches in
+    progress are tracked per entry and a fetch only stores its result if
+    nothing it depends on was invalidated since its miss. Expired entries
+    are pruned at most once per neutron_cache_ttl, when a value is stored.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._routers_by_network = collections.defaultdict(set)
+        # (kind, id) -> list of the _Fetch in progress for the entry
+        self._fetches = {}
+        self._next_prune = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, kind, key, fetch):
+        """Return a cached value, calling fetch(key) to fill a miss.
+
+        Exceptions raised by fetch are not cached.
+        """
+        ttl = cfg.CONF.neutron_cache_ttl
+        if ttl <= 0:
+            return fetch(key)
+
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get((kind, key))
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            pending = self._start_fetch(kind, key)
+
+        # Fetch without holding the lock so a slow call does not block
+        # lookups of other resources.
+        try:
+            value = fetch(key)
+        except Exception:
+            with self._lock:
+                self._end_fetch(kind, key, pending)
+            raise
+        with self._lock:
+            self._end_fetch(kind, key, pending)
+            if pending.is_fresh(kind, value):
+                self._store(kind, key, value, now, ttl)
+        return value
+
+    def get_many(self, kind, keys, fetch_many):
+        """Return a dict of cached values for several keys.
+
+        The keys that miss are filled with a single call to
+        fetch_many(missing_keys), which must return a dict keyed the same
+        way. Keys missing from that result are left out of the return
+        value and are not cached.
+        """
+        keys = list(keys)
+        ttl = cfg.CONF.neutron_cache_ttl
+        if ttl <= 0:
+            return fetch_many(keys)
+
+        now = time.time()
+        found = {}
+        missing = collections.OrderedDict()
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get((kind, key))
+                if entry is not None and entry[0] > now:
+                    self.hits += 1
+                    found[key] = entry[1]
+                elif key not in missing:
+                    self.misses += 1
+                    missing[key] = self._start_fetch(kind, key)
+
+        if missing:
+            try:
+                fetched = fetch_many(list(missing))
+            except Exception:
+                with self._lock:
+                    for key, pending in missing.items():
+                        self._end_fetch(kind, key, pending)
+                raise
+            with self._lock:
+                for key, pending in missing.items():
+                    self._end_fetch(kind, key, pending)
+                    if key in fetched and pending.is_fresh(kind, fetched[key]):
+                        self._store(kind, key, fetched[key], now, ttl)
+            found.update(fetched)
+        return found
+
+    def _start_fetch(self, kind, key):
+        pending = _Fetch()
+        self._fetches.setdefault((kind, key), []).append(pending)
+        return pending
+
+    def _end_fetch(self, kind, key, pending):
+        fetches = self._fetches[(kind, key)]
+        fetches.remove(pending)
+        if not fetches:
+            del self._fetches[(kind, key)]
+
+    def _store(self, kind, key, value, now, ttl):
+        if now >= self._next_prune:
+            self._prune(now)
+            self._next_prune = now + ttl
+        self._entries[(kind, key)] = (now + ttl, value)
+        if kind == 'router':
+            for port in value.ports:
+                self._routers_by_network[port.network_id].add(key)
+
+    def _prune(self, now):
+        for entry_key, (expires, value) in list(self._entries.items()):
+            if expires <= now:
+                del self._entries[entry_key]
+        for network_id, routers in list(self._routers_by_network.items()):
+            routers.difference_update(
+                [router_id for router_id in routers
+                 if ('router', router_id) not in self._entries])
+            if not routers:
+                del self._routers_by_network[network_id]
+
+    def _drop(self, kind, key):
+        for pending in self._fetches.get((kind, key), ()):
+            pending.stale = True
+        self._entries.pop((kind, key), None)
+
+    def _drop_fetches(self, kinds):
+        for (kind, key), fetches in self._fetches.items():
+            if kind in kinds:
+                for pending in fetches:
+                    pending.stale = True
+
+    def invalidate_router(self, router_id):
+        with self._lock:
+            self._drop('router', router_id)
+
+    def invalidate_network(self, network_id):
+        """Drop a network, its subnets and ports, and routers plugged in."""
+        with self._lock:
+            for kind in ('network', 'subnets', 'ports'):
+                self._drop(kind, network_id)
+            for router_id in self._routers_by_network.pop(network_id, ()):
+                self._drop('router', router_id)
+            # The routers being fetched are not indexed yet.
+            for (kind, key), fetches in self._fetches.items():
+                if kind == 'router':
+                    for pending in fetches:
+                        pending.networks.add(network_id)
+
+    def invalidate_deleted(self, key, resource_id, tenant_id=None):
+        """Drop the entries referring to a resource known only by ID.
+
+        Delete notifications only carry the ID of the deleted resource, so
+        the cached routers and port and subnet lists are searched for it.
+        If no router refers to it, the routers of tenant_id are dropped.
+
+        :param key: The key of the ID in the payload, one of floatingip_id,
+                    port_id or subnet_id.
+        """
+        def _refers(kind, value):
+            if kind == 'router':
+                if key == 'floatingip_id':
+                    return any(fip.id == resource_id
+                               for fip in value.floating_ips)
+                if key == 'port_id':
+                    return any(p.id == resource_id for p in value.ports)
+                return any(ip.subnet_id == resource_id
+                           for p in value.ports for ip in p.fixed_ips)
+            if (kind, key) in (('ports', 'port_id'),
+                               ('subnets', 'subnet_id')):
+                return any(item.id == resource_id for item in value)
+            return False
+
+        with self._lock:
+            # The values being fetched cannot be searched yet.
+            self._drop_fetches(('router', 'ports', 'subnets'))
+            stale = [(kind, entry_key)
+                     for (kind, entry_key), (_, value)
+                     in self._entries.items() if _refers(kind, value)]
+            if tenant_id and not any(kind == 'router' for kind, _ in stale):
+                stale.extend(
+                    (kind, entry_key)
+                    for (kind, entry_key), (_, value)
+                    in self._entries.items()
+                    if kind == 'router' and value.tenant_id == tenant_id)
+            for kind, entry_key in stale:
+                self._drop(kind, entry_key)
+
+    def invalidate_for_payload(self, payload, tenant_id=None):
+        """Drop the entries affected by a notification payload.
+
+        :param payload: The body of a Neutron notification or an astara
+                        command, as delivered to the worker.
+        :param tenant_id: The tenant the notification is for, whose
+                          routers are dropped if a deleted resource is not
+                          found in the cache.
+        """
+        if not isinstance(payload, dict):
+            return
+
+        for key in ('router_id', 'resource_id'):
+            if payload.get(key):
+                self.invalidate_router(payload[key])
+
+        for key in ('router', 'router.interface'):
+            router = payload.get(key)
+            if isinstance(router, dict) and router.get('id'):
+                self.invalidate_router(router['id'])
+
+        network = payload.get('network')
+        if isinstance(network, dict) and network.get('id'):
+            self.invalidate_network(network['id'])
+
+        for key in ('subnet', 'port'):
+            data = payload.get(key)
+            if not isinstance(data, dict):
+                continue
+            if data.get('network_id'):
+                self.invalidate_network(data['network_id'])
+            if key == 'port' and data.get('device_id'):
+                self.invalidate_router(data['device_id'])
+
+        fip = payload.get('floatingip')
+        if isinstance(fip, dict):
+            if fip.get('router_id'):
+                self.invalidate_router(fip['router_id'])
+            elif fip.get('id'):
+                # Disassociated, so only the router caching it knows which
+                # one it was.
+                self.invalidate_deleted('floatingip_id', fip['id'], tenant_id)
+
+        # Delete notifications only carry the ID of the deleted resource.
+        if payload.get('network_id'):
+            self.invalidate_network(payload['network_id'])
+        for key in ('floatingip_id', 'port_id', 'subnet_id'):
+            if payload.get(key):
+                self.invalidate_deleted(key, payload[key], tenant_id)
+
+        # Payloads of notifications merged into this one by the listener.
+        for coalesced in payload.get('coalesced_payloads', ()):
+            self.invalidate_for_payload(coalesced, tenant_id)
+
+    def clear(self):
+        with self._lock:
+            self._drop_fetches(('router', 'network', 'subnets', 'ports'))
+            self._entries.clear()
+            self._routers_by_network.clear()
+
+
+# Shared by all of the worker contexts of a worker process.
+RESPONSE_CACHE = ResponseCache()
+
+
+class StatusWriter(object):
+    """Writes resource statuses to Neutron from a background thread.
+
+    Statuses are queued per resource, keeping only the latest one, and
+    written every neutron_status_flush_interval seconds, so a resource
+    that goes through several states within an interval, as it does while
+    booting, is only updated once. The thread is started by the first
+    queued status, so it runs in the worker process that uses it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        # (kind, resource id) -> status, in the order first queued
+        self._pending = collections.OrderedDict()
+        self._thread = None
+        self._client = None
+        self.written = 0
+        self.coalesced = 0
+
+    def set_status(self, kind, resource_id, status):
+        """Queue a status write.
+
+        :param kind: 'router' or 'loadbalancer'
+        """
+        with self._lock:
+            key = (kind, resource_id)
+            if key in self._pending:
+                self.coalesced += 1
+            self._pending[key] = status
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name='NeutronStatusWriter')
+                self._thread.setDaemon(True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(cfg.CONF.neutron_status_flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                LOG.exception(_LE('failed to write statuses to neutron'))
+
+    def flush(self):
+        """Write the queued statuses now."""
+        with self._flush_lock:
+            with self._lock:
+                pending = self._pending
+                self._pending = collections.OrderedDict()
+            if not pending:
+                return
+            try:
+                if self._client is None:
+                    # Neutron clients are not thread-safe, so the writer has
+                    # its own. Its writes drop the cached routers once the
+                    # new status is in neutron.
+                    self._client = Neutron(cfg.CONF, cache=RESPONSE_CACHE)
+                for key, status in list(pending.items()):
+                    kind, resource_id = key
+                    if kind == 'router':
+                        self._client.update_router_status(resource_id, status)
+                    else:
+                        self._client.update_loadbalancer_status(
+                            resource_id, status)
+                    del pending[key]
+                    self.written += 1
+            except Exception:
+                self._requeue(pending)
+                raise
+
+    def _requeue(self, pending):
+        # Put back the statuses that were not written, ahead of the ones
+        # queued since and unless a newer status replaced them.
+        with self._lock:
+            for key in self._pending:
+                pending.pop(key, None)
+            pending.update(self._pending)
+            self._pending = pending
+
+
+# Shared by all of the worker contexts of a worker process.
+STATUS_WRITER = StatusWriter()
+
+
 class DictModelBase(object):
     DICT_ATTRS = ()
 
@@ -779,16 +1162,26 @@ class L3PluginApi(object):
         """Make a remote process call to retrieve the sync data for routers."""
         router_id = [router_id] if router_id else None
         # yes the plural is intended for havana compliance
-        retval = self._client.call(
-            context.get_admin_context().to_dict(),
-            'sync_routers', host=self.host, router_ids=router_id)  # plural
+        with metrics.timed_call('neutron', 'sync_routers'):
+            retval = self._client.call(
+                context.get_admin_context().to_dict(),
+                'sync_routers', host=self.host, router_ids=router_id)  # plural
         return retval
 
 
 class Neutron(object):
-    def __init__(self, conf):
+    def __init__(self, conf, cache=None, status_writer=None):
+        """
+        :param conf: The configuration object
+        :param cache: An optional ResponseCache used for router, network,
+                      subnet and port lookups.
+        :param status_writer: An optional StatusWriter through which router
+                              and load balancer statuses are written.
+        """
         self.conf = conf
-        ks_session = keystone.KeystoneSession()
+        self.cache = cache
+        self.status_writer = status_writer
+        ks_session = keystone.KeystoneSession(service='neutron')
         self.api_client = AstaraExtClientWrapper(
             session=ks_session.session,
             endpoint_type=cfg.CONF.endpoint_type,
@@ -796,7 +1189,16 @@ class Neutron(object):
         self.l3_rpc_client = L3PluginApi(PLUGIN_ROUTER_RPC_TOPIC,
                                          cfg.CONF.host)
 
+    def _defer_status(self, kind, resource_id, status):
+        if (self.status_writer is None or
+                cfg.CONF.neutron_status_flush_interval <= 0):
+            return False
+        self.status_writer.set_status(kind, resource_id, status)
+        return True
+
     def update_loadbalancer_status(self, loadbalancer_id, status):
+        if self._defer_status('loadbalancer', loadbalancer_id, status):
+            return
         try:
             self.api_client.update_loadbalancer_status(loadbalancer_id, status)
         except Exception as e:
@@ -930,8 +1332,34 @@ class Neutron(object):
         routers = self.api_client.list_routers().get('routers', [])
         return [Router.from_dict(r) for r in routers]
 
+    def _cached(self, kind, key, fetch):
+        if self.cache is None:
+            return fetch(key)
+        return self.cache.get(kind, key, fetch)
+
+    def _cached_many(self, kind, keys, fetch_many):
+        if self.cache is None:
+            return fetch_many(list(keys))
+        return self.cache.get_many(kind, keys, fetch_many)
+
+    def invalidate_cache(self, payload, router_id=None, tenant_id=None):
+        """Drop cached lookups affected by an incoming notification.
+
+        :param router_id: The router the notification was routed to, which
+                          is dropped whatever the payload says.
+        :param tenant_id: The tenant the notification was routed to.
+        """
+        if self.cache is None:
+            return
+        if router_id:
+            self.cache.invalidate_router(router_id)
+        self.cache.invalidate_for_payload(payload, tenant_id)
+
     def get_router_detail(self, router_id):
         """Return detailed information about a router and it's networks."""
+        return self._cached('router', router_id, self._get_router_detail)
+
+    def _get_router_detail(self, router_id):
         router = self.l3_rpc_client.get_routers(router_id=router_id)
         try:
             return Router.from_dict(router[0])
@@ -950,10 +1378,16 @@ class Neutron(object):
             return None
 
     def get_network_ports(self, network_id):
+        return self._cached('ports', network_id, self._get_network_ports)
+
+    def _get_network_ports(self, network_id):
         return [Port.from_dict(p) for p in
                 self.api_client.list_ports(network_id=network_id)['ports']]
 
     def get_network_subnets(self, network_id):
+        return self._cached('subnets', network_id, self._get_network_subnets)
+
+    def _get_network_subnets(self, network_id):
         response = []
         subnet_response = self.api_client.list_subnets(network_id=network_id)
         subnets = subnet_response['subnets']
@@ -966,7 +1400,65 @@ class Neutron(object):
                          network_id, e)
         return response
 
+    def get_ports_for_networks(self, network_ids):
+        """Return the ports on several networks with one list_ports call.
+
+        :returns: A dict mapping each network id to its list of ports.
+        """
+        return self._cached_many(
+            'ports', network_ids, self._get_ports_for_networks)
+
+    def _get_ports_for_networks(self, network_ids):
+        ports = dict((network_id, []) for network_id in network_ids)
+        if not ports:
+            return ports
+        response = self.api_client.list_ports(network_id=list(ports))
+        for p in response['ports']:
+            port = Port.from_dict(p)
+            ports.setdefault(port.network_id, []).append(port)
+        return ports
+
+    def get_network_details(self, network_ids):
+        """Return several networks and their subnets.
+
+        The networks are fetched with one list_networks call and their
+        subnets with one list_subnets call, instead of a show_network and
+        list_subnets pair per network. Networks that no longer exist are
+        left out of the result.
+
+        :returns: A dict mapping network id to Network.
+        """
+        return self._cached_many(
+            'network', network_ids, self._get_network_details)
+
+    def _get_network_details(self, network_ids):
+        network_ids = list(set(network_ids))
+        if not network_ids:
+            return {}
+        response = self.api_client.list_networks(id=network_ids)
+        networks = {}
+        for n in response['networks']:
+            network = Network.from_dict(n)
+            network.subnets = []
+            networks[network.id] = network
+
+        subnet_response = self.api_client.list_subnets(network_id=network_ids)
+        for s in subnet_response['subnets']:
+            try:
+                subnet = Subnet.from_dict(s)
+            except Exception as e:
+                LOG.info(_LI('ignoring subnet %s (%s) on network %s: %s'),
+                         s.get('id'), s.get('cidr'),
+                         s.get('network_id'), e)
+                continue
+            if subnet.network_id in networks:
+                networks[subnet.network_id].subnets.append(subnet)
+        return networks
+
     def get_network_detail(self, network_id):
+        return self._cached('network', network_id, self._get_network_detail)
+
+    def _get_network_detail(self, network_id):
         network_response = self.api_client.show_network(network_id)['network']
         network = Network.from_dict(network_response)
         network.subnets = self.get_network_subnets(network_id)
@@ -986,6 +1478,26 @@ class Neutron(object):
                 intf_ports.append(port)
         return mgt_port, intf_ports
 
+    def get_ports_for_instances(self, instance_ids):
+        """Return the ports of several instances with one list_ports call.
+
+        :returns: A dict mapping each instance id to a tuple of its
+                  management port (or None) and a list of its other ports.
+        """
+        result = dict((i, (None, [])) for i in instance_ids)
+        if not result:
+            return result
+        ports = self.api_client.list_ports(device_id=list(result))['ports']
+
+        for port in (Port.from_dict(p) for p in ports):
+            mgt_port, intf_ports = result.setdefault(port.device_id,
+                                                     (None, []))
+            if port.network_id == self.conf.management_network_id:
+                result[port.device_id] = (port, intf_ports)
+            else:
+                intf_ports.append(port)
+        return result
+
     def create_management_port(self, object_id):
         return self.create_vrrp_port(
             object_id,
@@ -993,7 +1505,35 @@ class Neutron(object):
             'MGT'
         )
 
-    def create_vrrp_port(self, object_id, network_id, label='VRRP'):
+    def create_management_ports(self, object_id, count):
+        """Create several management ports with one create_port call.
+
+        :returns: A list of count Port objects.
+        """
+        return self.create_vrrp_ports(
+            object_id, self.conf.management_network_id, count, 'MGT')
+
+    def create_vrrp_ports(self, object_id, network_id, count, label='VRRP'):
+        """Create several ports on a network with one create_port call.
+
+        :returns: A list of count Port objects.
+        """
+        if count < 1:
+            return []
+        port_dict = self._vrrp_port_dict(object_id, network_id, label)
+        response = self.api_client.create_port(
+            dict(ports=[dict(port_dict) for i in range(count)]))
+        ports_data = response.get('ports')
+        if not ports_data:
+            raise ValueError(_(
+                'Unable to create %s %s ports for %s on network %s') %
+                (count, label, object_id, network_id)
+            )
+        if self.cache is not None:
+            self.cache.invalidate_network(network_id)
+        return [Port.from_dict(p) for p in ports_data]
+
+    def _vrrp_port_dict(self, object_id, network_id, label):
         port_dict = dict(
             admin_state_up=True,
             network_id=network_id,
@@ -1010,7 +1550,10 @@ class Neutron(object):
             # disable port_securty on VRRP, LB, MGT
             if self.conf.neutron_port_security_extension_enabled:
                 port_dict['port_security_enabled'] = False
+        return port_dict
 
+    def create_vrrp_port(self, object_id, network_id, label='VRRP'):
+        port_dict = self._vrrp_port_dict(object_id, network_id, label)
         response = self.api_client.create_port(dict(port=port_dict))
         port_data = response.get('port')
         if not port_data:
@@ -1019,6 +1562,8 @@ class Neutron(object):
                 (label, object_id, network_id)
             )
         port = Port.from_dict(port_data)
+        if self.cache is not None:
+            self.cache.invalidate_network(network_id)
 
         return port
 
@@ -1038,6 +1583,8 @@ class Neutron(object):
                 'Unable to find VRRP port to delete with name %s.'), name)
         for port in port_data:
             self.api_client.delete_port(port['id'])
+            if self.cache is not None and port.get('network_id'):
+                self.cache.invalidate_network(port['network_id'])
 
     def _ensure_local_port(self, network_id, subnet_id, prefix,
                            network_type):
@@ -1163,6 +1710,8 @@ class Neutron(object):
             driver.unplug(device_name)
 
     def update_router_status(self, router_id, status):
+        if self._defer_status('router', router_id, status):
+            return
         try:
             self.api_client.update_router_status(router_id, status)
         except Exception as e:
@@ -1173,6 +1722,9 @@ class Neutron(object):
                 'ignoring failure to update status for %s to %s: %s'),
                 id, status, e,
             )
+        if self.cache is not None:
+            # The cached router detail carries the old status.
+            self.cache.invalidate_router(router_id)
 
     def clear_device_id(self, port):
         self.api_client.update_port(port.id, {'port': {'device_id': ''}})
@@ -14,7 +14,10 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import bisect
 from datetime import datetime
+import os
+import threading
 import time
 
 import netaddr
@@ -43,9 +46,17 @@ OPTIONS = [
     cfg.StrOpt(
         'astara_boot_command', default='astara-configure-management',
         help='The boot command to run to configure the appliance'),
+    cfg.IntOpt(
+        'nova_server_index_ttl', default=10,
+        help='Number of seconds a worker process reuses one listing of all '
+             'appliance servers to find the instances of each resource. '
+             'Set to 0 to query nova for every resource instead.'),
 ]
 cfg.CONF.register_opts(OPTIONS)
 
+# The number of servers requested per page when building the server index.
+SERVER_INDEX_PAGE_SIZE = 1000
+
 
 class NovaInstanceDeleteTimeout(Exception):
     pass
@@ -146,9 +157,10 @@ class PezInstanceProvider(InstanceProvider):
         mgt_port_dict = {
             'id': mgt_port.id,
             'network_id': mgt_port.network_id,
+            'name': mgt_port.name,
         }
         instance_ports_dicts = [{
-            'id': p.id, 'network_id': p.network_id,
+            'id': p.id, 'network_id': p.network_id, 'name': p.name,
         } for p in instance_ports]
 
         LOG.debug('Requesting new %s instance from Pez.', resource_type)
@@ -242,10 +254,120 @@ def get_instance_provider(provider):
         return default
 
 
+class ServerIndex(object):
+    """An index of the orchestrator's nova servers shared by a worker process.
+
+    The index is rebuilt from a paginated listing of every server at most
+    once per nova_server_index_ttl seconds, and answers the name prefix
+    lookups of Nova.get_instances_for_obj() without a query per resource.
+    Servers booted since the last rebuild are fetched by ID until a rebuild
+    picks them up, and servers we delete are dropped right away. Servers
+    fetched by ID, as they are before the orchestrator acts on their
+    status, replace their indexed copy.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._expires = 0
+        # sorted (name, id) pairs, for prefix searches
+        self._names = []
+        self._by_id = {}
+        # id -> name of servers booted since the last rebuild
+        self._booted = {}
+        self.rebuilds = 0
+
+    def _rebuild(self, client):
+        servers = []
+        marker = None
+        while True:
+            page = client.servers.list(
+                detailed=True, marker=marker, limit=SERVER_INDEX_PAGE_SIZE)
+            servers.extend(page)
+            if len(page) < SERVER_INDEX_PAGE_SIZE:
+                break
+            marker = page[-1].id
+        self._by_id = dict((s.id, s) for s in servers)
+        self._names = sorted((s.name, s.id) for s in servers)
+        for instance_id in list(self._booted):
+            if instance_id in self._by_id:
+                del self._booted[instance_id]
+        self.rebuilds += 1
+
+    def find(self, client, prefix, get_server):
+        """Return the servers whose name starts with prefix.
+
+        :param client: The novaclient used to rebuild the index.
+        :param prefix: The name prefix to look for.
+        :param get_server: Callable returning a server by ID, or None if it
+                           no longer exists.
+        """
+        now = time.time()
+        with self._lock:
+            if now >= self._expires:
+                self._rebuild(client)
+                self._expires = now + cfg.CONF.nova_server_index_ttl
+            names = self._names
+            servers = []
+            i = bisect.bisect_left(names, (prefix,))
+            while i < len(names) and names[i][0].startswith(prefix):
+                servers.append(self._by_id[names[i][1]])
+                i += 1
+            booted = [instance_id
+                      for instance_id, name in self._booted.items()
+                      if name.startswith(prefix)]
+
+        for instance_id in booted:
+            server = get_server(instance_id)
+            if server is not None:
+                servers.append(server)
+            else:
+                self.forget(instance_id)
+        return servers
+
+    def add_booted(self, instance_id, name):
+        """Track a server booted or renamed since the last rebuild.
+
+        A server taken from a Pez pool is already indexed under its pool
+        name, so its entry is dropped and it is fetched by ID under its new
+        name until the next rebuild.
+        """
+        with self._lock:
+            if self._by_id.pop(instance_id, None) is not None:
+                self._names = [n for n in self._names if n[1] != instance_id]
+            self._booted[instance_id] = name
+
+    def update(self, server):
+        """Replace the indexed copy of a server fetched by ID."""
+        with self._lock:
+            indexed = self._by_id.get(server.id)
+            if indexed is not None and indexed.name == server.name:
+                self._by_id[server.id] = server
+
+    def forget(self, instance_id):
+        """Drop a server that has been deleted."""
+        with self._lock:
+            self._booted.pop(instance_id, None)
+            server = self._by_id.pop(instance_id, None)
+            if server is not None:
+                self._names = [n for n in self._names if n[1] != instance_id]
+
+    def clear(self):
+        with self._lock:
+            self._expires = 0
+            self._names = []
+            self._by_id = {}
+            self._booted = {}
+
+
+# Shared by all of the worker contexts of a worker process.
+SERVER_INDEX = ServerIndex()
+
+
 class Nova(object):
-    def __init__(self, conf):
+    def __init__(self, conf, server_index=None):
         self.conf = conf
-        ks_session = keystone.KeystoneSession()
+        self.server_index = server_index
+        ks_session = keystone.KeystoneSession(service='nova')
         self.client = client.Client(
             version='2',
             session=ks_session.session,
@@ -268,10 +390,14 @@ class Nova(object):
 
         :returns: a list of novaclient.v2.servers.Server objects or []
         """
-        search_opt = '^' + name + '.*$'
-        instances = self.client.servers.list(
-            search_opts=dict(name=search_opt)
-        )
+        if self.server_index is not None and cfg.CONF.nova_server_index_ttl:
+            instances = self.server_index.find(
+                self.client, name, self.get_instance_by_id)
+        else:
+            search_opt = '^' + name + '.*$'
+            instances = self.client.servers.list(
+                search_opts=dict(name=search_opt)
+            )
         if not instances:
             return []
         return [InstanceInfo.from_nova(i) for i in instances]
@@ -300,14 +426,43 @@ class Nova(object):
         :returns: a novaclient.v2.servers.Server object
         """
         try:
-            return self.client.servers.get(instance_id)
+            server = self.client.servers.get(instance_id)
         except novaclient_exceptions.NotFound:
+            self._forget(instance_id)
             return None
+        if self.server_index is not None:
+            self.server_index.update(server)
+        return server
+
+    def _get_existing_instances(self, instance_infos):
+        """Returns the instances that nova still knows about.
+
+        Instances of a resource share a name prefix, so several of them are
+        looked up with a single servers.list call rather than one
+        servers.get each.
+
+        :param instance_infos: a list of InstanceInfo objects
+        :returns: the InstanceInfo objects whose servers still exist
+        """
+        prefix = os.path.commonprefix([i.name or '' for i in instance_infos])
+        if len(instance_infos) < 2 or not prefix:
+            return [i for i in instance_infos
+                    if self.get_instance_by_id(i.id_)]
+        servers = self.client.servers.list(
+            search_opts=dict(name='^' + prefix + '.*$')
+        )
+        existing = set(s.id for s in servers)
+        return [i for i in instance_infos if i.id_ in existing]
 
     def destroy_instance(self, instance_info):
         if instance_info:
             LOG.debug('deleting instance %s', instance_info.name)
             self.client.servers.delete(instance_info.id_)
+            self._forget(instance_info.id_)
+
+    def _forget(self, instance_id):
+        if self.server_index is not None:
+            self.server_index.forget(instance_id)
 
     def boot_instance(self,
                       resource_type,
@@ -335,6 +490,7 @@ class Nova(object):
                 return instance_info
 
             self.client.servers.delete(instance.id)
+            self._forget(instance.id)
             return None
 
         # it is now safe to attempt boot
@@ -345,6 +501,8 @@ class Nova(object):
             flavor=flavor,
             make_ports_callback=make_ports_callback
         )
+        if instance_info and self.server_index is not None:
+            self.server_index.add_booted(instance_info.id_, name)
         return instance_info
 
     def update_instance_info(self, instance_info):
@@ -369,24 +527,26 @@ class Nova(object):
                     _LE('Error deleting instance %s' % inst.id_))
                 to_poll.remove(inst)
 
-        # XXX parallelize this
-        timed_out = []
-        for inst in to_poll:
-            start = time.time()
-            i = 0
-            while time.time() - start < cfg.CONF.boot_timeout:
-                i += 1
-                if not self.get_instance_by_id(inst.id_):
+        # Poll all of the instances together so that the wait is bounded by
+        # the slowest deletion rather than the sum of them.
+        start = time.time()
+        while to_poll and time.time() - start < cfg.CONF.boot_timeout:
+            remaining = self._get_existing_instances(to_poll)
+            for inst in to_poll:
+                if inst not in remaining:
                     LOG.debug('Instance %s has been deleted', inst.id_)
-                    break
+            to_poll = remaining
+            if to_poll:
                 LOG.debug(
-                    'Instance %s has not finished stopping', inst.id_)
+                    'Instances %s have not finished stopping',
+                    ', '.join(i.id_ for i in to_poll))
                 time.sleep(cfg.CONF.retry_delay)
-            else:
-                timed_out.append(inst)
-                LOG.error(_LE(
-                    'Instance %s failed to stop within %d secs'),
-                    inst.id_, cfg.CONF.boot_timeout)
+
+        timed_out = to_poll
+        for inst in timed_out:
+            LOG.error(_LE(
+                'Instance %s failed to stop within %d secs'),
+                inst.id_, cfg.CONF.boot_timeout)
 
         if timed_out:
             raise NovaInstanceDeleteTimeout()
@@ -28,6 +28,7 @@ from oslo_log import log as logging
 
 from astara.cli import app
 from astara.common.i18n import _, _LE, _LI, _LW
+from astara.common import metrics
 
 LOG = logging.getLogger(__name__)
 
@@ -45,12 +46,26 @@ cfg.CONF.register_opts(RUG_API_OPTS)
 
 class RugAPI(object):
 
-    def __init__(self, ctl=app.RugController):
+    def __init__(self, ctl=app.RugController, aggregator=None):
         self.ctl = ctl()
+        self.aggregator = aggregator
+
+    def _metrics(self):
+        if self.aggregator is None:
+            return webob.exc.HTTPNotFound()
+        body = self.aggregator.render()
+        if isinstance(body, six.text_type):
+            body = body.encode('utf-8')
+        resp = webob.Response(body=body)
+        resp.headers['Content-Type'] = metrics.CONTENT_TYPE
+        return resp
 
     @webob.dec.wsgify(RequestClass=webob.Request)
     def __call__(self, req):
         try:
+            if req.method == 'GET' and req.path.rstrip('/') == '/metrics':
+                return self._metrics()
+
             if req.method != 'PUT':
                 return webob.exc.HTTPMethodNotAllowed()
 
@@ -78,11 +93,12 @@ class RugAPI(object):
 
 
 class RugAPIServer(object):
-    def __init__(self):
+    def __init__(self, aggregator=None):
         self.pool = eventlet.GreenPool(1000)
+        self.aggregator = aggregator
 
     def run(self, ip_address, port):
-        app = RugAPI()
+        app = RugAPI(aggregator=self.aggregator)
 
         try:
             socket.inet_pton(socket.AF_INET6, ip_address)
@@ -121,5 +137,13 @@ class RugAPIServer(object):
             log=LOG)
 
 
-def serve():
-    RugAPIServer().run(cfg.CONF.api_listen, cfg.CONF.api_port)
+def serve(metrics_queue=None):
+    aggregator = None
+    if metrics_queue is not None:
+        interval = cfg.CONF.metrics_report_interval
+        # Forget about processes that have missed a few reports, so the
+        # values of a worker that exited are not counted forever.
+        aggregator = metrics.Aggregator(
+            max_age=interval * 3 if interval > 0 else None)
+        metrics.start_collector(metrics_queue, aggregator)
+    RugAPIServer(aggregator).run(cfg.CONF.api_listen, cfg.CONF.api_port)
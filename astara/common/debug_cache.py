@@ -0,0 +1,123 @@
+# Copyright (c) 2016 Akanda, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""In-memory snapshot of the debug mode tables.
+
+The worker checks whether the cluster, a tenant, or a resource is in
+debug mode for every message it receives and every state machine it
+updates. Rather than querying the database each time, the checks are
+answered from a snapshot of all three tables. The snapshot is reloaded
+when the worker changes a debug mode itself, and otherwise at most
+every refresh_interval seconds so that changes made by other
+orchestrator processes are picked up.
+"""
+
+import threading
+import time
+
+from oslo_log import log as logging
+
+from astara.common.i18n import _LE
+
+
+LOG = logging.getLogger(__name__)
+
+
+class DebugModeCache(object):
+    """Answers debug mode queries from a periodically reloaded snapshot."""
+
+    def __init__(self, db_api, refresh_interval):
+        """
+        :param db_api: The database API used to load the snapshot.
+        :param refresh_interval: The maximum age of the snapshot, in
+                                 seconds. 0 disables caching and every
+                                 check goes to the database.
+        :type refresh_interval: int
+        """
+        self.db_api = db_api
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._global = (False, None)
+        self._tenants = {}
+        self._resources = {}
+        self._loaded_at = None
+        # Incremented each time a new snapshot is loaded.
+        self.version = 0
+
+    def invalidate(self):
+        """Force the next check to reload the snapshot."""
+        with self._lock:
+            self._loaded_at = None
+
+    def _load(self):
+        global_debug = self.db_api.global_debug()
+        tenants = dict(self.db_api.tenants_in_debug())
+        resources = dict(self.db_api.resources_in_debug())
+        self._global = global_debug
+        self._tenants = tenants
+        self._resources = resources
+        self._loaded_at = time.time()
+        self.version += 1
+
+    def _refresh(self):
+        with self._lock:
+            if (self._loaded_at is not None and
+                    time.time() - self._loaded_at < self.refresh_interval):
+                return
+            try:
+                self._load()
+            except Exception:
+                if not self.version:
+                    raise
+                # Keep answering from the previous snapshot rather than
+                # failing every message while the database is away, and
+                # only try again once refresh_interval has passed.
+                self._loaded_at = time.time()
+                LOG.exception(_LE('Could not reload debug mode state'))
+
+    def global_debug(self):
+        """
+        :returns: tuple (False, None) if the cluster is not in global debug
+                  mode or (True, "reason") if it is.
+        """
+        if not self.refresh_interval:
+            return self.db_api.global_debug()
+        self._refresh()
+        return self._global
+
+    def tenant_in_debug(self, tenant_uuid):
+        """
+        :returns: tuple (False, None) if the tenant is not in debug mode or
+                  (True, "reason") if it is.
+        """
+        if not self.refresh_interval:
+            return self.db_api.tenant_in_debug(tenant_uuid)
+        self._refresh()
+        tenants = self._tenants
+        if tenant_uuid in tenants:
+            return (True, tenants[tenant_uuid])
+        return (False, None)
+
+    def resource_in_debug(self, resource_uuid):
+        """
+        :returns: tuple (False, None) if the resource is not in debug mode or
+                  (True, "reason") if it is.
+        """
+        if not self.refresh_interval:
+            return self.db_api.resource_in_debug(resource_uuid)
+        self._refresh()
+        resources = self._resources
+        if resource_uuid in resources:
+            return (True, resources[resource_uuid])
+        return (False, None)
@@ -86,16 +86,22 @@ class HashRing(object):
                 _("Invalid hosts supplied when building HashRing."))
 
         self._host_hashes = {}
+        partitions_per_host = 2 ** CONF.hash_partition_exponent
         for host in hosts:
             key = str(host).encode('utf8')
             key_hash = hashlib.md5(key)
-            for p in range(2 ** CONF.hash_partition_exponent):
-                key_hash.update(key)
-                hashed_key = self._hash2int(key_hash)
-                self._host_hashes[hashed_key] = host
+            update = key_hash.update
+            for p in range(partitions_per_host):
+                update(key)
+                self._host_hashes[self._hash2int(key_hash)] = host
         # Gather the (possibly colliding) resulting hashes into a bisectable
         # list.
-        self._partitions = sorted(self._host_hashes.keys())
+        self._partitions = sorted(self._host_hashes)
+        # The host serving each partition, in partition order, so finding
+        # the host for a partition is a list index rather than a dict lookup
+        # keyed by a 128 bit integer.
+        self._partition_hosts = [self._host_hashes[p]
+                                 for p in self._partitions]
 
     def _hash2int(self, key_hash):
         """Convert the given hash's digest to a numerical value for the ring.
@@ -129,13 +135,43 @@ class HashRing(object):
                   this `HashRing` was created with. It may be less than this
                   if ignore_hosts is not None.
         """
-        hosts = []
         if ignore_hosts is None:
             ignore_hosts = set()
         else:
             ignore_hosts = set(ignore_hosts)
             ignore_hosts.intersection_update(self.hosts)
-        partition = self._get_partition(data)
+        return self._get_hosts_for_partition(
+            self._get_partition(data), ignore_hosts)
+
+    def get_hosts_bulk(self, data, ignore_hosts=None):
+        """Get the hosts for many identifiers at once.
+
+        This gives the same answers as calling get_hosts() for each item,
+        but works out the hosts of each partition only once, which makes
+        mapping a whole fleet of resources after a rebalance cheap.
+
+        :param data: An iterable of string identifiers.
+        :param ignore_hosts: A list of hosts to skip, as for get_hosts().
+        :returns: a dict mapping each identifier to its list of hosts.
+        """
+        if ignore_hosts is None:
+            ignore_hosts = set()
+        else:
+            ignore_hosts = set(ignore_hosts)
+            ignore_hosts.intersection_update(self.hosts)
+        by_partition = {}
+        result = {}
+        for item in data:
+            partition = self._get_partition(item)
+            hosts = by_partition.get(partition)
+            if hosts is None:
+                hosts = self._get_hosts_for_partition(partition, ignore_hosts)
+                by_partition[partition] = hosts
+            result[item] = list(hosts)
+        return result
+
+    def _get_hosts_for_partition(self, partition, ignore_hosts):
+        hosts = []
         for replica in range(0, self.replicas):
             if len(hosts) + len(ignore_hosts) == len(self.hosts):
                 # prevent infinite loop - cannot allocate more fallbacks.
@@ -157,7 +193,7 @@ class HashRing(object):
             e.g. 0 is the first partition, 1 is the second.
         :return: The host object the ring was constructed with.
         """
-        return self._host_hashes[self._partitions[partition]]
+        return self._partition_hosts[partition]
 
 
 class HashRingManager(object):
@@ -0,0 +1,371 @@
+# Copyright (c) 2016 Akanda, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Timing histograms, counters and gauges for the orchestrator.
+
+Each process records into its own in-memory registry. Processes that
+are started with a metrics queue periodically send a snapshot of their
+registry to it, and the rug-api process keeps the latest snapshot from
+each one so it can render the combined values in the Prometheus text
+exposition format.
+"""
+
+import bisect
+import contextlib
+import threading
+import time
+
+from oslo_config import cfg
+from oslo_log import log as logging
+from six.moves import queue as Queue
+
+from astara.common.i18n import _LE
+
+
+LOG = logging.getLogger(__name__)
+
+METRICS_OPTS = [
+    cfg.IntOpt('metrics_report_interval',
+               default=10,
+               help=('how often, in seconds, each orchestrator process sends '
+                     'its metrics to the rug-api for aggregation; 0 disables '
+                     'reporting')),
+    cfg.IntOpt('metrics_queue_size',
+               default=256,
+               help=('the number of metrics snapshots allowed to wait for '
+                     'the rug-api; snapshots sent while it is full are '
+                     'dropped')),
+]
+cfg.CONF.register_opts(METRICS_OPTS)
+
+# Upper bounds, in seconds, of the latency histogram buckets. Booting
+# and configuring an appliance can take minutes, so the buckets reach
+# further than usual for request latencies.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+HISTOGRAM = 'histogram'
+COUNTER = 'counter'
+GAUGE = 'gauge'
+
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+# Descriptions shown in the HELP lines of the rendered output.
+DESCRIPTIONS = {
+    'astara_state_duration_seconds':
+    'Time spent executing a state of the resource state machine.',
+    'astara_update_duration_seconds':
+    'Time spent in one update of a resource state machine.',
+    'astara_instance_boot_seconds':
+    'Time from starting an appliance instance until it was configured.',
+    'astara_api_request_duration_seconds':
+    'Latency of calls made to Neutron, Nova and the appliances.',
+    'astara_api_request_errors_total':
+    'Calls made to Neutron, Nova and the appliances that raised an error.',
+    'astara_queue_depth':
+    'Number of items waiting in an orchestrator queue.',
+    'astara_state_machines':
+    'Number of resource state machines managed by a worker process.',
+    'astara_appliance_sessions':
+    'Number of persistent HTTP sessions a worker process keeps to appliances.',
+    'astara_appliance_session_events_total':
+    'Appliance HTTP sessions created, reused, evicted or discarded.',
+}
+
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class Histogram(object):
+    """Counts observations into cumulative buckets."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        # The last slot counts the observations above the largest bucket.
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def to_dict(self):
+        return {
+            'buckets': self.buckets,
+            'counts': list(self.counts),
+            'sum': self.sum,
+            'count': self.count,
+        }
+
+
+class Registry(object):
+    """Holds the metrics recorded by one process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+        self._gauges = {}
+
+    def observe(self, name, value, **labels):
+        """Record value in the histogram name."""
+        key = (name, _label_key(labels))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = Histogram()
+            hist.observe(value)
+
+    def inc(self, name, amount=1, **labels):
+        """Add amount to the counter name."""
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def set_gauge(self, name, value, **labels):
+        """Set the gauge name to value."""
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._gauges[key] = value
+
+    @contextlib.contextmanager
+    def timed(self, name, **labels):
+        """Record the time spent in the block in the histogram name."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def snapshot(self):
+        """Return a picklable copy of the current values."""
+        with self._lock:
+            return {
+                HISTOGRAM: dict((k, h.to_dict())
+                                for k, h in self._histograms.items()),
+                COUNTER: dict(self._counters),
+                GAUGE: dict(self._gauges),
+            }
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+            self._gauges.clear()
+
+
+# Shared by everything running in a process.
+REGISTRY = Registry()
+observe = REGISTRY.observe
+inc = REGISTRY.inc
+set_gauge = REGISTRY.set_gauge
+timed = REGISTRY.timed
+
+
+@contextlib.contextmanager
+def timed_call(service, method):
+    """Time a call made to an external service.
+
+    :param service: 'neutron', 'nova' or 'appliance'
+    :param method: The kind of call, such as the HTTP method.
+    """
+    try:
+        with timed('astara_api_request_duration_seconds',
+                   service=service, method=method):
+            yield
+    except Exception:
+        inc('astara_api_request_errors_total', service=service, method=method)
+        raise
+
+
+def _merge_histogram(into, hist):
+    if into is None:
+        return {
+            'buckets': hist['buckets'],
+            'counts': list(hist['counts']),
+            'sum': hist['sum'],
+            'count': hist['count'],
+        }
+    if tuple(into['buckets']) != tuple(hist['buckets']):
+        # Processes running different code; keep the first one.
+        return into
+    into['counts'] = [a + b for a, b in zip(into['counts'], hist['counts'])]
+    into['sum'] += hist['sum']
+    into['count'] += hist['count']
+    return into
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (k, v.replace('\\', '\\\\').replace('"', '\\"')
+                     .replace('\n', '\\n'))
+        for k, v in labels
+    )
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class Aggregator(object):
+    """Combines the snapshots sent by the orchestrator processes.
+
+    Histograms and counters are summed across processes. Gauges describe
+    a single process, so they are kept apart with a process label.
+    """
+
+    def __init__(self, max_age=None):
+        """
+        :param max_age: Snapshots older than this many seconds are no
+                        longer included, so a process that has exited
+                        drops out. None keeps them forever.
+        :type max_age: int
+        """
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._snapshots = {}
+
+    def update(self, source, snapshot):
+        """Replace the snapshot last received from source."""
+        with self._lock:
+            self._snapshots[source] = (time.time(), snapshot)
+
+    def _current(self):
+        now = time.time()
+        with self._lock:
+            return sorted(
+                (source, snapshot)
+                for source, (received, snapshot) in self._snapshots.items()
+                if self.max_age is None or now - received <= self.max_age
+            )
+
+    def merged(self):
+        """Return the combined values of all current snapshots."""
+        histograms = {}
+        counters = {}
+        gauges = {}
+        for source, snapshot in self._current():
+            for key, hist in snapshot.get(HISTOGRAM, {}).items():
+                histograms[key] = _merge_histogram(histograms.get(key), hist)
+            for key, value in snapshot.get(COUNTER, {}).items():
+                counters[key] = counters.get(key, 0) + value
+            for (name, labels), value in snapshot.get(GAUGE, {}).items():
+                labels = tuple(sorted(labels + (('process', source),)))
+                gauges[(name, labels)] = value
+        return {HISTOGRAM: histograms, COUNTER: counters, GAUGE: gauges}
+
+    def render(self):
+        """Return the combined values in the Prometheus text format."""
+        merged = self.merged()
+        by_name = {}
+        for kind in (HISTOGRAM, COUNTER, GAUGE):
+            for (name, labels), value in merged[kind].items():
+                by_name.setdefault((name, kind), []).append((labels, value))
+
+        lines = []
+        for (name, kind), series in sorted(by_name.items()):
+            if name in DESCRIPTIONS:
+                lines.append('# HELP %s %s' % (name, DESCRIPTIONS[name]))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for labels, value in sorted(series):
+                if kind != HISTOGRAM:
+                    lines.append('%s%s %s' % (
+                        name, _format_labels(labels), _format_value(value)))
+                    continue
+                cumulative = 0
+                bounds = [repr(float(b)) for b in value['buckets']] + ['+Inf']
+                for bound, count in zip(bounds, value['counts']):
+                    cumulative += count
+                    lines.append('%s_bucket%s %d' % (
+                        name,
+                        _format_labels(labels + (('le', bound),)),
+                        cumulative))
+                lines.append('%s_sum%s %s' % (
+                    name, _format_labels(labels),
+                    _format_value(float(value['sum']))))
+                lines.append('%s_count%s %d' % (
+                    name, _format_labels(labels), value['count']))
+        return '\n'.join(lines) + '\n'
+
+
+def _report_loop(metrics_queue, source, collect, interval, registry):
+    while True:
+        time.sleep(interval)
+        try:
+            if collect is not None:
+                collect()
+            metrics_queue.put_nowait((source, registry.snapshot()))
+        except Queue.Full:
+            # The rug-api is not keeping up; it will get the next one.
+            pass
+        except Exception:
+            LOG.exception(_LE('Could not report metrics'))
+
+
+def start_reporter(metrics_queue, source, collect=None, interval=None,
+                   registry=REGISTRY):
+    """Periodically send this process' metrics to the metrics queue.
+
+    :param metrics_queue: The multiprocessing.Queue read by the rug-api.
+    :param source: The name of the reporting process.
+    :param collect: Optional callable invoked before each snapshot, to
+                    update the gauges.
+    :param interval: Seconds between snapshots. Defaults to
+                     metrics_report_interval.
+    :returns: The reporting thread, or None if reporting is disabled.
+    """
+    if interval is None:
+        interval = cfg.CONF.metrics_report_interval
+    if metrics_queue is None or interval <= 0:
+        return None
+    t = threading.Thread(
+        name='metrics-reporter',
+        target=_report_loop,
+        args=(metrics_queue, source, collect, interval, registry),
+    )
+    t.setDaemon(True)
+    t.start()
+    return t
+
+
+def _collect_loop(metrics_queue, aggregator):
+    while True:
+        try:
+            source, snapshot = metrics_queue.get()
+        except IOError:
+            # Interrupted by a signal.
+            continue
+        except Exception:
+            LOG.exception(_LE('Could not read metrics'))
+            continue
+        aggregator.update(source, snapshot)
+
+
+def start_collector(metrics_queue, aggregator):
+    """Feed the snapshots arriving on the metrics queue to aggregator."""
+    t = threading.Thread(
+        name='metrics-collector',
+        target=_collect_loop,
+        args=(metrics_queue, aggregator),
+    )
+    t.setDaemon(True)
+    t.start()
+    return t
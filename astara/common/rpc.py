@@ -118,7 +118,8 @@ class MessagingService(service.Service):
         self._add_server(server)
 
     def create_notification_listener(self, endpoints, exchange=None,
-                                     topic='notifications'):
+                                     topic='notifications', batch_size=None,
+                                     batch_timeout=None):
         """Creates an oslo.messaging notification listener associated with
         provided endpoints. Adds the resulting listener to the pool of
         messaging servers.
@@ -128,13 +129,25 @@ class MessagingService(service.Service):
         :param exchange: Optional control exchange to listen on. If not
                          specified, oslo_messaging defaults to 'openstack'
         :param topic: Topic on which to listen for notification events
+        :param batch_size: When given, create a batch listener that passes
+                           the endpoints lists of up to this many
+                           notifications
+        :param batch_timeout: Seconds a batch listener waits for a batch
+                              to fill up
         """
         transport = get_transport()
         target = get_target(topic=topic, fanout=False,
                             exchange=exchange)
         pool = 'astara.' + topic + '.' + cfg.CONF.host
-        server = oslo_messaging.get_notification_listener(
-            transport, [target], endpoints, pool=pool, executor='threading')
+        if batch_size:
+            server = oslo_messaging.get_batch_notification_listener(
+                transport, [target], endpoints, pool=pool,
+                executor='threading', batch_size=batch_size,
+                batch_timeout=batch_timeout)
+        else:
+            server = oslo_messaging.get_notification_listener(
+                transport, [target], endpoints, pool=pool,
+                executor='threading')
         LOG.debug(
             'Created RPC notification listener on topic:%s/exchange:%s.',
             topic, exchange)
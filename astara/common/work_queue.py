@@ -0,0 +1,196 @@
+# Copyright (c) 2016 Akanda, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Coalescing, prioritized work queue for the worker threads.
+
+Each state machine appears in the queue at most once.  A state machine
+that is already queued or currently being worked on by a thread is not
+queued again; instead its pending priority is upgraded if the new work
+is more urgent.  Threads drain a batch of ready state machines with a
+single lock acquisition and hand each one back with task_done() once it
+has been updated, at which point it is requeued if it has more work.
+"""
+
+import heapq
+import itertools
+import threading
+
+from astara import event
+
+
+# Lower values are handled first.
+ACTION_PRIORITIES = {
+    event.DELETE: 0,
+    event.REBUILD: 1,
+    event.CLUSTER_REBUILD: 1,
+    event.CREATE: 2,
+    event.UPDATE: 3,
+    event.READ: 4,
+    event.POLL: 5,
+}
+DEFAULT_PRIORITY = ACTION_PRIORITIES[event.UPDATE]
+
+
+def priority_for(actions):
+    """Return the most urgent priority for a collection of actions."""
+    return min([ACTION_PRIORITIES.get(a, DEFAULT_PRIORITY)
+                for a in actions] or [DEFAULT_PRIORITY])
+
+
+class WorkQueue(object):
+    """Queue of state machines waiting for a worker thread."""
+
+    def __init__(self, consumers=1, batch_size=1):
+        """
+        :param consumers: The number of threads pulling from the queue, used
+                          to avoid one thread grabbing all of the ready work
+                          while others sit idle.
+        :type consumers: int
+        :param batch_size: The maximum number of state machines handed to a
+                           thread by one call to get_batch().
+        :type batch_size: int
+        """
+        self._consumers = max(consumers, 1)
+        self._batch_size = max(batch_size, 1)
+        self._cond = threading.Condition(threading.Lock())
+        self._heap = []
+        # resource_id -> [priority, seq, sm, valid] heap entry
+        self._queued = {}
+        # resource_ids handed to a thread and not yet returned
+        self._in_progress = set()
+        self._counter = itertools.count()
+        self.closed = False
+
+    def _push(self, sm, priority):
+        entry = [priority, next(self._counter), sm, True]
+        self._queued[sm.resource_id] = entry
+        heapq.heappush(self._heap, entry)
+
+    def put(self, sm, action=None):
+        """Add a state machine to the queue.
+
+        :param sm: The state machine with work to do.
+        :param action: The action that triggered the enqueue. When omitted,
+                       the priority is derived from the state machine's
+                       pending actions.
+        :returns: True if the state machine was newly queued, False if the
+                  request was coalesced with an existing entry.
+        """
+        if action is None:
+            priority = priority_for(sm.pending_actions())
+        else:
+            priority = ACTION_PRIORITIES.get(action, DEFAULT_PRIORITY)
+
+        with self._cond:
+            if self.closed:
+                return False
+            resource_id = sm.resource_id
+            if resource_id in self._in_progress:
+                # The thread holding it will requeue it from task_done().
+                return False
+            entry = self._queued.get(resource_id)
+            if entry is not None:
+                if priority < entry[0]:
+                    # Invalidate the old heap entry and push a more
+                    # urgent one in its place.
+                    entry[3] = False
+                    self._push(sm, priority)
+                return False
+            self._push(sm, priority)
+            self._cond.notify()
+            return True
+
+    def _pop_ready(self):
+        while self._heap:
+            priority, seq, sm, valid = heapq.heappop(self._heap)
+            if valid:
+                del self._queued[sm.resource_id]
+                self._in_progress.add(sm.resource_id)
+                return sm
+        return None
+
+    def get_batch(self, timeout=None):
+        """Take a batch of state machines off of the queue.
+
+        The returned state machines are marked as in progress until they
+        are handed back with task_done().
+
+        :param timeout: Seconds to wait for work.
+        :returns: A list of state machines, an empty list on timeout, or None
+                  if the queue has been closed.
+        """
+        with self._cond:
+            if not self._queued and not self.closed:
+                self._cond.wait(timeout)
+            if self.closed:
+                return None
+            # Leave enough ready work for the other threads.
+            count = min(self._batch_size,
+                        max(1, len(self._queued) // self._consumers))
+            batch = []
+            while len(batch) < count:
+                sm = self._pop_ready()
+                if sm is None:
+                    break
+                batch.append(sm)
+            return batch
+
+    def task_done(self, sm, requeue=True):
+        """Hand a state machine back after working on it.
+
+        :param sm: A state machine returned by get_batch().
+        :param requeue: Whether to queue the state machine again if it has
+                        more work to do.
+        :returns: True if the state machine was requeued.
+        """
+        with self._cond:
+            self._in_progress.discard(sm.resource_id)
+            if (requeue and not self.closed and
+                    sm.resource_id not in self._queued and
+                    sm.has_more_work()):
+                self._push(sm, priority_for(sm.pending_actions()))
+                self._cond.notify()
+                return True
+            return False
+
+    def release(self, resource_id):
+        """Forget that a resource is being worked on.
+
+        :returns: True if the resource was marked in progress.
+        """
+        with self._cond:
+            try:
+                self._in_progress.remove(resource_id)
+            except KeyError:
+                return False
+            return True
+
+    def is_in_progress(self, resource_id):
+        with self._cond:
+            return resource_id in self._in_progress
+
+    def close(self):
+        """Discard any queued work and wake up all waiting threads."""
+        with self._cond:
+            self.closed = True
+            self._heap = []
+            self._queued.clear()
+            self._cond.notify_all()
+
+    def qsize(self):
+        with self._cond:
+            return len(self._queued)
+
+    def __len__(self):
+        return self.qsize()
@@ -79,11 +79,13 @@ class BaseDriver(object):
         """
         pass
 
-    def update_config(self,  management_address, config):
+    def update_config(self,  management_address, config, base_config=None):
         """Updates appliance configuration
 
         This is responsible for pushing configuration to the managed
         appliance
+
+        :param base_config: the last config the appliance accepted, if known
         """
         pass
 
@@ -145,6 +147,19 @@ class BaseDriver(object):
         """
         pass
 
+    @staticmethod
+    def notification_event_types():
+        """The notification event types process_notification() handles
+
+        Used by the notifications layer to build a routing table, so
+        events no enabled driver is interested in are dropped without
+        being offered to every driver.
+
+        :returns: A set of event types, or None if the driver must be
+                  offered every event.
+        """
+        return None
+
     @staticmethod
     def process_notification(tenant_id, event_type, payload):
         """Process an incoming notification event
@@ -52,6 +52,13 @@ STATUS_MAP = {
     states.REPLUG: neutron.PLUGIN_PENDING_UPDATE,
 }
 
+_UPDATE_NOTIFICATIONS = [
+    'listener.create.start',
+    'pool.create.start',
+    'member.create.end',
+    'member.delete.end',
+]
+
 
 class LoadBalancer(BaseDriver):
 
@@ -123,14 +130,15 @@ class LoadBalancer(BaseDriver):
             mgt_port,
             iface_map)
 
-    def update_config(self, management_address, config):
+    def update_config(self, management_address, config, base_config=None):
         """Updates appliance configuration
 
         This is responsible for pushing configuration to the managed
         appliance
         """
         self.log.info(_('Updating config for %s'), self.name)
-        astara_client.update_config(management_address, self.mgt_port, config)
+        astara_client.update_config(management_address, self.mgt_port, config,
+                                    base_config=base_config)
 
     def pre_plug(self, worker_context):
         """pre-plug hook
@@ -251,6 +259,15 @@ class LoadBalancer(BaseDriver):
                     lb_id = lb.id
         return lb_id
 
+    @staticmethod
+    def notification_event_types():
+        """The notification event types process_notification() handles
+
+        :returns: A set of event types.
+        """
+        return set(['loadbalancer.create.end', 'loadbalancer.delete.end'] +
+                   _UPDATE_NOTIFICATIONS)
+
     @staticmethod
     def process_notification(tenant_id, event_type, payload):
         """Process an incoming notification event
@@ -275,22 +292,15 @@ class LoadBalancer(BaseDriver):
             payload.get('loadbalancer_id')
         )
 
-        update_notifications = [
-            'listener.create.start',
-            'pool.create.start',
-            'member.create.end',
-            'member.delete.end',
-        ]
-
         # some events do not contain a lb id.
-        if not lb_id and event_type not in update_notifications:
+        if not lb_id and event_type not in _UPDATE_NOTIFICATIONS:
             return
 
         if event_type == 'loadbalancer.create.end':
             crud = event.CREATE
         elif event_type == 'loadbalancer.delete.end':
             crud = event.DELETE
-        elif event_type in update_notifications:
+        elif event_type in _UPDATE_NOTIFICATIONS:
             crud = event.UPDATE
         else:
             crud = None
@@ -168,7 +168,7 @@ class Router(BaseDriver):
             iface_map
         )
 
-    def update_config(self, management_address, config):
+    def update_config(self, management_address, config, base_config=None):
         """Updates appliance configuration
 
         This is responsible for pushing configuration to the managed
@@ -178,7 +178,8 @@ class Router(BaseDriver):
         start_time = timeutils.utcnow()
 
         astara_client.update_config(
-            management_address, self.mgt_port, config)
+            management_address, self.mgt_port, config,
+            base_config=base_config)
         delta = timeutils.delta_seconds(start_time, timeutils.utcnow())
         self.log.info(_('Config updated for %s after %s seconds'),
                       self.name, round(delta, 2))
@@ -271,6 +272,19 @@ class Router(BaseDriver):
             return None
         return router.id
 
+    @staticmethod
+    def notification_event_types():
+        """The notification event types process_notification() handles
+
+        :returns: A set of event types.
+        """
+        event_types = set(['router.create.end', 'router.delete.end'])
+        event_types.update(_ROUTER_INTERFACE_NOTIFICATIONS)
+        event_types.update(_ROUTER_INTERESTING_NOTIFICATIONS)
+        if cfg.CONF.router.ipsec_vpn:
+            event_types.update(_VPN_NOTIFICATIONS)
+        return event_types
+
     @staticmethod
     def process_notification(tenant_id, event_type, payload):
         """Process an incoming notification event
@@ -303,6 +317,13 @@ class Router(BaseDriver):
             router_id = payload.get('router.interface', {}).get('id')
         elif event_type in _ROUTER_INTERESTING_NOTIFICATIONS:
             crud = event.UPDATE
+            port = payload.get('port') or {}
+            if (not router_id and
+                    port.get('device_owner', '').startswith(
+                        'network:router')):
+                # A port plugged into the router, so the event is about
+                # that router rather than whichever one the tenant has.
+                router_id = port.get('device_id') or None
         elif cfg.CONF.router.ipsec_vpn and event_type in _VPN_NOTIFICATIONS:
             crud = event.UPDATE
         else:
@@ -21,9 +21,13 @@
 import threading
 import time
 
+import six
+from six.moves import queue as Queue
+
 from oslo_config import cfg
 
 from astara import event
+from astara.drivers import states
 
 from oslo_log import log as logging
 
@@ -35,6 +39,12 @@ HEALTH_INSPECTOR_OPTS = [
     cfg.IntOpt('health_check_period',
                default=60,
                help='seconds between health checks'),
+    cfg.IntOpt('health_probe_threads',
+               default=64,
+               help=('the maximum number of appliances a worker process '
+                     'probes concurrently during a health check. Only '
+                     'resources found to have changed are then polled. '
+                     'Set to 0 to poll every resource instead.')),
 ]
 CONF.register_opts(HEALTH_INSPECTOR_OPTS)
 
@@ -59,6 +69,92 @@ def _health_inspector(scheduler):
         scheduler.handle_message('*', e)
 
 
+class HealthProber(object):
+    """Checks the liveness of many appliances at once.
+
+    A worker process uses this to handle the periodic wildcard POLL.
+    Instead of having every state machine run its own serial liveness
+    checks, the management addresses of all of the configured resources
+    are probed concurrently and only the state machines whose health may
+    have changed are sent the POLL.
+    """
+
+    def __init__(self, threads):
+        self.threads = threads
+
+    def probe(self, checks):
+        """Run liveness checks concurrently.
+
+        :param checks: A dict mapping a management address to a callable
+                       that takes the address and returns whether it is
+                       alive. Each callable is expected to enforce its own
+                       timeout.
+        :returns: The set of addresses found alive.
+        """
+        pending = Queue.Queue()
+        for item in checks.items():
+            pending.put(item)
+        alive = set()
+
+        def _probe():
+            while True:
+                try:
+                    address, is_alive = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    if is_alive(address):
+                        # set.add is atomic, no lock needed.
+                        alive.add(address)
+                except Exception:
+                    LOG.debug('liveness probe of %s failed', address,
+                              exc_info=True)
+
+        threads = [
+            threading.Thread(target=_probe, name='HealthProbe%02d' % i)
+            for i in six.moves.range(min(self.threads, len(checks)))
+        ]
+        for t in threads:
+            t.setDaemon(True)
+            t.start()
+        for t in threads:
+            t.join()
+        return alive
+
+    def find_changed(self, state_machines):
+        """Return the state machines that need to handle the health POLL.
+
+        A state machine is skipped only when its resource is configured and
+        every one of its instances answered the probe, since handling the
+        POLL would not change anything for it.
+        """
+        changed = []
+        candidates = []
+        checks = {}
+        for sm in state_machines:
+            if sm.deleted:
+                continue
+            instances = sm.instance.instances
+            addresses = [i.management_address for i in instances.instances]
+            if (sm.instance.state != states.CONFIGURED or
+                    instances.cluster_degraded or
+                    not addresses or not all(addresses)):
+                changed.append(sm)
+                continue
+            candidates.append((sm, addresses))
+            for address in addresses:
+                checks[address] = sm.resource.is_alive
+
+        alive = self.probe(checks)
+        for sm, addresses in candidates:
+            if not alive.issuperset(addresses):
+                changed.append(sm)
+        LOG.debug('health probe of %d appliances found %d of %d '
+                  'resources changed', len(checks), len(changed),
+                  len(state_machines))
+        return changed
+
+
 def start_inspector(period, scheduler):
     """Start a health check thread.
     """
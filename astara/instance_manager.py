@@ -16,14 +16,17 @@
 
 from datetime import datetime
 from functools import wraps
+import threading
 import time
 import six
 
 from oslo_config import cfg
 
+from astara.api.config import delta
 from astara.drivers import states
 from astara.common.i18n import _LE, _LI
 from astara.common import container
+from astara.common import metrics
 
 
 CONF = cfg.CONF
@@ -41,8 +44,15 @@ INSTANCE_MANAGER_OPTS = [
         help='Number of seconds to ignore new events when an instance goes '
         'into ERROR state.',
     ),
+    cfg.IntOpt(
+        'config_resync_interval',
+        default=600,
+        help='Number of seconds after which the config of an instance is '
+        'pushed again even if it has not changed. Set to 0 to push the '
+        'config on every update.'),
 ]
 CONF.register_opts(INSTANCE_MANAGER_OPTS)
+CONF.import_opt('config_timeout', 'astara.api.astara_client')
 
 
 def _generate_interface_map(instance, interfaces):
@@ -78,19 +88,31 @@ def ensure_cache(f):
     Ensures that self.instance_info is up to date and catches instances in a
     GONE or missing state before wasting cycles trying to do something with it.
 
+    The managed instances are reconciled against a single nova listing of the
+    resource's servers, and their ports are refreshed with a single neutron
+    call. During an update cycle (see InstanceManager.begin_update_cycle())
+    that snapshot is reused by the following decorated calls until something
+    changes the instances. The listing may come from the server index and be
+    up to nova_server_index_ttl seconds old, so the instances are looked up
+    one by one before they are booted, replugged or deleted.
+
     NOTE: This replaces the old function called _ensure_cache made a Decorator
     rather than calling it explicitly at the start of all those functions.
     """
     @wraps(f)
     def wrapper(self, worker_context, *args, **kw):
-        self.instances.refresh(worker_context)
-
-        instances = worker_context.nova_client.get_instances_for_obj(
-            self.resource.name)
-        for inst_info in instances:
-            self.instances[inst_info.id_] = inst_info
-
-        self.instances.update_ports(worker_context)
+        if not self._snapshot_fresh:
+            instances = worker_context.nova_client.get_instances_for_obj(
+                self.resource.name)
+            found = set(inst_info.id_ for inst_info in instances)
+            for instance_id, _ in list(self.instances.items()):
+                if instance_id not in found:
+                    del self.instances[instance_id]
+            for inst_info in instances:
+                self.instances[inst_info.id_] = inst_info
+
+            self.instances.update_ports(worker_context)
+            self._snapshot_fresh = self._in_update_cycle
 
         return f(self, worker_context, *args, **kw)
 
@@ -112,12 +134,36 @@ class BootAttemptCounter(object):
         return self._attempts
 
 
+class _ConfigPush(threading.Thread):
+    """Daemon thread pushing a config, with a flag to make it give up
+
+    A push that is cancelled stops before its next attempt; a request
+    already on the wire completes before any newer push to the same
+    instance is sent.
+    """
+    def __init__(self, *args, **kwargs):
+        super(_ConfigPush, self).__init__(*args, **kwargs)
+        self.setDaemon(True)
+        self.cancelled = threading.Event()
+
+
 class InstanceGroupManager(container.ResourceContainer):
     def __init__(self, log, resource):
         super(InstanceGroupManager, self).__init__()
         self.log = log
         self.resource = resource
         self._alive = set()
+        # instance id -> (fingerprint, time, delta.pack()ed config) of the
+        # last config it accepted
+        self._applied_configs = {}
+        # instance id -> lock held while a config request is on the wire, so
+        # a newer push never overtakes the request of an abandoned one
+        self._push_locks = {}
+
+    def __delitem__(self, instance_id):
+        self._applied_configs.pop(instance_id, None)
+        self._push_locks.pop(instance_id, None)
+        super(InstanceGroupManager, self).__delitem__(instance_id)
 
     @property
     def instances(self):
@@ -169,19 +215,23 @@ class InstanceGroupManager(container.ResourceContainer):
 
         dead = set(self.resources.values()) - alive
         self._alive = [i.id_ for i in alive - dead]
+        # an instance that stopped answering may come back without its config
+        for inst_info in dead:
+            self.forget_config(inst_info)
         return list(alive), list(dead)
 
     def update_ports(self, worker_context):
         """Refresh ports on all managed instance info objects"""
-        for instance_info in self.instances:
-            if not instance_info:
-                continue
+        instances = [i for i in self.instances if i]
+        if not instances:
+            return
+        ports = worker_context.neutron.get_ports_for_instances(
+            [i.id_ for i in instances])
+        for instance_info in instances:
             (
                 instance_info.management_port,
                 instance_info.ports
-            ) = worker_context.neutron.get_ports_for_instance(
-                instance_info.id_
-            )
+            ) = ports.get(instance_info.id_, (None, []))
 
     def get_interfaces(self):
         """Obtain a list of interfaces from each managed instance
@@ -239,32 +289,68 @@ class InstanceGroupManager(container.ResourceContainer):
 
         return False
 
-    def _update_config(self, instance, config):
+    def _update_config(self, instance, config, base_config=None):
         self.log.debug(
             'Updating config for instance %s on resource %s',
             instance.id_, self.resource.id)
         self.log.debug('New config: %r', config)
+        # set when the push runs in a _ConfigPush that outlived its deadline
+        cancelled = getattr(threading.current_thread(), 'cancelled', None)
+        lock = self._push_locks.setdefault(instance.id_, threading.Lock())
         attempts = cfg.CONF.max_retries
         for i in six.moves.range(attempts):
-            try:
-                self.resource.update_config(
-                    instance.management_address,
-                    config)
-            except Exception:
-                if i == attempts - 1:
-                    # Only log the traceback if we encounter it many times.
-                    self.log.exception(_LE('failed to update config'))
+            with lock:
+                if cancelled is not None and cancelled.is_set():
+                    self.log.info(
+                        'Abandoning stale config push to instance %s',
+                        instance.id_)
+                    return False
+                try:
+                    self.resource.update_config(
+                        instance.management_address,
+                        config,
+                        base_config=base_config)
+                except Exception:
+                    if i == attempts - 1:
+                        # Only log the traceback if we encounter it many
+                        # times.
+                        self.log.exception(_LE('failed to update config'))
+                    else:
+                        self.log.debug(
+                            'failed to update config, attempt %d',
+                            i
+                        )
                 else:
-                    self.log.debug(
-                        'failed to update config, attempt %d',
-                        i
-                    )
-                time.sleep(cfg.CONF.retry_delay)
-            else:
-                self.log.info('Instance config updated')
-                return True
+                    self.log.info('Instance config updated')
+                    return True
+            time.sleep(cfg.CONF.retry_delay)
+        else:
+            return False
+
+    def forget_config(self, instance=None):
+        """Forces the next configure() to push the config again
+
+        :param instance: InstanceInfo object, or None for all instances
+        """
+        if instance is None:
+            self._applied_configs.clear()
         else:
+            self._applied_configs.pop(instance.id_, None)
+
+    def _config_applied(self, instance, fingerprint):
+        """Checks whether the instance already runs the given config
+
+        The config is considered stale once config_resync_interval seconds
+        have passed since it was pushed, so that an instance that lost its
+        config unnoticed eventually gets it back.
+        """
+        applied = self._applied_configs.get(instance.id_)
+        if applied is None or applied[0] != fingerprint:
+            return False
+        interval = cfg.CONF.config_resync_interval
+        if interval <= 0 or time.time() - applied[1] >= interval:
             return False
+        return True
 
     def _ha_config(self, instance):
         """Builds configuration describing the HA cluster
@@ -296,10 +382,61 @@ class InstanceGroupManager(container.ResourceContainer):
             'priority': priority,
         }
 
+    def _push_configs(self, updates):
+        """Pushes configs to several instances concurrently
+
+        Each instance gets its own thread, and all of them share the
+        deadline of a single _update_config() that exhausts its retries.
+        An instance whose push has not finished by then counts as failed
+        and its push is cancelled.
+
+        :param updates: list of (instance, config, base_config) tuples
+        :returns: set of the instances whose config was updated
+        """
+        if len(updates) == 1:
+            inst, config, base_config = updates[0]
+            if self._update_config(inst, config, base_config) is True:
+                return set([inst])
+            return set()
+
+        results = {}
+
+        def _push(inst, config, base_config):
+            results[inst.id_] = self._update_config(inst, config, base_config)
+
+        threads = [
+            _ConfigPush(target=_push, args=update,
+                        name='ConfigPush-%s' % update[0].id_)
+            for update in updates
+        ]
+        for t in threads:
+            t.start()
+
+        # config_timeout bounds the connect and the read of a request
+        # separately, so a single attempt may take twice as long.
+        deadline = time.time() + cfg.CONF.max_retries * (
+            2 * cfg.CONF.config_timeout + cfg.CONF.retry_delay)
+        for t in threads:
+            t.join(max(deadline - time.time(), 0))
+
+        for t in threads:
+            t.cancelled.set()
+
+        results = dict(results)
+        updated = set()
+        for inst, _, _ in updates:
+            if results.get(inst.id_) is True:
+                updated.add(inst)
+            elif inst.id_ not in results:
+                self.log.error(
+                    'Config update for instance %s did not finish in time',
+                    inst.id_)
+        return updated
+
     def configure(self, worker_context):
-        # XXX config update can be dispatched to threads to speed
-        # things up across multiple instances
         failed = []
+        updates = []
+        fingerprints = {}
 
         # get_interfaces() return returns only instances that are up and ready
         # for config
@@ -321,12 +458,37 @@ class InstanceGroupManager(container.ResourceContainer):
                 config['ha_config'] = config.get('ha') or {}
                 config['ha_config'].update(self._ha_config(inst))
 
+            fingerprint = delta.fingerprint(config)
+            if self._config_applied(inst, fingerprint):
+                self.log.debug(
+                    'config for instance %s on %s resource is unchanged, '
+                    'skipping update', inst.id_, self.resource.RESOURCE_NAME)
+                continue
+
+            # send only the changes from the config the instance runs, but
+            # the whole config when resyncing
+            applied = self._applied_configs.get(inst.id_)
+            if applied is not None and applied[0] != fingerprint:
+                base_config = delta.unpack(applied[2])
+            else:
+                base_config = None
+
             self.log.debug(
                 'preparing to update config for instance %s on %s resource '
                 'to %r', inst.id_, self.resource.RESOURCE_NAME, config)
-
-            if self._update_config(inst, config) is not True:
-                failed.append(inst)
+            updates.append((inst, config, base_config))
+            fingerprints[inst.id_] = fingerprint
+
+        if updates:
+            updated = self._push_configs(updates)
+            for inst, config, _ in updates:
+                if inst in updated:
+                    self._applied_configs[inst.id_] = (
+                        fingerprints[inst.id_], time.time(),
+                        delta.pack(config))
+                else:
+                    self.forget_config(inst)
+                    failed.append(inst)
 
         if set(failed) == set(self.instances):
             # all updates have failed
@@ -357,6 +519,7 @@ class InstanceGroupManager(container.ResourceContainer):
 
     def delete(self, instance):
         """Removes nova server reference from manager"""
+        self.forget_config(instance)
         del self.resources[instance.id_]
 
     def refresh(self, worker_context):
@@ -447,9 +610,25 @@ class InstanceManager(object):
         self._boot_counter = BootAttemptCounter()
         self._boot_logged = []
         self._last_synced_status = None
+        self._in_update_cycle = False
+        self._snapshot_fresh = False
 
         self.state = self.update_state(worker_context, silent=True)
 
+    def begin_update_cycle(self):
+        """Start reusing the instance snapshot taken by ensure_cache.
+
+        Called by the state machine before it runs a series of actions, so
+        that only the first of them has to query nova and neutron.
+        """
+        self._in_update_cycle = True
+        self._snapshot_fresh = False
+
+    def end_update_cycle(self):
+        """Stop reusing the instance snapshot."""
+        self._in_update_cycle = False
+        self._snapshot_fresh = False
+
     @property
     def attempts(self):
         """Property which returns the boot count.
@@ -532,11 +711,15 @@ class InstanceManager(object):
         if self.state == states.CONFIGURED:
             for i in alive:
                 if not i.booting and i not in self._boot_logged:
+                    boot_time = i.time_since_boot.total_seconds()
                     self.log.info(
                         '%s booted in %s seconds after %s attempts',
                         self.resource.RESOURCE_NAME,
-                        i.time_since_boot.total_seconds(),
+                        boot_time,
                         self._boot_counter.count)
+                    metrics.observe('astara_instance_boot_seconds',
+                                    boot_time,
+                                    driver=self.resource.RESOURCE_NAME)
                     self._boot_logged.append(i)
             self.reset_boot_counter()
         else:
@@ -552,6 +735,10 @@ class InstanceManager(object):
         :returns: None
         """
         self.log.info('Booting %s' % self.resource.RESOURCE_NAME)
+        self._snapshot_fresh = False
+        # The snapshot may come from the server index, so check that the
+        # instances still exist before deciding how many to boot.
+        self.instances.refresh(worker_context)
 
         if self.state != states.DEGRADED:
             self.state = states.DOWN
@@ -626,6 +813,8 @@ class InstanceManager(object):
         :returns:
         """
         self.log.info(_LI('Destroying instance'))
+        self._snapshot_fresh = False
+        self.instances.refresh(worker_context)
 
         self.resource.delete_ports(worker_context)
 
@@ -679,6 +868,8 @@ class InstanceManager(object):
         :returns:
         """
         self.log.debug('Attempting to replug...')
+        self._snapshot_fresh = False
+        self.instances.refresh(worker_context)
 
         self.resource.pre_plug(worker_context)
 
@@ -28,8 +28,10 @@ from oslo_log import log
 
 from astara.common.i18n import _LE, _LI
 from astara.common import config as ak_cfg
+from astara.common import metrics
 from astara import coordination
 from astara import daemon
+from astara import event
 from astara import health
 from astara import metadata
 from astara import notifications
@@ -55,22 +57,75 @@ CEILOMETER_OPTS = [
                 help='Enable reporting metrics to ceilometer.'),
     cfg.StrOpt('topic', default='notifications.info',
                help='The name of the topic queue ceilometer consumes events '
-                    'from.')
+                    'from.'),
+    cfg.IntOpt('bandwidth_interval', default=60,
+               help='Number of seconds over which the bandwidth samples of '
+                    'each tenant are collected before they are sent '
+                    'together in astara.bandwidth.used.batch notifications. '
+                    'Set to 0 to send each sample as soon as it is read, in '
+                    'an astara.bandwidth.used notification.'),
+    cfg.IntOpt('batch_size', default=100,
+               help='The maximum number of routers whose bandwidth is sent '
+                    'in a single notification.'),
+    cfg.IntOpt('queue_size', default=1000,
+               help='The maximum number of notifications a worker process '
+                    'keeps waiting to be sent. While the queue is full, '
+                    'bandwidth samples are dropped first to make room for '
+                    'other notifications.'),
 ]
 CONF.register_group(cfg.OptGroup(name='ceilometer',
                                  title='Ceilometer Reporting Options'))
 CONF.register_opts(CEILOMETER_OPTS, group='ceilometer')
 
 
+def _prepare_message(message):
+    if getattr(message, 'crud', None) == event.REBALANCE:
+        message = populate.add_rebalance_inventory(message)
+    return message
+
+
+def _collect_metrics(notification_queue, sched):
+    try:
+        depth = notification_queue.qsize()
+    except NotImplementedError:
+        depth = None
+    if depth is not None:
+        metrics.set_gauge('astara_queue_depth', depth, queue='notification')
+    for name, depth in sched.queue_depths().items():
+        metrics.set_gauge('astara_queue_depth', depth, queue='scheduler',
+                          worker=name)
+
+
 def shuffle_notifications(notification_queue, sched):
     """Copy messages from the notification queue into the scheduler.
+
+    Messages that have already piled up behind the first one are passed
+    to the scheduler together, so each worker process receives them in a
+    single batch.
     """
+    batch_size = max(cfg.CONF.scheduler_batch_size, 1)
     while True:
         try:
             target, message = notification_queue.get()
             if target is None:
                 break
-            sched.handle_message(target, message)
+            batch = [(target, _prepare_message(message))]
+            stop = False
+            while len(batch) < batch_size and not notification_queue.empty():
+                try:
+                    target, message = notification_queue.get()
+                except IOError:
+                    break
+                if target is None:
+                    stop = True
+                    break
+                batch.append((target, _prepare_message(message)))
+            if len(batch) == 1:
+                sched.handle_message(*batch[0])
+            else:
+                sched.handle_messages(batch)
+            if stop:
+                break
         except IOError:
             # FIXME(rods): if a signal arrive during an IO operation
             # an IOError is raised. We catch the exceptions in
@@ -125,6 +180,10 @@ def main(argv=sys.argv[1:]):
     # listening process and the scheduler.
     notification_queue = multiprocessing.Queue()
 
+    # Set up the queue the other processes use to send their metrics
+    # to the rug-api, which combines them.
+    metrics_queue = multiprocessing.Queue(cfg.CONF.metrics_queue_size)
+
     # Ignore signals that might interrupt processing.
     daemon.ignore_signals()
 
@@ -165,6 +224,9 @@ def main(argv=sys.argv[1:]):
     from astara.api import rug as rug_api
     rug_api_proc = multiprocessing.Process(
         target=rug_api.serve,
+        kwargs={
+            'metrics_queue': metrics_queue,
+        },
         name='rug-api'
     )
     rug_api_proc.start()
@@ -174,6 +236,9 @@ def main(argv=sys.argv[1:]):
                  else notifications.NoopPublisher)
     publisher = Publisher(
         topic=cfg.CONF.ceilometer.topic,
+        queue_size=cfg.CONF.ceilometer.queue_size,
+        bandwidth_interval=cfg.CONF.ceilometer.bandwidth_interval,
+        batch_size=cfg.CONF.ceilometer.batch_size,
     )
 
     # Set up a factory to make Workers that know how many threads to
@@ -182,6 +247,7 @@ def main(argv=sys.argv[1:]):
         worker.Worker,
         notifier=publisher,
         management_address=mgt_ip_address,
+        metrics_queue=metrics_queue,
     )
 
     # Set up the scheduler that knows how to manage the routers and
@@ -193,6 +259,11 @@ def main(argv=sys.argv[1:]):
     # Prepopulate the workers with existing routers on startup
     populate.pre_populate_workers(sched)
 
+    metrics.start_reporter(
+        metrics_queue, p.name,
+        collect=functools.partial(_collect_metrics, notification_queue, sched),
+    )
+
     # Set up the periodic health check
     health.start_inspector(cfg.CONF.health_check_period, sched)
 
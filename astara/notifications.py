@@ -18,8 +18,10 @@
 """Listen for notifications.
 """
 
+import collections
 import Queue
 import threading
+import time
 
 from astara import commands
 from astara import drivers
@@ -45,12 +47,26 @@ NOTIFICATIONS_OPTS = [
                help='name of the exchange where we receive RPC calls'),
     cfg.StrOpt('neutron-control-exchange',
                default='neutron',
-               help='The name of the exchange used by Neutron for RPCs')
+               help='The name of the exchange used by Neutron for RPCs'),
+    cfg.IntOpt('notification-batch-size',
+               default=50,
+               help=('the maximum number of notifications received and '
+                     'coalesced together; 1 handles each notification on '
+                     'its own')),
+    cfg.FloatOpt('notification-batch-timeout',
+                 default=0.5,
+                 help=('the number of seconds to wait for a batch of '
+                       'notifications to fill up')),
 ]
 cfg.CONF.register_opts(NOTIFICATIONS_OPTS)
 
 LOG = logging.getLogger(__name__)
 
+BANDWIDTH_EVENT = 'astara.bandwidth.used'
+# The samples of several routers sent together, with a payload that differs
+# from the one of BANDWIDTH_EVENT.
+BANDWIDTH_BATCH_EVENT = 'astara.bandwidth.used.batch'
+
 
 def _get_tenant_id_for_message(context, payload=None):
     """Find the tenant id in the incoming message."""
@@ -107,27 +123,100 @@ class L3RPCEndpoint(object):
         self.notification_queue.put((e.resource.tenant_id, e))
 
 
+class NotificationRouter(object):
+    """Maps notification event types to the drivers that handle them.
+
+    The table is built once from the enabled drivers, so routing an
+    event is a single dict lookup and events that no driver handles can
+    be dropped right away.
+    """
+    def __init__(self, driver_list=None):
+        if driver_list is None:
+            driver_list = list(drivers.enabled_drivers())
+        self._table = {}
+        # Drivers that do not say which events they handle see all of them.
+        self._catch_all = []
+        for driver in driver_list:
+            event_types = driver.notification_event_types()
+            if event_types is None:
+                self._catch_all.append(driver)
+                continue
+            for event_type in event_types:
+                self._table.setdefault(event_type, []).append(driver)
+
+    def drivers_for(self, event_type):
+        """Returns the drivers to offer an event of the given type."""
+        routed = self._table.get(event_type)
+        if not self._catch_all:
+            return routed or []
+        return (routed or []) + self._catch_all
+
+
+def _merge_events(first, second):
+    """Combine two updates for the same resource into one.
+
+    The newest payload is kept. The older payloads are carried along
+    under 'coalesced_payloads', so the worker can still drop every
+    cached Neutron lookup they affect.
+    """
+    body = dict(second.body) if isinstance(second.body, dict) else {}
+    coalesced = []
+    if isinstance(first.body, dict):
+        older = dict(first.body)
+        coalesced.extend(older.pop('coalesced_payloads', []))
+        coalesced.append(older)
+    body['coalesced_payloads'] = coalesced
+    return event.Event(resource=second.resource, crud=second.crud, body=body)
+
+
+def coalesce_events(events):
+    """Merge repeated updates for the same resource.
+
+    Only UPDATE events for a known resource are merged. The merged event
+    takes the place of the first one, and any other kind of event for the
+    resource starts a new group so the order of creates and deletes
+    relative to updates is kept.
+
+    :param events: a list of (target, event.Event) tuples
+    :returns: a list of (target, event.Event) tuples
+    """
+    result = []
+    pending = {}
+    for target, e in events:
+        key = (target, e.resource.driver, e.resource.id)
+        if e.crud != event.UPDATE or not e.resource.id:
+            pending.pop(key, None)
+            result.append((target, e))
+            continue
+        idx = pending.get(key)
+        if idx is None:
+            pending[key] = len(result)
+            result.append((target, e))
+        else:
+            result[idx] = (target, _merge_events(result[idx][1], e))
+    return result
+
+
 class NotificationsEndpoint(object):
     """A RPC endpoint for processing notification"""
-    def __init__(self, notification_queue):
+    def __init__(self, notification_queue, router=None):
         self.notification_queue = notification_queue
+        self.router = router or NotificationRouter()
 
-    def info(self, ctxt, publisher_id, event_type, payload, metadata):
-        tenant_id = _get_tenant_id_for_message(ctxt, payload)
+    def _make_events(self, ctxt, event_type, payload):
+        """Translate a notification into (target, event.Event) tuples."""
         crud = event.UPDATE
-        e = None
         events = []
         if event_type.startswith('astara.command'):
             LOG.debug('received a command: %r', payload)
             crud = event.COMMAND
             if payload.get('command') == commands.POLL:
                 r = event.Resource(driver='*', id='*', tenant_id='*')
-                e = event.Event(
+                poll = event.Event(
                     resource=r,
                     crud=event.POLL,
                     body={})
-                self.notification_queue.put(('*', e))
-                return
+                return [('*', poll)]
             else:
                 # If the message does not specify a tenant, send it to everyone
                 tenant_id = payload.get('tenant_id', '*')
@@ -138,8 +227,13 @@ class NotificationsEndpoint(object):
                     tenant_id=tenant_id)
                 events.append(event.Event(resource, crud, payload))
         else:
+            driver_list = self.router.drivers_for(event_type)
+            if not driver_list:
+                LOG.debug('No driver handles %s events, ignoring', event_type)
+                return []
 
-            for driver in drivers.enabled_drivers():
+            tenant_id = _get_tenant_id_for_message(ctxt, payload)
+            for driver in driver_list:
                 driver_event = driver.process_notification(
                     tenant_id, event_type, payload)
                 if driver_event:
@@ -148,22 +242,61 @@ class NotificationsEndpoint(object):
         if not events:
             LOG.debug('Could not construct any events from %s /w payload: %s',
                       event_type, payload)
-            return
+            return []
 
         LOG.debug('Generated %s events from %s /w payload: %s',
                   len(events), event_type, payload)
 
-        for e in events:
-            self.notification_queue.put((e.resource.tenant_id, e))
+        return [(e.resource.tenant_id, e) for e in events]
+
+    def info(self, ctxt, publisher_id, event_type, payload, metadata):
+        for target, e in self._make_events(ctxt, event_type, payload):
+            self.notification_queue.put((target, e))
+
+
+class BatchNotificationsEndpoint(NotificationsEndpoint):
+    """A RPC endpoint for processing batches of notifications
+
+    Neutron sends several notifications for a single change to a router,
+    so the events generated from a batch are coalesced before they are
+    queued for the scheduler.
+    """
+    def info(self, messages):
+        events = []
+        for message in messages:
+            # A notification that cannot be handled must not lose the
+            # others of its batch.
+            try:
+                events.extend(self._make_events(
+                    message['ctxt'], message['event_type'],
+                    message['payload']))
+            except Exception:
+                LOG.exception(_LE('could not handle notification %r'),
+                              message)
+        coalesced = coalesce_events(events)
+        if len(coalesced) < len(events):
+            LOG.debug('Coalesced %d events from %d notifications into %d',
+                      len(events), len(messages), len(coalesced))
+        for target, e in coalesced:
+            self.notification_queue.put((target, e))
 
 
 def listen(notification_queue):
     """Create and launch the messaging service"""
     connection = rpc.MessagingService()
-    connection.create_notification_listener(
-        endpoints=[NotificationsEndpoint(notification_queue)],
-        exchange=cfg.CONF.neutron_control_exchange,
-    )
+    batch_size = cfg.CONF.notification_batch_size
+    if batch_size > 1:
+        connection.create_notification_listener(
+            endpoints=[BatchNotificationsEndpoint(notification_queue)],
+            exchange=cfg.CONF.neutron_control_exchange,
+            batch_size=batch_size,
+            batch_timeout=cfg.CONF.notification_batch_timeout,
+        )
+    else:
+        connection.create_notification_listener(
+            endpoints=[NotificationsEndpoint(notification_queue)],
+            exchange=cfg.CONF.neutron_control_exchange,
+        )
     connection.create_rpc_consumer(
         topic=L3_AGENT_TOPIC,
         endpoints=[L3RPCEndpoint(notification_queue)]
@@ -191,11 +324,31 @@ class Sender(object):
 
 
 class Publisher(Sender):
+    """Sends notifications from a thread of the worker process.
+
+    Bandwidth samples are not sent as they are published. The latest
+    sample of each router is kept, and every bandwidth_interval seconds the
+    samples of each tenant are sent together, batch_size routers per
+    BANDWIDTH_BATCH_EVENT notification. The queue of notifications waiting
+    to be sent holds at most queue_size of them, and notifications
+    published while it is full are dropped rather than blocking the worker
+    threads when the message broker falls behind. Queued bandwidth samples
+    are dropped first to make room for other notifications.
+    """
 
-    def __init__(self, topic=None):
+    def __init__(self, topic=None, queue_size=1000, bandwidth_interval=60,
+                 batch_size=100):
         super(Publisher, self).__init__(topic)
-        self._q = Queue.Queue()
+        self._q = Queue.Queue(maxsize=max(queue_size, 0))
         self._t = None
+        self._bandwidth_interval = bandwidth_interval
+        self._batch_size = max(batch_size, 1)
+        # tenant id -> router id -> (timestamp, bandwidth)
+        self._bandwidth = collections.defaultdict(dict)
+        # publish() is called from all of the worker threads
+        self._dropped_lock = threading.Lock()
+        self.dropped = 0
+        self._reported_dropped = 0
 
     def start(self):
         ready = threading.Event()
@@ -214,12 +367,82 @@ class Publisher(Sender):
     def stop(self):
         if self._t:
             LOG.debug('stopping %s', self._t.getName())
-            self._q.put(None)
+            try:
+                self._q.put(None, timeout=1)
+            except Queue.Full:
+                LOG.warning('notification queue is full, not waiting for '
+                            '%s', self._t.getName())
             self._t.join(timeout=1)
             self._t = None
 
     def publish(self, incoming):
-        self._q.put(incoming)
+        try:
+            self._q.put_nowait(incoming)
+        except Queue.Full:
+            if not self._replace_bandwidth(incoming):
+                with self._dropped_lock:
+                    self.dropped += 1
+
+    def _replace_bandwidth(self, incoming):
+        """Queue incoming in place of the oldest queued bandwidth sample.
+
+        :returns: True if a bandwidth sample was dropped for incoming
+        """
+        if incoming and incoming.get('event_type') == BANDWIDTH_EVENT:
+            return False
+        with self._q.mutex:
+            for msg in self._q.queue:
+                if msg and msg.get('event_type') == BANDWIDTH_EVENT:
+                    self._q.queue.remove(msg)
+                    self._q.queue.append(incoming)
+                    break
+            else:
+                return False
+        with self._dropped_lock:
+            self.dropped += 1
+        return True
+
+    def _handle(self, msg):
+        if (msg['event_type'] == BANDWIDTH_EVENT and
+                self._bandwidth_interval > 0):
+            self._bandwidth[msg['tenant_id']][msg['uuid']] = (
+                msg['timestamp'], msg['payload'])
+            return
+        LOG.debug('sending notification %r', msg)
+        try:
+            self.send(event_type=msg['event_type'], message=msg['payload'])
+        except Exception:
+            LOG.exception(_LE('could not publish notification'))
+
+    def _flush_bandwidth(self):
+        """Send the bandwidth samples collected since the last flush"""
+        dropped = self.dropped - self._reported_dropped
+        if dropped:
+            LOG.warning('dropped %d notifications because the '
+                        'notification queue was full', dropped)
+            self._reported_dropped += dropped
+
+        bandwidth, self._bandwidth = (
+            self._bandwidth, collections.defaultdict(dict))
+        for tenant_id, routers in sorted(bandwidth.items()):
+            router_ids = sorted(routers)
+            for i in range(0, len(router_ids), self._batch_size):
+                payload = {
+                    'tenant_id': tenant_id,
+                    'routers': [
+                        {'uuid': router_id,
+                         'timestamp': routers[router_id][0],
+                         'bandwidth': routers[router_id][1]}
+                        for router_id in router_ids[i:i + self._batch_size]
+                    ],
+                }
+                LOG.debug('sending bandwidth of %d routers of tenant %s',
+                          len(payload['routers']), tenant_id)
+                try:
+                    self.send(event_type=BANDWIDTH_BATCH_EVENT,
+                              message=payload)
+                except Exception:
+                    LOG.exception(_LE('could not publish notification'))
 
     def _send(self, ready):
         """Deliver notification messages from the in-process queue
@@ -230,15 +453,25 @@ class Publisher(Sender):
         # Tell the start() method that we have set up the AMQP
         # communication stuff and are ready to do some work.
         ready.set()
+        interval = self._bandwidth_interval
+        next_flush = time.time() + interval
         while True:
-            msg = self._q.get()
+            try:
+                if interval > 0:
+                    msg = self._q.get(
+                        timeout=max(next_flush - time.time(), 0))
+                else:
+                    msg = self._q.get()
+            except Queue.Empty:
+                msg = False
             if msg is None:
                 break
-            LOG.debug('sending notification %r', msg)
-            try:
-                self.send(event_type=msg['event_type'], message=msg['payload'])
-            except Exception:
-                LOG.exception(_LE('could not publish notification'))
+            if msg:
+                self._handle(msg)
+            if interval > 0 and time.time() >= next_flush:
+                self._flush_bandwidth()
+                next_flush = time.time() + interval
+        self._flush_bandwidth()
 
 
 class NoopPublisher(Publisher):
@@ -15,6 +15,7 @@ import astara.api.nova
 import astara.drivers
 import astara.main
 import astara.common.linux.interface
+import astara.common.metrics
 import astara.notifications
 import astara.coordination
 import astara.pez.manager
@@ -29,6 +30,7 @@ def list_opts():
          itertools.chain(
              astara.api.api_opts,
              astara.api.rug.RUG_API_OPTS,
+             astara.common.metrics.METRICS_OPTS,
              astara.api.nova.OPTIONS,
              astara.api.neutron.neutron_opts,
              astara.api.astara_client.AK_CLIENT_OPTS,
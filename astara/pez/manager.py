@@ -27,7 +27,26 @@ CONF = cfg.CONF
 PEZ_OPTIONS = [
     cfg.IntOpt('pool_size', default=1,
                help=_('How many pre-allocated hot standby nodes to keep '
-                      'in the pez pool.')),
+                      'in the pez pool. When max_pool_size is larger, this '
+                      'is the smallest size of the pool.')),
+    cfg.IntOpt('max_pool_size', default=0,
+               help=_('The largest size of a pez pool sized from demand. '
+                      'Each pool holds about as many nodes as are reserved '
+                      'in the time it takes to boot a new one, between '
+                      'pool_size and max_pool_size. Set to 0 to keep pools '
+                      'at pool_size.')),
+    cfg.IntOpt('pool_demand_window', default=900,
+               help=_('The number of seconds of reservations used to '
+                      'measure the demand for a pez pool.')),
+    cfg.IntOpt('launch_concurrency', default=4,
+               help=_('How many pez nodes are booted at the same time when '
+                      'a pool is replenished.')),
+    cfg.ListOpt('preplugged_networks', default=[],
+                help=_('IDs of networks, such as the external network, that '
+                       'pez nodes are booted with a placeholder port on. A '
+                       'reserved node is given its port on these networks '
+                       'by renaming the placeholder instead of hotplugging '
+                       'a new port.')),
 
     # NOTE(adam_g): We should consider how these get configured for when
     #               we support multiple drivers. {router, lbaas}_image_uuid?
@@ -58,7 +77,11 @@ class PezManager(object):
             self.image_uuid,
             self.flavor,
             self.pool_size,
-            self.mgt_net_id)
+            self.mgt_net_id,
+            max_pool_size=CONF.pez.max_pool_size,
+            demand_window=CONF.pez.pool_demand_window,
+            launch_concurrency=CONF.pez.launch_concurrency,
+            preplugged_networks=CONF.pez.preplugged_networks)
 
     def start(self):
         pooler_thread = threading.Thread(target=self.pool_mgr.start)
@@ -14,13 +14,17 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import collections
 import copy
+import math
+import threading
 import time
 
-from six.moves import range
+from six.moves import queue as Queue
 from oslo_concurrency import lockutils
 from oslo_config import cfg
 from oslo_log import log as logging
+from oslo_utils import excutils
 from oslo_utils import timeutils
 
 from astara.common.i18n import _LE, _LI
@@ -45,11 +49,168 @@ DELETING = 'deleting'
 
 PEZ_LOCK = 'astara-pez'
 
+# Weight of the newest sample in the moving average of the time taken
+# to replenish a pool.
+REPLENISH_SMOOTHING = 0.3
+
+# The management ports of free instances are named after this fake UUID
+# so astara-neutron's name matching still catches them as astara ports.
+# This can be avoided if we use a mgt security group in the future.
+FREE_PORT_OWNER = '00000000-0000-0000-0000-000000000000'
+
+# The name of the placeholder ports free instances are booted with.
+PLACEHOLDER_PORT = 'ASTARA:VRRP:%s' % FREE_PORT_OWNER
+
 
 class PezPoolExhausted(Exception):
     pass
 
 
+def _status(server):
+    return (server.status or '').lower()
+
+
+class PezInventory(object):
+    """The free instances of each pool, as of the last listing of nova.
+
+    The pool manager's main loop refreshes the inventory, and reservations
+    are taken from it without asking nova. Instances that have finished
+    booting are handed out before those still booting.
+
+    Instances that are reserved or deleted are remembered until a listing
+    no longer shows them as free, so a listing that raced with a
+    reservation cannot offer the same instance twice.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        # resource name -> ordered instance id -> server
+        self._ready = {}
+        self._booting = {}
+        self._claimed = set()
+        self.loaded = False
+
+    def update(self, pools):
+        """Replace the inventory with the contents of pools.
+
+        :param pools: a dict keyed by driver name, each value a list of the
+                      nova servers named as free instances of that driver.
+        """
+        ready = {}
+        booting = {}
+        listed = set()
+        with self._lock:
+            for resource, pool in pools.items():
+                ready[resource] = collections.OrderedDict()
+                booting[resource] = collections.OrderedDict()
+                for server in pool:
+                    if server is None:
+                        continue
+                    listed.add(server.id)
+                    if server.id in self._claimed:
+                        continue
+                    status = _status(server)
+                    if status == ACTIVE:
+                        ready[resource][server.id] = server
+                    elif status not in (ERROR, DELETING):
+                        booting[resource][server.id] = server
+            self._claimed &= listed
+            self._ready = ready
+            self._booting = booting
+            self.loaded = True
+
+    def reserve(self, resource):
+        """Take a free instance out of the inventory.
+
+        :returns: the nova server, or None if the pool is empty.
+        """
+        with self._lock:
+            for index in (self._ready, self._booting):
+                free = index.get(resource)
+                if free:
+                    server_id, server = free.popitem(last=False)
+                    self._claimed.add(server_id)
+                    return server
+        return None
+
+    def release(self, server_id):
+        """Forget a failed reservation, so the instance is offered again
+        once the next listing shows it as free.
+        """
+        with self._lock:
+            self._claimed.discard(server_id)
+
+    def remove(self, server_id):
+        """Stop offering an instance that is being deleted."""
+        with self._lock:
+            self._claimed.add(server_id)
+            for index in (self._ready, self._booting):
+                for free in index.values():
+                    free.pop(server_id, None)
+
+    def count(self, resource):
+        """Return the number of ready and booting free instances."""
+        with self._lock:
+            return (len(self._ready.get(resource, ())) +
+                    len(self._booting.get(resource, ())))
+
+    def is_ready(self, resource, server_id):
+        with self._lock:
+            return server_id in self._ready.get(resource, ())
+
+
+class PoolSizer(object):
+    """Sizes a pool from the demand observed for it.
+
+    Reservations keep arriving while a replacement instance boots, so the
+    pool needs about (reservation rate * replenish time) free instances to
+    not run dry. The rate is measured over a sliding window and the
+    replenish time is a moving average of how long new instances took to
+    become ready. The size is kept between min_size and max_size.
+    """
+    def __init__(self, min_size, max_size, window, replenish_time):
+        """
+        :param min_size: The smallest size of the pool.
+        :param max_size: The largest size of the pool. The pool is kept at
+                         min_size if this is not larger.
+        :param window: Seconds of reservations the rate is measured over.
+        :param replenish_time: Initial estimate, in seconds, of the time
+                               taken by a new instance to become ready.
+        """
+        self.min_size = min_size
+        self.max_size = max(max_size, min_size)
+        self.window = max(window, 1)
+        self.replenish_time = float(replenish_time)
+        self._lock = threading.Lock()
+        self._reservations = collections.deque()
+
+    def reserved(self, now=None):
+        """Record a request for an instance of the pool."""
+        with self._lock:
+            self._reservations.append(now or time.time())
+
+    def replenished(self, seconds):
+        """Record the time a new instance took to become ready."""
+        with self._lock:
+            self.replenish_time += (
+                REPLENISH_SMOOTHING * (seconds - self.replenish_time))
+
+    def rate(self, now=None):
+        """Return the reservations per second over the window."""
+        now = now or time.time()
+        with self._lock:
+            while (self._reservations and
+                   self._reservations[0] <= now - self.window):
+                self._reservations.popleft()
+            return len(self._reservations) / float(self.window)
+
+    def target(self, now=None):
+        """Return the number of free instances the pool should hold."""
+        if self.max_size <= self.min_size:
+            return self.min_size
+        demand = int(math.ceil(self.rate(now) * self.replenish_time))
+        return max(self.min_size, min(self.max_size, demand))
+
+
 class WorkerContext(object):
     """Holds resources owned by the worker and used by the Automaton.
     """
@@ -72,9 +233,11 @@ class PezPoolManager(object):
     image), they will be deleted from the pool and the manager will replenish
     the deficit on its next tick.
 
-    Instances may be reserved for use via the get_instance() method. This
-    simply renames the instance according to the ID of the thing that it will
-    host and returns it to the caller. At this point, Pez no longer cares about
+    The free instances found by the main loop are kept in a PezInventory.
+    Instances may be reserved for use via the get_instance() method, which
+    takes one from the inventory without listing nova. This simply renames
+    the instance according to the ID of the thing that it will host and
+    returns it to the caller. At this point, Pez no longer cares about
     the instance and will refill its position in the pool on next its next
     tick.
 
@@ -82,20 +245,42 @@ class PezPoolManager(object):
     returned instance.  This includes attaching required ports, ensuring
     deletion/cleanup, etc. The instance will not be returned to the pool when
     it is no longer in use.
+
+    When max_pool_size is larger than pool_size, the size of each driver's
+    pool follows the demand measured by a PoolSizer. Deficits are filled by
+    creating all of the management ports with one Neutron call and booting
+    up to launch_concurrency instances at a time.
+
+    Free instances can also be booted with a placeholder port on each of
+    the preplugged_networks. A reservation asking for a port on one of
+    those networks is given the placeholder instead, renamed after the
+    requested port, so the port does not have to be hotplugged.
     """
-    def __init__(self, image_uuid, flavor, pool_size, mgt_net_id):
+    def __init__(self, image_uuid, flavor, pool_size, mgt_net_id,
+                 max_pool_size=0, demand_window=900, launch_concurrency=1,
+                 preplugged_networks=()):
         """
         :param image_uuid: UUID of backing image for managed instances.
         :param flavor: nova flavor id to be used for managed instances.
         :param mgt_net_id: UUID of management network. Each instance in the
                            pool is initially booted with a single port on this
                            network
-        :param pool_size: The size of the pool
+        :param pool_size: The size of the pool, or its smallest size when it
+                          adapts to demand.
+        :param max_pool_size: The largest size of a pool adapting to demand.
+        :param demand_window: Seconds of reservations used to measure demand.
+        :param launch_concurrency: How many instances are booted at a time.
+        :param preplugged_networks: IDs of the networks free instances get a
+                                    placeholder port on.
         """
         self.image_uuid = image_uuid
         self.flavor = flavor
         self.mgt_net_id = mgt_net_id
         self.pool_size = int(pool_size)
+        self.max_pool_size = int(max_pool_size)
+        self.demand_window = int(demand_window)
+        self.launch_concurrency = max(int(launch_concurrency), 1)
+        self.preplugged_networks = list(preplugged_networks)
         self.poll_interval = 3
         self.ctxt = WorkerContext()
         self.boot_timeout = 120
@@ -104,6 +289,13 @@ class PezPoolManager(object):
         # used to track boot/delete timeouts
         self._delete_counters = {}
         self._boot_counters = {}
+        self.inventory = PezInventory()
+        # driver name -> PoolSizer
+        self.sizers = {}
+        # id -> (driver name, launch time) of instances not yet ready
+        self._launches = {}
+        # the clients used by each launching thread
+        self._launch_contexts = []
         self.load_driver_config()
 
     def load_driver_config(self):
@@ -115,10 +307,15 @@ class PezPoolManager(object):
                 cfg.CONF, driver.RESOURCE_NAME).image_uuid
             self.flavors[driver.RESOURCE_NAME] = getattr(
                 cfg.CONF, driver.RESOURCE_NAME).instance_flavor
+            if driver.RESOURCE_NAME not in self.sizers:
+                self.sizers[driver.RESOURCE_NAME] = PoolSizer(
+                    self.pool_size, self.max_pool_size, self.demand_window,
+                    self.boot_timeout)
 
     @lockutils.synchronized(PEZ_LOCK)
     def delete_instance(self, instance_uuid):
         LOG.info(_LI('Deleting instance %s.'), instance_uuid)
+        self.inventory.remove(instance_uuid)
         self.ctxt.nova_client.client.servers.delete(instance_uuid)
         self._delete_counters[instance_uuid] = timeutils.utcnow()
 
@@ -212,6 +409,9 @@ class PezPoolManager(object):
         flavor does not match whats configured) will be deleted and replenished
         on the next tick of hte main loop.
 
+        The instances that remain usable replace the contents of the
+        inventory that get_instance() reserves from.
+
         :returns: a dict keyed by driver name, each value a list of nova server
                   objects that represents the current resources pool.
         """
@@ -219,29 +419,89 @@ class PezPoolManager(object):
         self._check_err_instances(pools)
         self._check_del_instances(pools)
         self._check_outdated_instances(pools)
+        self.inventory.update(pools)
+        self._check_launched_instances()
         return pools
 
+    def _check_launched_instances(self):
+        """Measures how long new instances took to become ready"""
+        now = time.time()
+        for server_id, (resource, launched) in list(self._launches.items()):
+            if self.inventory.is_ready(resource, server_id):
+                self.sizers[resource].replenished(now - launched)
+                del self._launches[server_id]
+            elif now - launched > self.boot_timeout:
+                # It failed to boot or was reserved before it was ready.
+                del self._launches[server_id]
+
     def launch_instances(self, count, driver):
+        if count < 1:
+            return
         LOG.info(_LI(
             'Launching %s %s instances.'), driver.RESOURCE_NAME, count)
-        for i in range(0, count):
-            # NOTE: Use a fake UUID so astara-neutron's name matching still
-            # catches this port as an astara port. This can be avoided if
-            # we use a mgt security group in the future.
-            mgt_port = self.ctxt.neutron_client.create_management_port(
-                '00000000-0000-0000-0000-000000000000')
-            nics = [{
-                'net-id': mgt_port.network_id,
-                'v4-fixed-ip': '',
-                'port-id': mgt_port.id}]
-
-            instance_name = INSTANCE_FREE % {
-                'resource_name': driver.RESOURCE_NAME
-            }
-            image = self.images[driver.RESOURCE_NAME]
-            flavor = self.flavors[driver.RESOURCE_NAME]
-
-            self.ctxt.nova_client.client.servers.create(
+        mgt_ports = self.ctxt.neutron_client.create_management_ports(
+            FREE_PORT_OWNER, count)
+        placeholders = [
+            self.ctxt.neutron_client.create_vrrp_ports(
+                FREE_PORT_OWNER, network_id, len(mgt_ports))
+            for network_id in self.preplugged_networks
+        ]
+
+        pending = Queue.Queue()
+        for i, mgt_port in enumerate(mgt_ports):
+            pending.put((mgt_port, [ports[i] for ports in placeholders]))
+
+        def _launch(ctxt):
+            while True:
+                try:
+                    mgt_port, placeholder_ports = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    self._launch_instance(
+                        ctxt, driver, mgt_port, placeholder_ports)
+                except Exception:
+                    LOG.exception(_LE(
+                        'Could not launch %s instance with management '
+                        'port %s.'), driver.RESOURCE_NAME, mgt_port.id)
+
+        threads = [
+            threading.Thread(target=_launch, args=(ctxt,),
+                             name='PezLaunch%02d' % i)
+            for i, ctxt in enumerate(
+                self._get_launch_contexts(len(mgt_ports)))
+        ]
+        for t in threads:
+            t.setDaemon(True)
+            t.start()
+        for t in threads:
+            t.join()
+
+    def _get_launch_contexts(self, count):
+        """Returns a client context for each of the launching threads.
+
+        The clients are not thread-safe, so each thread gets its own. They
+        are kept between launches to reuse their sessions.
+        """
+        count = min(count, self.launch_concurrency)
+        while len(self._launch_contexts) < count:
+            self._launch_contexts.append(WorkerContext())
+        return self._launch_contexts[:count]
+
+    def _launch_instance(self, ctxt, driver, mgt_port, placeholder_ports=()):
+        nics = [{
+            'net-id': p.network_id,
+            'v4-fixed-ip': '',
+            'port-id': p.id} for p in [mgt_port] + list(placeholder_ports)]
+
+        instance_name = INSTANCE_FREE % {
+            'resource_name': driver.RESOURCE_NAME
+        }
+        image = self.images[driver.RESOURCE_NAME]
+        flavor = self.flavors[driver.RESOURCE_NAME]
+
+        try:
+            server = ctxt.nova_client.client.servers.create(
                 name=instance_name,
                 image=image,
                 flavor=flavor,
@@ -249,15 +509,21 @@ class PezPoolManager(object):
                 config_drive=True,
                 userdata=nova.format_userdata(mgt_port),
             )
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                for nic in nics:
+                    ctxt.neutron_client.api_client.delete_port(nic['port-id'])
+        self._launches[server.id] = (driver.RESOURCE_NAME, time.time())
 
-    @lockutils.synchronized(PEZ_LOCK)
     def get_instance(self, resource_type, name, management_port=None,
                      instance_ports=None):
         """Get an instance from the pool.
 
         This involves popping it out of the pool, updating its name and
         attaching
-        any ports.
+        any ports. The instance is taken from the inventory kept by the main
+        loop, so concurrent reservations neither list nova nor wait for each
+        other.
 
         :param resource_type: The str driver name of the resource
         :param name: The requested name of the instance
@@ -272,24 +538,32 @@ class PezPoolManager(object):
         """
         instance_ports = instance_ports or []
 
-        try:
-            server = self.unused_instances[resource_type][0]
-        except IndexError:
+        if resource_type in self.sizers:
+            self.sizers[resource_type].reserved()
+
+        if not self.inventory.loaded:
+            # The main loop has not listed the pool yet.
+            self.unused_instances
+
+        server = self.inventory.reserve(resource_type)
+        if server is None:
             raise PezPoolExhausted()
 
-        LOG.info(_LI('Renaming instance %s to %s'), server.name, name)
-        server = self.ctxt.nova_client.client.servers.update(
-            server, name=name)
+        try:
+            LOG.info(_LI('Renaming instance %s to %s'), server.name, name)
+            server = self.ctxt.nova_client.client.servers.update(
+                server, name=name)
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                self.inventory.release(server.id)
 
-        for port in instance_ports:
-            LOG.info(_LI('Attaching instance port %s to %s (%s)'),
-                     port['id'], server.name, server.id)
-            self.ctxt.nova_client.client.servers.interface_attach(
-                server=server, port_id=port['id'], net_id=None, fixed_ip=None)
+        self._plug_instance_ports(server, instance_ports)
 
         mgt_port, instance_ports = (
             self.ctxt.neutron_client.get_ports_for_instance(server.id)
         )
+        instance_ports = [p for p in instance_ports
+                          if p.name != PLACEHOLDER_PORT]
 
         return (
             self.ctxt.nova_client.client.servers.get(server.id),
@@ -297,28 +571,71 @@ class PezPoolManager(object):
             instance_ports,
         )
 
+    def _plug_instance_ports(self, server, instance_ports):
+        """Gives a reserved instance the ports requested for it.
+
+        A requested port on a network the instance has a placeholder port on
+        is deleted, and the placeholder is renamed after it. Other requested
+        ports are attached to the instance, and placeholders left unused are
+        deleted.
+        """
+        api_client = self.ctxt.neutron_client.api_client
+        placeholders = {}
+        if self.preplugged_networks:
+            mgt_port, plugged = (
+                self.ctxt.neutron_client.get_ports_for_instance(server.id))
+            for port in plugged:
+                if port.name == PLACEHOLDER_PORT:
+                    placeholders.setdefault(port.network_id, []).append(port)
+
+        for port in instance_ports:
+            free = placeholders.get(port['network_id'])
+            if free and port.get('name'):
+                placeholder = free.pop()
+                LOG.info(_LI('Using placeholder port %s of %s (%s) for %s'),
+                         placeholder.id, server.name, server.id, port['id'])
+                api_client.update_port(
+                    placeholder.id, {'port': {'name': port['name']}})
+                api_client.delete_port(port['id'])
+                continue
+            LOG.info(_LI('Attaching instance port %s to %s (%s)'),
+                     port['id'], server.name, server.id)
+            self.ctxt.nova_client.client.servers.interface_attach(
+                server=server, port_id=port['id'], net_id=None, fixed_ip=None)
+
+        for free in placeholders.values():
+            for placeholder in free:
+                LOG.info(_LI('Deleting unused placeholder port %s of %s'),
+                         placeholder.id, server.id)
+                api_client.delete_port(placeholder.id)
+
     def start(self):
         """The pool manager main loop.
 
-        The bulk of the algorithm exists in the 'unused_instances' property.
+        The bulk of the algorithm exists in the 'unused_instances' property,
+        which also refreshes the inventory reservations are taken from.
         This main loop simply checks for a deficit in the pool and dispatches
-        a 'launch_instances' call when a deficit needs to be filled.
+        a 'launch_instances' call when a deficit needs to be filled. The size
+        each pool is filled to comes from its PoolSizer.
         """
         while True:
-            cur_pools = self.unused_instances
+            self.unused_instances
+            targets = dict(
+                (d.RESOURCE_NAME, self.sizers[d.RESOURCE_NAME].target())
+                for d in self.drivers)
             report = []
             for driver in self.drivers:
                 report.append(
                     '%s:%s/%s' %
                     (driver.RESOURCE_NAME,
-                     len(cur_pools[driver.RESOURCE_NAME]),
-                     self.pool_size))
+                     self.inventory.count(driver.RESOURCE_NAME),
+                     targets[driver.RESOURCE_NAME]))
             LOG.debug('Current pools: %s' % ' '.join(report))
 
             for driver in self.drivers:
-                cur_pool = cur_pools[driver.RESOURCE_NAME]
-                deficit = self.pool_size - len(cur_pool)
-                if deficit:
+                deficit = (targets[driver.RESOURCE_NAME] -
+                           self.inventory.count(driver.RESOURCE_NAME))
+                if deficit > 0:
                     LOG.info(_LI(
                         'Need to launch %s more %s instance(s).'),
                         deficit, driver.RESOURCE_NAME)
@@ -19,6 +19,7 @@
 """
 
 import threading
+import uuid
 
 from oslo_log import log as logging
 
@@ -36,6 +37,64 @@ def repopulate():
     return resources
 
 
+def add_rebalance_inventory(message):
+    """Attach the resource inventory to a cluster rebalance event.
+
+    The parent process fetches the inventory once and hands it to every
+    worker with the event, rather than each worker listing all of the
+    resources itself. If the inventory cannot be fetched the event is
+    returned unchanged and the workers fall back to their own listing.
+
+    :param message: event.Event with a REBALANCE crud
+    :returns: event.Event
+    """
+    if message.body.get('node_bootstrap') or 'resources' in message.body:
+        return message
+    try:
+        resources = repopulate()
+    except Exception:
+        LOG.exception('Could not fetch the resource inventory for the '
+                      'rebalance, workers will fetch their own')
+        return message
+    body = dict(message.body)
+    body['resources'] = resources
+    return event.Event(
+        resource=message.resource,
+        crud=message.crud,
+        body=body,
+    )
+
+
+def add_redistribute_inventory(message):
+    """Attach the resources of the moved tenants to a redistribute event.
+
+    As for rebalances, the scheduler fetches the inventory once for all of
+    the workers. If it cannot be fetched the event is returned unchanged
+    and the workers fall back to their own listing.
+
+    :param message: event.Event with a REDISTRIBUTE crud, whose body lists
+                    the tenants that moved
+    :returns: event.Event
+    """
+    if 'resources' in message.body:
+        return message
+    tenants = set(message.body.get('tenants', []))
+    try:
+        resources = [r for r in repopulate()
+                     if str(uuid.UUID(r.tenant_id)) in tenants]
+    except Exception:
+        LOG.exception('Could not fetch the resource inventory for the '
+                      'redistribution, workers will fetch their own')
+        return message
+    body = dict(message.body)
+    body['resources'] = resources
+    return event.Event(
+        resource=message.resource,
+        crud=message.crud,
+        body=body,
+    )
+
+
 def _pre_populate_workers(scheduler):
     """Loops through enabled drivers triggering each drivers pre_populate_hook
     which is a static method for each driver.
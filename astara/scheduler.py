@@ -17,17 +17,26 @@
 
 """Scheduler to send messages for a given router to the correct worker.
 """
+import collections
+import itertools
 import six
 import multiprocessing
+import threading
+import time
 import uuid
 
+from six.moves import cPickle as pickle
+from six.moves import queue as Queue
 from six.moves import range
 from oslo_config import cfg
 from oslo_log import log as logging
 
 from astara import commands
 from astara.common.i18n import _, _LE, _LI, _LW
+from astara.common import hash_ring
 from astara import daemon
+from astara import event
+from astara import populate
 
 
 LOG = logging.getLogger(__name__)
@@ -36,9 +45,37 @@ SCHEDULER_OPTS = [
     cfg.IntOpt('num_worker_processes',
                default=16,
                help='the number of worker processes to run'),
+    cfg.IntOpt('scheduler_batch_size',
+               default=64,
+               help=('the maximum number of queued notifications the '
+                     'scheduler sends to a worker process in one batch')),
+    cfg.IntOpt('worker_split_queue_depth',
+               default=100,
+               help=('when this many batches are waiting for a worker '
+                     'process, the tenant sending it the most messages has '
+                     'its resources spread across all of the worker '
+                     'processes; 0 always keeps a tenant on one process')),
 ]
 CONF.register_opts(SCHEDULER_OPTS)
 
+# How often, in seconds, split tenants are checked for merging back onto
+# their home worker.
+SPLIT_CHECK_INTERVAL = 60
+
+# How long, in seconds, a tenant's messages are held for the workers to
+# release its state machines before it is handed over anyway.
+HANDOVER_TIMEOUT = 600
+
+
+def _is_workers_debug(message):
+    return (getattr(message, 'crud', None) == event.COMMAND and
+            isinstance(message.body, dict) and
+            message.body.get('command') == commands.WORKERS_DEBUG)
+
+
+def _encode(target, message):
+    return pickle.dumps((target, message), pickle.HIGHEST_PROTOCOL)
+
 
 def _worker(inq, worker_factory, scheduler, proc_name):
     """Scheduler's worker process main function.
@@ -48,36 +85,90 @@ def _worker(inq, worker_factory, scheduler, proc_name):
     worker = worker_factory(scheduler=scheduler, proc_name=proc_name)
     while True:
         try:
-            data = inq.get()
+            batch = inq.get()
         except IOError:
             # NOTE(dhellmann): Likely caused by a signal arriving
             # during processing, especially SIGCHLD.
-            data = None
-        if data is None:
-            target, message = None, None
-        else:
-            target, message = data
-        try:
-            worker.handle_message(target, message)
-        except Exception:
-            LOG.exception(_LE('Error processing data %s'), six.text_type(data))
-        if data is None:
-            break
-    LOG.debug('exiting')
+            batch = None
+        if batch is None:
+            # Poison pill from the scheduler, or a failed read.
+            batch = [None]
+        for data in batch:
+            if data is None:
+                target, message = None, None
+            else:
+                target, message = pickle.loads(data)
+            try:
+                worker.handle_message(target, message)
+            except Exception:
+                LOG.exception(_LE('Error processing data %s'),
+                              six.text_type((target, message)))
+            if data is None:
+                LOG.debug('exiting')
+                return
 
 
 class Dispatcher(object):
     """Choose one of the workers to receive a message.
 
-    The current implementation uses the least significant bits of the
-    UUID as an integer to shard across the worker pool.
+    Tenants are placed on the worker processes with a consistent hash
+    ring, so all of a tenant's resources are normally handled by the same
+    process and changing the number of processes only moves the tenants
+    whose part of the ring changed hands. The resources of tenants that
+    have been split are placed on the ring by resource id instead, to
+    spread a busy tenant across the whole pool.
     """
 
     def __init__(self, workers):
         self.workers = workers
+        self._by_name = dict((w['worker'].name, w) for w in workers)
+        self._ring = hash_ring.HashRing(sorted(self._by_name))
+        self.split_tenants = set()
+
+    @staticmethod
+    def _normalize(target):
+        return str(uuid.UUID(target))
 
-    def pick_workers(self, target):
+    def is_split(self, tenant_id):
+        """Returns True if the tenant's resources are spread by resource id.
+        """
+        try:
+            return self._normalize(tenant_id) in self.split_tenants
+        except (TypeError, ValueError):
+            return False
+
+    def split_tenant(self, tenant_id):
+        """Spread a tenant's resources across all of the workers.
+
+        :returns: True if the tenant was not already split.
+        """
+        tenant_id = self._normalize(tenant_id)
+        if tenant_id in self.split_tenants:
+            return False
+        self.split_tenants.add(tenant_id)
+        return True
+
+    def merge_tenant(self, tenant_id):
+        """Place a split tenant's resources back on its home worker.
+
+        :returns: True if the tenant was split.
+        """
+        tenant_id = self._normalize(tenant_id)
+        if tenant_id not in self.split_tenants:
+            return False
+        self.split_tenants.discard(tenant_id)
+        return True
+
+    def set_split_tenants(self, tenant_ids):
+        """Replace the set of split tenants with the scheduler's."""
+        self.split_tenants = set(self._normalize(t) for t in tenant_ids)
+
+    def pick_workers(self, target, resource_id=None):
         """Returns the workers that match the target.
+
+        :param target: The tenant id, or a wildcard.
+        :param resource_id: The resource the message is about, if known.
+                            Only used for tenants that have been split.
         """
         target = target.strip() if target else None
         # If we get any wildcard target, send the message to all of
@@ -85,16 +176,18 @@ class Dispatcher(object):
         if target in commands.WILDCARDS:
             return self.workers[:]
         try:
-            idx = uuid.UUID(target).int % len(self.workers)
+            key = self._normalize(target)
         except (TypeError, ValueError) as e:
             LOG.warning(_LW(
                 'Could not determine UUID from %r: %s, ignoring message'),
                 target, e,
             )
             return []
-        else:
-            LOG.debug('target %s maps to worker %s', target, idx)
-        return [self.workers[idx]]
+        if resource_id and key in self.split_tenants:
+            key = resource_id
+        name = self._ring.get_hosts(key)[0]
+        LOG.debug('target %s maps to worker %s', key, name)
+        return [self._by_name[name]]
 
 
 class Scheduler(object):
@@ -134,6 +227,25 @@ class Scheduler(object):
                 'worker': worker,
             })
         self.dispatcher = Dispatcher(self.workers)
+        self._stats_lock = threading.Lock()
+        self._stats = {'messages': 0, 'batches': 0, 'bytes': 0}
+        # Messages sent to each worker, by tenant, since its queue was
+        # last seen to be short.
+        self._tenant_load = dict(
+            (w['worker'].name, collections.Counter()) for w in self.workers)
+        # Messages sent for each split tenant since SPLIT_CHECK_INTERVAL
+        # last passed.
+        self._split_load = collections.Counter()
+        self._split_checked = time.time()
+        # Workers acknowledge handovers on this queue once they released
+        # the state machines they no longer own.
+        self._handover_acks = multiprocessing.Queue()
+        self._handover_ids = itertools.count(1)
+        # handover id -> dict of the tenant being split or merged, the
+        # workers yet to acknowledge and the messages held meanwhile
+        self._handovers = {}
+        # tenant id -> handover id
+        self._handing_over = {}
         for w in self.workers:
             w['worker'].start()
 
@@ -162,5 +274,239 @@ class Scheduler(object):
         :param message: Dictionary full of data to send to the target.
         :type message: dict
         """
-        for w in self.dispatcher.pick_workers(target):
-            w['queue'].put((target, message))
+        self.handle_messages([(target, message)])
+
+    def handle_messages(self, messages):
+        """Distribute several notification messages at once.
+
+        Each message is serialized a single time, even when it goes to
+        every worker, and each worker receives all of its messages in one
+        queue operation.
+
+        :param messages: (target, message) pairs, as for handle_message().
+        :type messages: list
+        """
+        self._finish_handovers()
+        batches = {}
+        nbytes = 0
+        for target, message in messages:
+            if _is_workers_debug(message):
+                self.report_status()
+            if self._handing_over or self.dispatcher.split_tenants:
+                tenant_id = self._tenant_key(target)
+                if tenant_id in self._handing_over:
+                    # Hold the message until the workers have released
+                    # the tenant's state machines.
+                    hid = self._handing_over[tenant_id]
+                    self._handovers[hid]['held'].append((target, message))
+                    continue
+                if tenant_id in self.dispatcher.split_tenants:
+                    self._split_load[tenant_id] += 1
+            resource_id = getattr(
+                getattr(message, 'resource', None), 'id', None)
+            workers = self.dispatcher.pick_workers(target, resource_id)
+            if not workers:
+                continue
+            data = _encode(target, message)
+            for w in workers:
+                batches.setdefault(id(w), (w, []))[1].append(data)
+                nbytes += len(data)
+            if len(workers) == 1:
+                self._tenant_load[workers[0]['worker'].name][target] += 1
+        for w, batch in batches.values():
+            w['queue'].put(batch)
+        with self._stats_lock:
+            self._stats['messages'] += len(messages)
+            self._stats['batches'] += len(batches)
+            self._stats['bytes'] += nbytes
+        self._split_hot_tenants([w for w, batch in batches.values()])
+        self._merge_cool_tenants()
+
+    def forward(self, worker, target, message):
+        """Send a message straight to one worker, bypassing the dispatcher.
+
+        Used by worker processes to pass on messages that the dispatcher
+        could not place precisely because they had no resource id.
+        """
+        worker['queue'].put([_encode(target, message)])
+
+    def handover_done(self, handover, worker_name):
+        """Acknowledge a handover, from a worker process.
+
+        Called once the worker has released the state machines that no
+        longer belong to it, and finished the updates they had under way.
+        """
+        self._handover_acks.put((handover, worker_name))
+
+    def _tenant_key(self, target):
+        try:
+            return self.dispatcher._normalize(target)
+        except (TypeError, ValueError):
+            return None
+
+    def _broadcast(self, message):
+        data = _encode('*', message)
+        for w in self.workers:
+            w['queue'].put([data])
+
+    def _start_handover(self, tenant_id, split):
+        """Move a tenant's resources between the workers.
+
+        Every worker is first told the new placement and asked to release
+        the tenant's state machines it no longer owns. The tenant's
+        messages are held meanwhile, so no two workers ever manage the
+        same resource, and dispatched with the new placement once all of
+        the workers have acknowledged.
+
+        :param split: True to spread the tenant across the workers, False
+                      to merge it back onto its home worker.
+        """
+        split_tenants = set(self.dispatcher.split_tenants)
+        if split:
+            split_tenants.add(tenant_id)
+        else:
+            split_tenants.discard(tenant_id)
+        hid = next(self._handover_ids)
+        self._handovers[hid] = {
+            'tenant_id': tenant_id,
+            'split': split,
+            'waiting': set(w['worker'].name for w in self.workers),
+            'held': [],
+            'started': time.time(),
+        }
+        self._handing_over[tenant_id] = hid
+        self._broadcast(event.Event(
+            resource=event.Resource(driver='*', id='*', tenant_id='*'),
+            crud=event.REDISTRIBUTE,
+            body={'split_tenants': sorted(split_tenants),
+                  'tenants': [tenant_id],
+                  'handover': hid},
+        ))
+
+    def _finish_handovers(self):
+        """Complete the handovers all of the workers acknowledged."""
+        if not self._handovers:
+            return
+        while True:
+            try:
+                hid, name = self._handover_acks.get_nowait()
+            except Queue.Empty:
+                break
+            if hid in self._handovers:
+                self._handovers[hid]['waiting'].discard(name)
+
+        now = time.time()
+        finished = []
+        for hid, handover in sorted(self._handovers.items()):
+            if handover['waiting']:
+                if now - handover['started'] < HANDOVER_TIMEOUT:
+                    continue
+                LOG.warning(_LW('%s did not release tenant %s in time, '
+                                'handing it over anyway'),
+                            ', '.join(sorted(handover['waiting'])),
+                            handover['tenant_id'])
+            del self._handovers[hid]
+            del self._handing_over[handover['tenant_id']]
+            finished.append(handover)
+
+        for handover in finished:
+            tenant_id = handover['tenant_id']
+            if handover['split']:
+                self.dispatcher.split_tenant(tenant_id)
+            else:
+                self.dispatcher.merge_tenant(tenant_id)
+            # Send one inventory of the tenant's resources, so the workers
+            # they moved to start managing them without each listing the
+            # resources of the whole cloud.
+            self._broadcast(populate.add_redistribute_inventory(event.Event(
+                resource=event.Resource(driver='*', id='*', tenant_id='*'),
+                crud=event.REDISTRIBUTE,
+                body={'split_tenants': sorted(self.dispatcher.split_tenants),
+                      'tenants': [tenant_id]},
+            )))
+            if handover['held']:
+                self.handle_messages(handover['held'])
+
+    def _split_hot_tenants(self, workers):
+        """Split the busiest tenant of any worker that is falling behind.
+        """
+        threshold = cfg.CONF.worker_split_queue_depth
+        if threshold <= 0 or len(self.workers) < 2:
+            return
+        for w in workers:
+            load = self._tenant_load[w['worker'].name]
+            if not load:
+                continue
+            try:
+                depth = w['queue'].qsize()
+            except NotImplementedError:
+                return
+            if depth < threshold:
+                load.clear()
+                continue
+            tenant_id = self._tenant_key(load.most_common(1)[0][0])
+            load.clear()
+            if (tenant_id is None or
+                    tenant_id in self.dispatcher.split_tenants or
+                    tenant_id in self._handing_over):
+                continue
+            LOG.info(_LI('%s has %d batches waiting, spreading tenant '
+                         '%s across all workers'),
+                     w['worker'].name, depth, tenant_id)
+            self._start_handover(tenant_id, split=True)
+
+    def _merge_cool_tenants(self):
+        """Merge split tenants whose load dropped back onto one worker.
+
+        A split tenant that sent fewer messages over the last
+        SPLIT_CHECK_INTERVAL than worker_split_queue_depth, while its home
+        worker's queue is under half of that depth, is merged back.
+        """
+        now = time.time()
+        if now - self._split_checked < SPLIT_CHECK_INTERVAL:
+            return
+        self._split_checked = now
+        load, self._split_load = self._split_load, collections.Counter()
+        threshold = cfg.CONF.worker_split_queue_depth
+        for tenant_id in sorted(self.dispatcher.split_tenants):
+            if tenant_id in self._handing_over:
+                continue
+            home = self.dispatcher.pick_workers(tenant_id)[0]
+            try:
+                depth = home['queue'].qsize()
+            except NotImplementedError:
+                return
+            if (threshold <= 0 or
+                    (load[tenant_id] < threshold and depth * 2 < threshold)):
+                LOG.info(_LI('tenant %s is no longer busy, merging it back '
+                             'onto %s'), tenant_id, home['worker'].name)
+                self._start_handover(tenant_id, split=False)
+
+    def queue_depths(self):
+        """Return the number of batches waiting for each worker process.
+
+        :returns: dict mapping worker name to depth, or None when the
+                  platform cannot report the size of a queue.
+        """
+        depths = {}
+        for w in self.workers:
+            try:
+                depths[w['worker'].name] = w['queue'].qsize()
+            except NotImplementedError:
+                depths[w['worker'].name] = None
+        return depths
+
+    def stats(self):
+        """Return counters describing the traffic sent to the workers."""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['queue_depths'] = self.queue_depths()
+        return stats
+
+    def report_status(self):
+        stats = self.stats()
+        LOG.info(_LI(
+            'Scheduler sent %(messages)d messages to the workers in '
+            '%(batches)d batches (%(bytes)d bytes)'), stats)
+        for name, depth in sorted(stats['queue_depths'].items()):
+            LOG.info(_LI('Worker %s has %s batches waiting'), name, depth)
@@ -23,15 +23,144 @@
 # http://akanda.readthedocs.org/en/latest/rug.html#state-machine-workers-and-router-lifecycle
 
 import collections
-import itertools
+import threading
 
 from astara.common.i18n import _LE, _LI, _LW
+from astara.common import metrics
 from astara.event import (POLL, CREATE, READ, UPDATE, DELETE, REBUILD,
                           CLUSTER_REBUILD)
 from astara import instance_manager
 from astara.drivers import states
 
 
+# Lanes of the state machine inbox, most urgent first. Actions without a
+# lane of their own are kept after READ, in the order they first arrive.
+INBOX_LANES = (DELETE, REBUILD, CLUSTER_REBUILD, CREATE, UPDATE, READ, POLL)
+
+# The actions consumed from the inbox when collapsing pending events into
+# the given action. Every action implies a POLL, REBUILD implies creating
+# and updating the instance, and CREATE implies an UPDATE.
+ABSORBED_ACTIONS = {
+    REBUILD: (REBUILD, CLUSTER_REBUILD, CREATE, UPDATE, POLL),
+    CLUSTER_REBUILD: (CLUSTER_REBUILD, POLL),
+    CREATE: (CREATE, UPDATE, POLL),
+    UPDATE: (UPDATE, POLL),
+    READ: (READ, POLL),
+    POLL: (POLL,),
+}
+
+
+class Inbox(object):
+    """Pending actions for a state machine, kept as counters per lane.
+
+    Repeated events of the same kind only bump a counter, so checking for,
+    collapsing and dropping pending actions does not depend on how many
+    events have piled up. Events are put by the worker's message thread
+    and taken by its worker threads, so the counters are guarded by a lock.
+    """
+
+    def __init__(self, actions=()):
+        self._lock = threading.Lock()
+        self._lanes = collections.OrderedDict(
+            (a, 0) for a in INBOX_LANES if a != POLL)
+        self._poll = 0
+        self._size = 0
+        for action in actions:
+            self.put(action)
+
+    def put(self, action):
+        with self._lock:
+            if action == POLL:
+                self._poll += 1
+            else:
+                self._lanes[action] = self._lanes.get(action, 0) + 1
+            self._size += 1
+
+    def _count(self, action):
+        if action == POLL:
+            return self._poll
+        return self._lanes.get(action, 0)
+
+    def count(self, action):
+        with self._lock:
+            return self._count(action)
+
+    def take(self, *actions):
+        """Remove all pending events of the given actions.
+
+        :returns: The number of events removed.
+        """
+        taken = 0
+        with self._lock:
+            for action in actions:
+                if action == POLL:
+                    taken += self._poll
+                    self._poll = 0
+                elif self._lanes.get(action):
+                    taken += self._lanes[action]
+                    self._lanes[action] = 0
+            self._size -= taken
+        return taken
+
+    def _pending(self):
+        """Returns (action, count) pairs of the pending actions."""
+        with self._lock:
+            pending = [(a, n) for a, n in self._lanes.items() if n]
+            if self._poll:
+                pending.append((POLL, self._poll))
+        return pending
+
+    def actions(self):
+        """Returns the pending actions, most urgent first."""
+        return [a for a, n in self._pending()]
+
+    def most_urgent(self):
+        pending = self._pending()
+        if pending:
+            return pending[0][0]
+        return None
+
+    def rank(self, action):
+        """Returns the position of an action's lane, lower is more urgent."""
+        with self._lock:
+            lanes = list(self._lanes)
+        if action == POLL:
+            return len(lanes)
+        try:
+            return lanes.index(action)
+        except ValueError:
+            return len(lanes)
+
+    def clear(self):
+        with self._lock:
+            for action in self._lanes:
+                self._lanes[action] = 0
+            self._poll = 0
+            self._size = 0
+
+    def __contains__(self, action):
+        return bool(self.count(action))
+
+    def __len__(self):
+        with self._lock:
+            return self._size
+
+    def __bool__(self):
+        with self._lock:
+            return self._size > 0
+
+    def __nonzero__(self):
+        return self.__bool__()
+
+    def __iter__(self):
+        for action, n in self._pending():
+            for i in range(n):
+                yield action
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, dict(self._pending()))
+
+
 class StateParams(object):
     def __init__(self, driver, instance, queue, bandwidth_callback,
                  reboot_error_threshold):
@@ -90,60 +219,31 @@ class CalcAction(State):
            CLUSTER_REBUILD not in queue):
             self.params.resource.log.debug(
                 'Scheduling a rebuild on degraded cluster')
-            queue.append(CLUSTER_REBUILD)
-
-        while queue:
-            self.params.resource.log.debug(
-                'action = %s, len(queue) = %s, queue = %s',
-                action,
-                len(queue),
-                list(itertools.islice(queue, 0, 60))
-            )
+            queue.put(CLUSTER_REBUILD)
 
-            if action == UPDATE and queue[0] == CREATE:
-                # upgrade to CREATE from UPDATE by taking the next
-                # item from the queue
-                self.params.resource.log.debug(
-                    'upgrading from update to create')
-                action = queue.popleft()
-                continue
-
-            elif (action in (CREATE, UPDATE, CLUSTER_REBUILD) and
-                  queue[0] == REBUILD):
-                # upgrade to REBUILD from CREATE/UPDATE by taking the next
-                # item from the queue
-                self.params.resource.log.debug('upgrading from %s to rebuild',
-                                               action)
-                action = queue.popleft()
-                continue
-
-            elif action == CREATE and queue[0] == UPDATE:
-                # CREATE implies an UPDATE so eat the update event
-                # without changing the action
-                self.params.resource.log.debug('merging create and update')
-                queue.popleft()
-                continue
-
-            elif action and queue[0] == POLL:
-                # Throw away a poll following any other valid action,
-                # because a create or update will automatically handle
-                # the poll and repeated polls are not needed.
-                self.params.resource.log.debug(
-                    'discarding poll event following action %s',
-                    action)
-                queue.popleft()
-                continue
-
-            elif action and action != POLL and action != queue[0]:
-                # We are not polling and the next action is something
-                # different from what we are doing, so just do the
-                # current action.
-                self.params.resource.log.debug('done collapsing events')
-                break
-
-            self.params.resource.log.debug('popping action from queue')
-            action = queue.popleft()
+        if not queue:
+            return action
 
+        self.params.resource.log.debug(
+            'action = %s, len(queue) = %s, queue = %r',
+            action, len(queue), queue)
+
+        # A POLL carried over from the last pass is implied by any
+        # pending action, so only carry over real work.
+        carried = action if action != POLL else None
+        action = queue.most_urgent()
+        if carried and queue.rank(carried) < queue.rank(action):
+            action = carried
+
+        absorbed = ABSORBED_ACTIONS.get(action, (action, POLL))
+        queue.take(*absorbed)
+        if carried and carried not in absorbed:
+            # The carried action is not implied by what we are about to
+            # do, so keep it around for the next pass.
+            queue.put(carried)
+
+        self.params.resource.log.debug('done collapsing events into %s',
+                                       action)
         return action
 
     def transition(self, action, worker_context):
@@ -188,8 +288,8 @@ class PushUpdate(State):
     """Put an update instruction on the queue for the state machine.
     """
     def execute(self, action, worker_context):
-        # Put the action back on the front of the queue.
-        self.queue.appendleft(UPDATE)
+        # Put an update back into the queue.
+        self.queue.put(UPDATE)
         return action
 
     def transition(self, action, worker_context):
@@ -268,12 +368,12 @@ class CheckBoot(State):
         self.instance.update_state(worker_context)
         self.params.resource.log.debug(
             'Instance is %s' % self.instance.state.upper())
-        # Put the action back on the front of the queue so that we can yield
-        # and handle it in another state machine traversal (which will proceed
+        # Put the action back into the queue so that we can yield and
+        # handle it in another state machine traversal (which will proceed
         # from CalcAction directly to CheckBoot).
         if self.instance.state not in (states.DOWN,
                                        states.GONE):
-            self.queue.appendleft(action)
+            self.queue.put(action)
         return action
 
     def transition(self, action, worker_context):
@@ -410,7 +510,7 @@ class Automaton(object):
         self._reboot_error_threshold = reboot_error_threshold
         self.deleted = False
         self.bandwidth_callback = bandwidth_callback
-        self._queue = collections.deque()
+        self._queue = Inbox()
 
         self.action = POLL
         self.instance = instance_manager.InstanceManager(self.resource,
@@ -443,6 +543,17 @@ class Automaton(object):
 
     def update(self, worker_context):
         "Called when the router config should be changed"
+        # Let the instance manager reuse what it learns about the
+        # instances for all of the actions taken during this call.
+        self.instance.begin_update_cycle()
+        try:
+            with metrics.timed('astara_update_duration_seconds',
+                               driver=self.resource.RESOURCE_NAME):
+                self._update(worker_context)
+        finally:
+            self.instance.end_update_cycle()
+
+    def _update(self, worker_context):
         while self._queue:
             while True:
                 if self.deleted:
@@ -457,10 +568,13 @@ class Automaton(object):
                         self.state,
                         self.action,
                         self.instance.state)
-                    self.action = self.state.execute(
-                        self.action,
-                        worker_context,
-                    )
+                    with metrics.timed('astara_state_duration_seconds',
+                                       driver=self.resource.RESOURCE_NAME,
+                                       state=self.state.__class__.__name__):
+                        self.action = self.state.execute(
+                            self.action,
+                            worker_context,
+                        )
                     self.resource.log.debug(
                         '%s.execute -> %s instance.state=%s',
                         self.state,
@@ -530,7 +644,7 @@ class Automaton(object):
             else:
                 self.image_uuid = self.resource.image_uuid
 
-        self._queue.append(message.crud)
+        self._queue.put(message.crud)
         queue_len = len(self._queue)
         if queue_len > self._queue_warning_threshold:
             logger = self.resource.log.warning
@@ -551,6 +665,10 @@ class Automaton(object):
         "Called to check if there are more messages in the state machine queue"
         return (not self.deleted) and bool(self._queue)
 
+    def pending_actions(self):
+        "Returns the distinct actions waiting in the queue"
+        return self._queue.actions()
+
     def has_error(self):
         return self.instance.state == states.ERROR
 
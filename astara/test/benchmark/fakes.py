@@ -0,0 +1,651 @@
+# Copyright (c) 2016 Akanda, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""In-process fakes of the services the orchestrator talks to.
+
+A FakeCloud holds the Neutron and Nova state of a synthetic fleet of
+tenant routers. It answers the calls the real Neutron and Nova wrappers
+make through their clients, and the HTTP requests of the appliance
+client, sleeping for a configurable latency on each call so the
+orchestrator code above them runs unchanged.
+
+Each worker process gets its own copy of the cloud when it is forked.
+That is enough because a router is managed by a single worker process
+at a time; the configuration pushes received by the fake appliances are
+reported back to the parent through a multiprocessing queue.
+"""
+
+import collections
+import datetime
+import functools
+import itertools
+import random
+import re
+import threading
+import time
+import uuid
+
+import mock
+import netaddr
+from novaclient import exceptions as novaclient_exceptions
+from oslo_serialization import jsonutils
+import requests
+from requests import adapters
+from six.moves.urllib import parse as urlparse
+
+from astara.api import astara_client
+from astara.api.config import delta
+from astara.api import neutron
+from astara.api import nova
+from astara.common import metrics
+
+
+NAMESPACE = uuid.UUID('2e7c3a58-61d4-4c0f-9d0b-6b8f1a4e9c21')
+
+MGT_NETWORK_ID = str(uuid.uuid5(NAMESPACE, 'management-network'))
+MGT_SUBNET_ID = str(uuid.uuid5(NAMESPACE, 'management-subnet'))
+MGT_CIDR = 'fdca:3ba5:a17a:acda::/64'
+# The orchestrator's own address on the management network.
+RUG_ADDRESS = 'fdca:3ba5:a17a:acda::1'
+EXT_NETWORK_ID = str(uuid.uuid5(NAMESPACE, 'external-network'))
+EXT_SUBNET_ID = str(uuid.uuid5(NAMESPACE, 'external-subnet'))
+EXT_CIDR = '172.16.0.0/12'
+FLOATING_CIDR = '198.18.0.0/15'
+
+
+def _uuid(*parts):
+    return str(uuid.uuid5(NAMESPACE, '-'.join(str(p) for p in parts)))
+
+
+class Latency(object):
+    """The simulated latency of the calls made to a service."""
+
+    def __init__(self, mean, jitter=0.0):
+        """
+        :param mean: The average latency, in seconds.
+        :param jitter: How far, as a fraction of the mean, a single call
+                       may be faster or slower than the mean.
+        """
+        self.mean = mean
+        self.jitter = jitter
+
+    def sample(self):
+        if self.mean <= 0:
+            return 0
+        spread = self.mean * self.jitter
+        return max(random.uniform(self.mean - spread, self.mean + spread), 0)
+
+
+class FakeServer(object):
+    """A nova server, which finishes booting boot_time seconds after it
+    is created.
+    """
+
+    def __init__(self, cloud, id, name, image, port_ids):
+        self.cloud = cloud
+        self.id = id
+        self.name = name
+        self.image = {'id': image}
+        self.port_ids = list(port_ids)
+        self.created = datetime.datetime.utcnow().strftime(
+            '%Y-%m-%dT%H:%M:%SZ')
+        self._ready_at = time.time() + cloud.boot_time
+        # the config its appliance runs
+        self.config = None
+
+    @property
+    def status(self):
+        if time.time() >= self._ready_at:
+            return 'ACTIVE'
+        return 'BUILD'
+
+    def interface_attach(self, port_id, net_id, fixed_ip):
+        self.cloud.call('nova', 'POST')
+        self.cloud.attach_port(self, port_id)
+
+    def interface_detach(self, port_id):
+        self.cloud.call('nova', 'DELETE')
+        self.cloud.detach_port(self, port_id)
+
+
+class FakeCloud(object):
+    """The Neutron and Nova state of a fleet of tenant routers.
+
+    Every tenant has routers_per_tenant routers. Each router has a
+    gateway on the shared external network, networks_per_router tenant
+    networks with ports_per_network instance ports on each, and a
+    floating IP. IDs and addresses are derived from the position of the
+    resource in the fleet, so forked copies of a cloud agree on them.
+    """
+
+    def __init__(self, tenants, routers_per_tenant=1, networks_per_router=1,
+                 ports_per_network=2, latencies=None, boot_time=0,
+                 results=None):
+        """
+        :param latencies: A dict mapping 'neutron', 'nova' and 'appliance'
+                          to the Latency of their calls.
+        :param boot_time: Seconds a new server takes to become reachable.
+        :param results: An optional queue on which a (router_id, started,
+                        finished) tuple is put for every configuration
+                        pushed to an appliance.
+        """
+        self.latencies = latencies or {}
+        self.boot_time = boot_time
+        self.results = results
+        self._lock = threading.Lock()
+        self._macs = itertools.count(1)
+        self._mgt_ips = itertools.count(2)
+        self._ext_ips = itertools.count(2)
+
+        self.networks = {}
+        self.subnets = {}
+        self.ports = {}
+        self.routers = collections.OrderedDict()
+        self.servers = collections.OrderedDict()
+        self.router_status = {}
+        self.tenant_ids = []
+        # port attribute -> value -> set of port ids
+        self._port_index = dict(
+            (k, collections.defaultdict(set))
+            for k in ('network_id', 'device_id', 'name'))
+        self._ports_by_mgt_ip = {}
+
+        self._build(tenants, routers_per_tenant, networks_per_router,
+                    ports_per_network)
+
+    def _build(self, tenants, routers_per_tenant, networks_per_router,
+               ports_per_network):
+        self._add_network(MGT_NETWORK_ID, 'mgt', '', MGT_SUBNET_ID,
+                          MGT_CIDR, ipv6_ra_mode='slaac')
+        self._add_network(EXT_NETWORK_ID, 'ext', '', EXT_SUBNET_ID, EXT_CIDR)
+        ext_net = netaddr.IPNetwork(EXT_CIDR)
+        floating_net = netaddr.IPNetwork(FLOATING_CIDR)
+        network_index = itertools.count()
+
+        for t in range(tenants):
+            tenant_id = uuid.UUID(_uuid('tenant', t)).hex
+            self.tenant_ids.append(tenant_id)
+            for r in range(routers_per_tenant):
+                router_id = _uuid('router', t, r)
+                gw_port = self._add_port(
+                    EXT_NETWORK_ID, '', tenant_id=tenant_id,
+                    device_id=router_id,
+                    device_owner=neutron.DEVICE_OWNER_ROUTER_GW,
+                    fixed_ips=[(EXT_SUBNET_ID,
+                                ext_net[next(self._ext_ips)])])
+                interface_ids = []
+                compute_ports = []
+                for n in range(networks_per_router):
+                    index = next(network_index)
+                    network_id = _uuid('network', t, r, n)
+                    subnet_id = _uuid('subnet', t, r, n)
+                    cidr = netaddr.IPNetwork('10.%d.%d.0/24' % (
+                        index // 256 % 256, index % 256))
+                    self._add_network(network_id, 'net-%d-%d-%d' % (t, r, n),
+                                      tenant_id, subnet_id, cidr)
+                    interface_ids.append(self._add_port(
+                        network_id, '', tenant_id=tenant_id,
+                        device_id=router_id,
+                        device_owner=neutron.DEVICE_OWNER_ROUTER_INT,
+                        fixed_ips=[(subnet_id, cidr[1])])['id'])
+                    for p in range(ports_per_network):
+                        compute_ports.append(self._add_port(
+                            network_id, '', tenant_id=tenant_id,
+                            device_id=_uuid('vm', t, r, n, p),
+                            device_owner='compute:None',
+                            fixed_ips=[(subnet_id, cidr[10 + p])]))
+                floatingips = []
+                if compute_ports:
+                    index = len(self.routers)
+                    floatingips.append({
+                        'id': _uuid('floatingip', t, r),
+                        'floating_ip_address': str(floating_net[index + 1]),
+                        'fixed_ip_address':
+                        compute_ports[0]['fixed_ips'][0]['ip_address'],
+                    })
+                self.routers[router_id] = {
+                    'id': router_id,
+                    'tenant_id': tenant_id,
+                    'name': 'router-%d-%d' % (t, r),
+                    'gw_port_id': gw_port['id'],
+                    'interface_port_ids': interface_ids,
+                    'floatingips': floatingips,
+                }
+
+    def _add_network(self, network_id, name, tenant_id, subnet_id, cidr,
+                     ipv6_ra_mode=None):
+        cidr = netaddr.IPNetwork(cidr)
+        self.networks[network_id] = {
+            'id': network_id,
+            'name': name,
+            'tenant_id': tenant_id,
+            'status': 'ACTIVE',
+            'shared': False,
+            'admin_state_up': True,
+            'mtu': 1500,
+        }
+        self.subnets[subnet_id] = {
+            'id': subnet_id,
+            'name': name,
+            'tenant_id': tenant_id,
+            'network_id': network_id,
+            'ip_version': cidr.version,
+            'cidr': str(cidr),
+            'gateway_ip': str(cidr[1]),
+            'enable_dhcp': True,
+            'dns_nameservers': [],
+            'host_routes': [],
+            'ipv6_ra_mode': ipv6_ra_mode,
+        }
+
+    def _add_port(self, network_id, name, tenant_id='', device_id='',
+                  device_owner='', fixed_ips=()):
+        mac = next(self._macs)
+        port = {
+            'id': str(uuid.uuid4()),
+            'name': name,
+            'network_id': network_id,
+            'tenant_id': tenant_id,
+            'device_id': device_id,
+            'device_owner': device_owner,
+            'mac_address': 'fa:16:3e:%02x:%02x:%02x' % (
+                mac >> 16 & 0xff, mac >> 8 & 0xff, mac & 0xff),
+            'fixed_ips': [{'subnet_id': s, 'ip_address': str(ip)}
+                          for s, ip in fixed_ips],
+            'admin_state_up': True,
+            'status': 'ACTIVE',
+        }
+        self.ports[port['id']] = port
+        self._index_port(port)
+        return port
+
+    def _index_port(self, port):
+        for key, index in self._port_index.items():
+            index[port[key]].add(port['id'])
+        if port['network_id'] == MGT_NETWORK_ID and port['fixed_ips']:
+            self._ports_by_mgt_ip[port['fixed_ips'][0]['ip_address']] = port
+
+    def _unindex_port(self, port):
+        for key, index in self._port_index.items():
+            index[port[key]].discard(port['id'])
+        if port['network_id'] == MGT_NETWORK_ID and port['fixed_ips']:
+            self._ports_by_mgt_ip.pop(
+                port['fixed_ips'][0]['ip_address'], None)
+
+    def _set_device(self, port, device_id, device_owner):
+        self._unindex_port(port)
+        port['device_id'] = device_id
+        port['device_owner'] = device_owner
+        self._index_port(port)
+
+    def wait(self, service):
+        """Sleep for the latency of a call to service."""
+        latency = self.latencies.get(service)
+        if latency is not None:
+            delay = latency.sample()
+            if delay:
+                time.sleep(delay)
+
+    def call(self, service, method):
+        """Record a call to service, taking as long as its latency."""
+        with metrics.timed_call(service, method):
+            self.wait(service)
+
+    # Neutron
+
+    def router_detail(self, router_id):
+        with self._lock:
+            router = self.routers.get(router_id)
+            if router is None:
+                return None
+            return {
+                'id': router['id'],
+                'tenant_id': router['tenant_id'],
+                'name': router['name'],
+                'admin_state_up': True,
+                'status': self.router_status.get(router_id, 'ACTIVE'),
+                'ha': False,
+                'gw_port': dict(self.ports[router['gw_port_id']]),
+                '_interfaces': [dict(self.ports[p])
+                                for p in router['interface_port_ids']],
+                '_floatingips': [dict(f) for f in router['floatingips']],
+            }
+
+    def list_ports(self, **filters):
+        with self._lock:
+            candidates = None
+            for key, index in self._port_index.items():
+                if key not in filters:
+                    continue
+                values = filters[key]
+                if not isinstance(values, (list, tuple, set)):
+                    values = [values]
+                ids = set()
+                for value in values:
+                    ids.update(index.get(value, ()))
+                candidates = ids if candidates is None else candidates & ids
+            if candidates is None:
+                candidates = self.ports
+            return [dict(self.ports[i]) for i in candidates]
+
+    def create_port(self, network_id, name='', device_id='',
+                    device_owner=''):
+        with self._lock:
+            fixed_ips = []
+            if network_id == MGT_NETWORK_ID:
+                # The management subnet uses SLAAC, so its ports get an
+                # address even when none is asked for.
+                fixed_ips.append((
+                    MGT_SUBNET_ID,
+                    netaddr.IPNetwork(MGT_CIDR)[next(self._mgt_ips)]))
+            return dict(self._add_port(
+                network_id, name, device_id=device_id,
+                device_owner=device_owner, fixed_ips=fixed_ips))
+
+    def delete_port(self, port_id):
+        with self._lock:
+            port = self.ports.pop(port_id, None)
+            if port is None:
+                return False
+            self._unindex_port(port)
+            server = self.servers.get(port['device_id'])
+            if server is not None and port_id in server.port_ids:
+                server.port_ids.remove(port_id)
+            return True
+
+    # Nova
+
+    def create_server(self, name, image, port_ids):
+        with self._lock:
+            server = FakeServer(self, str(uuid.uuid4()), name, image,
+                                port_ids)
+            self.servers[server.id] = server
+            for port_id in port_ids:
+                self._set_device(self.ports[port_id], server.id,
+                                 'compute:None')
+            return server
+
+    def delete_server(self, server_id):
+        with self._lock:
+            server = self.servers.pop(server_id, None)
+            if server is None:
+                return False
+            for port_id in server.port_ids:
+                port = self.ports.get(port_id)
+                if port is not None:
+                    self._set_device(port, '', '')
+            return True
+
+    def attach_port(self, server, port_id):
+        with self._lock:
+            server.port_ids.append(port_id)
+            self._set_device(self.ports[port_id], server.id, 'compute:None')
+
+    def detach_port(self, server, port_id):
+        with self._lock:
+            if port_id in server.port_ids:
+                server.port_ids.remove(port_id)
+            port = self.ports.get(port_id)
+            if port is not None:
+                self._set_device(port, '', '')
+
+    # Appliance
+
+    def _server_for_address(self, address):
+        with self._lock:
+            port = self._ports_by_mgt_ip.get(address)
+            if port is None:
+                return None, None
+            return port, self.servers.get(port['device_id'])
+
+    def _interfaces(self, server, mgt_port):
+        with self._lock:
+            ports = [mgt_port] + [self.ports[p] for p in server.port_ids
+                                  if p != mgt_port['id'] and p in self.ports]
+        return [{'ifname': 'ge%d' % i,
+                 'lladdr': p['mac_address'],
+                 'addresses': []}
+                for i, p in enumerate(ports)]
+
+    def appliance_request(self, method, address, path, body=None):
+        """Answer a request made to the appliance at address.
+
+        Configs are accepted whole with PUT, or as the changes from the
+        config the appliance runs with PATCH, as sent by
+        astara_client.update_config.
+
+        :returns: A tuple of the HTTP status and the decoded response body.
+        """
+        started = time.time()
+        self.wait('appliance')
+        mgt_port, server = self._server_for_address(address)
+        if server is None or server.status != 'ACTIVE':
+            raise requests.ConnectionError(
+                'appliance %s is not reachable' % address)
+
+        if path.endswith('/system/interfaces'):
+            return 200, {'interfaces': self._interfaces(server, mgt_port)}
+        if path.endswith('/system/config') and method in ('PUT', 'PATCH'):
+            if method == 'PUT':
+                config = body
+            else:
+                if (server.config is None or
+                        delta.fingerprint(server.config) !=
+                        body['base_version']):
+                    return 409, {'message': 'config version mismatch'}
+                config = delta.apply(server.config, body['changes'])
+                if delta.fingerprint(config) != body['version']:
+                    return 409, {'message': 'config version mismatch'}
+            server.config = config
+            # Management ports are named ASTARA:MGT:<resource id>.
+            router_id = mgt_port['name'].rpartition(':')[2]
+            if self.results is not None:
+                self.results.put((router_id, started, time.time()))
+            return 200, config
+        if path.endswith('/firewall/labels'):
+            return 200, {'labels': []}
+        return 200, {}
+
+
+class FakeNeutronClient(object):
+    """Answers the neutronclient calls made by astara.api.neutron."""
+
+    def __init__(self, cloud):
+        self.cloud = cloud
+
+    def list_routers(self, tenant_id=None):
+        self.cloud.call('neutron', 'GET')
+        return {'routers': [
+            {'id': r['id'], 'tenant_id': r['tenant_id'], 'name': r['name']}
+            for r in self.cloud.routers.values()
+            if tenant_id is None or r['tenant_id'] == tenant_id
+        ]}
+
+    def list_ports(self, **filters):
+        self.cloud.call('neutron', 'GET')
+        return {'ports': self.cloud.list_ports(**filters)}
+
+    def list_networks(self, id=None):
+        self.cloud.call('neutron', 'GET')
+        ids = set(id) if id is not None else set(self.cloud.networks)
+        return {'networks': [dict(self.cloud.networks[i]) for i in ids
+                             if i in self.cloud.networks]}
+
+    def show_network(self, network_id):
+        self.cloud.call('neutron', 'GET')
+        return {'network': dict(self.cloud.networks[network_id])}
+
+    def list_subnets(self, network_id=None):
+        self.cloud.call('neutron', 'GET')
+        if network_id is None:
+            network_ids = None
+        elif isinstance(network_id, (list, tuple, set)):
+            network_ids = set(network_id)
+        else:
+            network_ids = set([network_id])
+        return {'subnets': [
+            dict(s) for s in self.cloud.subnets.values()
+            if network_ids is None or s['network_id'] in network_ids
+        ]}
+
+    def create_port(self, body):
+        self.cloud.call('neutron', 'POST')
+        port = body['port']
+        return {'port': self.cloud.create_port(
+            port['network_id'],
+            name=port.get('name', ''),
+            device_id=port.get('device_id', ''),
+            device_owner=port.get('device_owner', ''))}
+
+    def delete_port(self, port_id):
+        self.cloud.call('neutron', 'DELETE')
+        self.cloud.delete_port(port_id)
+
+    def update_router_status(self, router_id, status):
+        self.cloud.call('neutron', 'PUT')
+        self.cloud.router_status[router_id] = status
+
+
+class FakeL3PluginApi(object):
+    """Answers the sync_routers RPC call."""
+
+    def __init__(self, cloud):
+        self.cloud = cloud
+
+    def get_routers(self, router_id=None):
+        self.cloud.call('neutron', 'sync_routers')
+        if router_id is None:
+            ids = list(self.cloud.routers)
+        else:
+            ids = [router_id]
+        routers = (self.cloud.router_detail(i) for i in ids)
+        return [r for r in routers if r is not None]
+
+
+class FakeServerManager(object):
+    """Answers the novaclient servers calls made by astara.api.nova."""
+
+    def __init__(self, cloud):
+        self.cloud = cloud
+
+    def list(self, detailed=True, search_opts=None, marker=None, limit=None):
+        self.cloud.call('nova', 'GET')
+        servers = list(self.cloud.servers.values())
+        name = (search_opts or {}).get('name')
+        if name:
+            pattern = re.compile(name)
+            servers = [s for s in servers if pattern.match(s.name)]
+        if marker is not None:
+            ids = [s.id for s in servers]
+            servers = servers[ids.index(marker) + 1:] if marker in ids else []
+        if limit is not None:
+            servers = servers[:limit]
+        return servers
+
+    def get(self, server_id):
+        self.cloud.call('nova', 'GET')
+        try:
+            return self.cloud.servers[server_id]
+        except KeyError:
+            raise novaclient_exceptions.NotFound(404)
+
+    def create(self, name, image, flavor, nics=(), config_drive=None,
+               userdata=None):
+        self.cloud.call('nova', 'POST')
+        return self.cloud.create_server(
+            name, image, [nic['port-id'] for nic in nics])
+
+    def delete(self, server_id):
+        self.cloud.call('nova', 'DELETE')
+        if not self.cloud.delete_server(server_id):
+            raise novaclient_exceptions.NotFound(404)
+
+
+class FakeNovaClient(object):
+    def __init__(self, cloud):
+        self.servers = FakeServerManager(cloud)
+
+
+class FakeApplianceAdapter(adapters.BaseAdapter):
+    """A requests transport adapter that answers for the appliances."""
+
+    def __init__(self, cloud):
+        super(FakeApplianceAdapter, self).__init__()
+        self.cloud = cloud
+
+    def send(self, request, stream=False, timeout=None, verify=True,
+             cert=None, proxies=None):
+        url = urlparse.urlsplit(request.url)
+        body = None
+        if request.body:
+            body = jsonutils.loads(request.body)
+        status, body = self.cloud.appliance_request(
+            request.method, url.hostname, url.path, body)
+        resp = requests.Response()
+        resp.status_code = status
+        resp._content = jsonutils.dump_as_bytes(body)
+        resp.headers['Content-Type'] = 'application/json'
+        resp.encoding = 'utf-8'
+        resp.url = request.url
+        resp.request = request
+        return resp
+
+    def close(self):
+        pass
+
+
+class SimulatedNeutron(neutron.Neutron):
+    """The real Neutron wrapper, talking to a FakeCloud."""
+
+    def __init__(self, conf, cache=None, status_writer=None, cloud=None):
+        self.conf = conf
+        self.cache = cache
+        self.status_writer = status_writer
+        self.api_client = FakeNeutronClient(cloud)
+        self.l3_rpc_client = FakeL3PluginApi(cloud)
+
+
+class SimulatedNova(nova.Nova):
+    """The real Nova wrapper, talking to a FakeCloud."""
+
+    def __init__(self, conf, server_index=None, cloud=None):
+        self.conf = conf
+        self.server_index = server_index
+        self.client = FakeNovaClient(cloud)
+        self.instance_provider = nova.OnDemandInstanceProvider(self.client)
+
+
+def install(cloud):
+    """Point the Neutron, Nova and appliance clients at cloud.
+
+    :returns: The started patchers. Stopping them restores the real
+              clients.
+    """
+    def _new_session(pool):
+        session = requests.Session()
+        session.trust_env = False
+        session.mount('http://', FakeApplianceAdapter(cloud))
+        return session
+
+    patchers = [
+        mock.patch.object(neutron, 'Neutron',
+                          functools.partial(SimulatedNeutron, cloud=cloud)),
+        mock.patch.object(nova, 'Nova',
+                          functools.partial(SimulatedNova, cloud=cloud)),
+        mock.patch.object(astara_client.SessionPool, '_new_session',
+                          _new_session),
+    ]
+    for p in patchers:
+        p.start()
+    return patchers
@@ -0,0 +1,486 @@
+# Copyright (c) 2016 Akanda, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Replay a synthetic notification trace against a simulated fleet.
+
+The real notification endpoint, scheduler, worker processes and state
+machines run against the fakes in astara.test.benchmark.fakes, and the
+report shows how quickly the configuration of each router converged
+after a notification about it, and how many calls were made to Neutron,
+Nova and the appliances to get there.
+
+Run it with::
+
+    python -m astara.test.benchmark.fleet --tenants 50 --duration 60
+
+Arguments not recognized by the simulator are handed to oslo.config, so
+any orchestrator option can be tried, for example
+``--neutron_cache_ttl 0``.
+"""
+
+from __future__ import print_function
+
+import argparse
+import bisect
+import collections
+import functools
+import json
+import math
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from oslo_config import cfg
+from oslo_log import log
+
+from astara.common import config as ak_cfg
+from astara.common import metrics
+from astara import health
+from astara import main as orchestrator
+from astara import notifications
+from astara import scheduler
+from astara.test.benchmark import fakes
+from astara import worker
+
+
+LOG = log.getLogger(__name__)
+
+Notification = collections.namedtuple(
+    'Notification',
+    ['offset', 'router_id', 'tenant_id', 'event_type', 'payload'],
+)
+
+
+def generate_trace(cloud, duration, update_rate, ramp=0, seed=None):
+    """Build the notifications to replay against cloud.
+
+    Every router is created once during the first ramp seconds, then
+    routers picked at random receive port and router updates at
+    update_rate per second for duration seconds.
+
+    :returns: A list of Notifications sorted by their offset, in seconds
+              from the start of the run.
+    """
+    rng = random.Random(seed)
+    routers = list(cloud.routers.values())
+    trace = []
+    for router in routers:
+        trace.append(Notification(
+            rng.uniform(0, ramp), router['id'], router['tenant_id'],
+            'router.create.end',
+            {'router': {'id': router['id'],
+                        'tenant_id': router['tenant_id']}},
+        ))
+    for i in range(int(duration * update_rate)):
+        router = rng.choice(routers)
+        offset = ramp + rng.uniform(0, duration)
+        if router['interface_port_ids'] and rng.random() < 0.5:
+            port = cloud.ports[rng.choice(router['interface_port_ids'])]
+            trace.append(Notification(
+                offset, router['id'], router['tenant_id'],
+                'port.change.end', {'port': dict(port)},
+            ))
+        else:
+            trace.append(Notification(
+                offset, router['id'], router['tenant_id'],
+                'router.change.end',
+                {'router': {'id': router['id'],
+                            'tenant_id': router['tenant_id']}},
+            ))
+    trace.sort(key=lambda n: n.offset)
+    return trace
+
+
+def percentile(values, pct):
+    """Return the pct percentile of values, by the nearest rank method."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = int(math.ceil(pct / 100.0 * len(ordered)))
+    return ordered[max(rank, 1) - 1]
+
+
+class ConvergenceTracker(object):
+    """Matches the notifications sent with the configuration pushes.
+
+    A notification has converged once a configuration push for its
+    router that started after the notification was sent has finished.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sent = []
+        self._last_sent = {}
+        # router id -> sorted (started, finished) pairs
+        self._pushes = collections.defaultdict(list)
+        self._last_push = {}
+
+    def sent(self, router_id, at):
+        with self._lock:
+            self._sent.append((router_id, at))
+            self._last_sent[router_id] = max(
+                at, self._last_sent.get(router_id, at))
+
+    def pushed(self, router_id, started, finished):
+        with self._lock:
+            bisect.insort(self._pushes[router_id], (started, finished))
+            self._last_push[router_id] = max(
+                started, self._last_push.get(router_id, started))
+
+    @property
+    def push_count(self):
+        with self._lock:
+            return sum(len(p) for p in self._pushes.values())
+
+    def pending(self):
+        """Return the number of routers waiting for a push."""
+        with self._lock:
+            return sum(1 for router_id, at in self._last_sent.items()
+                       if self._last_push.get(router_id, at - 1) < at)
+
+    def latencies(self):
+        """Return the convergence time of each converged notification,
+        and the number of notifications that did not converge.
+        """
+        latencies = []
+        unconverged = 0
+        with self._lock:
+            for router_id, at in self._sent:
+                pushes = self._pushes.get(router_id, [])
+                i = bisect.bisect_left(pushes, (at,))
+                if i < len(pushes):
+                    latencies.append(pushes[i][1] - at)
+                else:
+                    unconverged += 1
+        return latencies, unconverged
+
+    def first_sent(self):
+        with self._lock:
+            return min(at for _, at in self._sent) if self._sent else None
+
+
+def replay(trace, endpoint, tracker, batch_size=1, start=None):
+    """Deliver the notifications of trace to endpoint at their offsets.
+
+    Notifications that are due at the same time are delivered together,
+    up to batch_size at a time, the way the notification listener
+    receives them.
+    """
+    if start is None:
+        start = time.time()
+    i = 0
+    while i < len(trace):
+        delay = start + trace[i].offset - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        now = time.time()
+        batch = []
+        while (i < len(trace) and len(batch) < batch_size and
+               start + trace[i].offset <= now):
+            batch.append(trace[i])
+            i += 1
+        for n in batch:
+            tracker.sent(n.router_id, now)
+        if batch_size > 1:
+            endpoint.info([{'ctxt': {'tenant_id': n.tenant_id},
+                            'event_type': n.event_type,
+                            'payload': n.payload}
+                           for n in batch])
+        else:
+            n = batch[0]
+            endpoint.info({'tenant_id': n.tenant_id}, 'network.benchmark',
+                          n.event_type, n.payload, {})
+
+
+def _collect_pushes(results, tracker):
+    while True:
+        try:
+            item = results.get()
+        except IOError:
+            continue
+        if item is None:
+            break
+        tracker.pushed(*item)
+
+
+def _api_calls(merged):
+    calls = {}
+    hists = merged[metrics.HISTOGRAM]
+    counters = merged[metrics.COUNTER]
+    for (name, labels), hist in hists.items():
+        if name != 'astara_api_request_duration_seconds':
+            continue
+        labels = dict(labels)
+        key = '%s %s' % (labels['service'], labels['method'])
+        calls[key] = {
+            'count': hist['count'],
+            'mean': hist['sum'] / hist['count'] if hist['count'] else 0,
+            'errors': counters.get(
+                ('astara_api_request_errors_total',
+                 tuple(sorted(labels.items()))), 0),
+        }
+    return calls
+
+
+def _state_timings(merged):
+    states = {}
+    for (name, labels), hist in merged[metrics.HISTOGRAM].items():
+        if name != 'astara_state_duration_seconds':
+            continue
+        labels = dict(labels)
+        key = '%s %s' % (labels['driver'], labels['state'])
+        states[key] = {
+            'count': hist['count'],
+            'mean': hist['sum'] / hist['count'] if hist['count'] else 0,
+            'total': hist['sum'],
+        }
+    return states
+
+
+def _configure(args, workdir):
+    """Point the orchestrator options at the simulated cloud."""
+    rules_path = os.path.join(workdir, 'provider_rules.json')
+    with open(rules_path, 'w') as f:
+        f.write('{}')
+    key_path = os.path.join(workdir, 'id_rsa.pub')
+    with open(key_path, 'w') as f:
+        f.write('ssh-rsa AAAA benchmark')
+    overrides = {
+        'management_network_id': fakes.MGT_NETWORK_ID,
+        'management_subnet_id': fakes.MGT_SUBNET_ID,
+        'management_prefix': fakes.MGT_CIDR,
+        'instance_provider': 'on_demand',
+        'provider_rules_path': rules_path,
+        'ssh_public_key': key_path,
+        'metrics_report_interval': 1,
+    }
+    for option in ('num_worker_processes', 'num_worker_threads',
+                   'health_check_period'):
+        value = getattr(args, option)
+        if value is not None:
+            overrides[option] = value
+    for name, value in overrides.items():
+        cfg.CONF.set_override(name, value)
+    cfg.CONF.set_override('enabled', False, group='coordination')
+    # The updates of the trace leave the router configs unchanged, so
+    # unless asked otherwise push them anyway, the way a real change is.
+    cfg.CONF.set_default('config_resync_interval', 0)
+
+    # Debug modes are tracked in the database, so give the workers an
+    # empty one of their own.
+    from astara.db.sqlalchemy import migration
+    cfg.CONF.set_override(
+        'connection', 'sqlite:///%s' % os.path.join(workdir, 'astara.db'),
+        group='database')
+    migration.upgrade('head')
+
+
+def run(args, workdir):
+    """Replay a trace against a simulated fleet and return the report."""
+    _configure(args, workdir)
+    results = multiprocessing.Queue()
+    latencies = {
+        'neutron': fakes.Latency(args.neutron_latency, args.latency_jitter),
+        'nova': fakes.Latency(args.nova_latency, args.latency_jitter),
+        'appliance': fakes.Latency(args.appliance_latency,
+                                   args.latency_jitter),
+    }
+    cloud = fakes.FakeCloud(
+        args.tenants,
+        routers_per_tenant=args.routers_per_tenant,
+        networks_per_router=args.networks_per_router,
+        latencies=latencies,
+        boot_time=args.boot_time,
+        results=results,
+    )
+    trace = generate_trace(cloud, args.duration, args.update_rate,
+                           ramp=args.ramp, seed=args.seed)
+    # The workers get their copy of the fakes when they are forked.
+    patchers = fakes.install(cloud)
+
+    notification_queue = multiprocessing.Queue()
+    metrics_queue = multiprocessing.Queue(cfg.CONF.metrics_queue_size)
+    aggregator = metrics.Aggregator()
+    metrics.start_collector(metrics_queue, aggregator)
+    tracker = ConvergenceTracker()
+
+    sched = scheduler.Scheduler(
+        worker_factory=functools.partial(
+            worker.Worker,
+            notifier=notifications.NoopPublisher(),
+            management_address=fakes.RUG_ADDRESS,
+            metrics_queue=metrics_queue,
+        ),
+    )
+    threads = [
+        threading.Thread(target=orchestrator.shuffle_notifications,
+                         args=(notification_queue, sched),
+                         name='shuffle'),
+        threading.Thread(target=_collect_pushes, args=(results, tracker),
+                         name='pushes'),
+    ]
+    for t in threads:
+        t.setDaemon(True)
+        t.start()
+    health.start_inspector(cfg.CONF.health_check_period, sched)
+
+    batch_size = cfg.CONF.notification_batch_size
+    if batch_size > 1:
+        endpoint = notifications.BatchNotificationsEndpoint(
+            notification_queue)
+    else:
+        endpoint = notifications.NotificationsEndpoint(notification_queue)
+
+    try:
+        replay(trace, endpoint, tracker, batch_size=batch_size)
+        deadline = time.time() + args.timeout
+        while tracker.pending() and time.time() < deadline:
+            time.sleep(0.1)
+        finished = time.time()
+        # Give the workers time to report their final metrics.
+        time.sleep(cfg.CONF.metrics_report_interval * 2)
+    finally:
+        notification_queue.put((None, None))
+        threads[0].join()
+        sched.stop()
+        results.put(None)
+        threads[1].join()
+        for p in patchers:
+            p.stop()
+
+    return build_report(args, cloud, trace, tracker, aggregator, finished)
+
+
+def build_report(args, cloud, trace, tracker, aggregator, finished):
+    latencies, unconverged = tracker.latencies()
+    started = tracker.first_sent() or finished
+    elapsed = max(finished - started, 1e-9)
+    merged = aggregator.merged()
+    return {
+        'tenants': args.tenants,
+        'routers': len(cloud.routers),
+        'notifications': len(trace),
+        'num_worker_processes': cfg.CONF.num_worker_processes,
+        'num_worker_threads': cfg.CONF.num_worker_threads,
+        'health_check_period': cfg.CONF.health_check_period,
+        'elapsed': elapsed,
+        'notifications_per_second': len(trace) / elapsed,
+        'config_pushes': tracker.push_count,
+        'convergence': {
+            'p50': percentile(latencies, 50),
+            'p90': percentile(latencies, 90),
+            'p99': percentile(latencies, 99),
+            'max': max(latencies) if latencies else None,
+            'unconverged': unconverged,
+        },
+        'api_calls': _api_calls(merged),
+        'states': _state_timings(merged),
+    }
+
+
+def _seconds(value):
+    return '-' if value is None else '%.3f' % value
+
+
+def format_report(report):
+    lines = [
+        'Fleet: %(tenants)d tenants, %(routers)d routers, '
+        '%(notifications)d notifications' % report,
+        'Workers: %(num_worker_processes)d processes x '
+        '%(num_worker_threads)d threads, health check every '
+        '%(health_check_period)ds' % report,
+        'Elapsed: %.1fs, %.1f notifications/s, %d config pushes' % (
+            report['elapsed'], report['notifications_per_second'],
+            report['config_pushes']),
+        'Convergence (s): p50 %s  p90 %s  p99 %s  max %s  unconverged %d' % (
+            _seconds(report['convergence']['p50']),
+            _seconds(report['convergence']['p90']),
+            _seconds(report['convergence']['p99']),
+            _seconds(report['convergence']['max']),
+            report['convergence']['unconverged']),
+        '',
+        '%-28s %8s %10s %8s' % ('API calls', 'count', 'mean (s)', 'errors'),
+    ]
+    for key, call in sorted(report['api_calls'].items()):
+        lines.append('%-28s %8d %10.3f %8d' % (
+            key, call['count'], call['mean'], call['errors']))
+    lines.append('')
+    lines.append('%-28s %8s %10s %10s' % (
+        'States', 'count', 'mean (s)', 'total (s)'))
+    for key, state in sorted(report['states'].items()):
+        lines.append('%-28s %8d %10.3f %10.1f' % (
+            key, state['count'], state['mean'], state['total']))
+    return '\n'.join(lines)
+
+
+def _parser():
+    parser = argparse.ArgumentParser(
+        description='Replay a synthetic notification trace against a '
+                    'simulated fleet of routers.',
+    )
+    parser.add_argument('--tenants', type=int, default=10)
+    parser.add_argument('--routers-per-tenant', type=int, default=1)
+    parser.add_argument('--networks-per-router', type=int, default=1)
+    parser.add_argument('--duration', type=float, default=30,
+                        help='seconds of updates after the routers are '
+                             'created')
+    parser.add_argument('--update-rate', type=float, default=5,
+                        help='update notifications per second')
+    parser.add_argument('--ramp', type=float, default=5,
+                        help='seconds over which the routers are created')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--neutron-latency', type=float, default=0.02)
+    parser.add_argument('--nova-latency', type=float, default=0.05)
+    parser.add_argument('--appliance-latency', type=float, default=0.05)
+    parser.add_argument('--latency-jitter', type=float, default=0.5,
+                        help='how far, as a fraction of the mean, a call '
+                             'may be faster or slower')
+    parser.add_argument('--boot-time', type=float, default=5,
+                        help='seconds an appliance takes to boot')
+    parser.add_argument('--timeout', type=float, default=120,
+                        help='seconds to wait for the routers to converge '
+                             'after the last notification')
+    parser.add_argument('--num-worker-processes', type=int)
+    parser.add_argument('--num-worker-threads', type=int)
+    parser.add_argument('--health-check-period', type=int)
+    parser.add_argument('--json', metavar='PATH',
+                        help='also write the report to PATH as JSON')
+    return parser
+
+
+def main(argv=sys.argv[1:]):
+    args, oslo_args = _parser().parse_known_args(argv)
+    multiprocessing.current_process().name = 'pmain'
+    ak_cfg.parse_config(oslo_args, default_config_files=[])
+    log.setup(cfg.CONF, 'astara-benchmark')
+
+    workdir = tempfile.mkdtemp(prefix='astara-benchmark-')
+    try:
+        report = run(args, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(format_report(report))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -52,6 +52,25 @@ class TestCommonConfig(unittest.TestCase):
                     subnets_dict=subnets_dict,
                     network_ports=[]),
 
+    def test_network_config_prefetched_network(self):
+        mock_client = mock.Mock()
+        subnets_dict = {fakes.fake_subnet.id: fakes.fake_subnet}
+
+        with mock.patch.object(common, '_make_network_config_dict') as nc:
+            with mock.patch.object(common, '_interface_config') as ic:
+                common.network_config(
+                    mock_client,
+                    fakes.fake_int_port,
+                    'ge1',
+                    'internal',
+                    [],
+                    network=fakes.fake_network)
+
+                self.assertFalse(mock_client.get_network_detail.called)
+                ic.assert_called_once_with(
+                    'ge1', fakes.fake_int_port, subnets_dict, 1280)
+                self.assertTrue(nc.called)
+
     def test_make_network_config(self):
         interface = {'ifname': 'ge2'}
 
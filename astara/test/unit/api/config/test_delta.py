@@ -0,0 +1,123 @@
+# Copyright (c) 2016 Akanda, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import copy
+
+import unittest2 as unittest
+
+from astara.api.config import delta
+
+
+def _allocation(mac, ip):
+    return {'mac_address': mac, 'device_id': 'd-' + mac,
+            'ip_addresses': {ip: True}, 'hostname': ip + '.local'}
+
+
+BASE_CONFIG = {
+    'tenant_id': 't1',
+    'networks': [
+        {'network_id': 'ext', 'network_type': 'external',
+         'allocations': [], 'subnets': [{'id': 's1', 'cidr': '1.0.0.0/24'}]},
+        {'network_id': 'int', 'network_type': 'internal',
+         'allocations': [_allocation('m1', '10.0.0.1'),
+                         _allocation('m2', '10.0.0.2')],
+         'subnets': [{'id': 's2', 'cidr': '10.0.0.0/24'}]},
+    ],
+    'floating_ips': [{'floating_ip': '1.0.0.5', 'fixed_ip': '10.0.0.1'}],
+    'labels': {'ext': ['1.0.0.0/24']},
+}
+
+
+class TestDelta(unittest.TestCase):
+    def setUp(self):
+        self.old = copy.deepcopy(BASE_CONFIG)
+        self.new = copy.deepcopy(BASE_CONFIG)
+
+    def _assert_round_trip(self):
+        changes = delta.diff(self.old, self.new)
+        self.assertEqual(self.new, delta.apply(self.old, changes))
+        return changes
+
+    def test_fingerprint(self):
+        self.assertEqual(delta.fingerprint({'a': 1, 'b': [2]}),
+                         delta.fingerprint({'b': [2], 'a': 1}))
+        self.assertNotEqual(delta.fingerprint({'a': 1}),
+                            delta.fingerprint({'a': 2}))
+
+    def test_pack(self):
+        packed = delta.pack(self.old)
+        self.assertEqual(self.old, delta.unpack(packed))
+        self.assertLess(len(packed), len(repr(self.old)))
+
+    def test_no_changes(self):
+        self.assertEqual([], self._assert_round_trip())
+
+    def test_allocation_added(self):
+        allocation = _allocation('m3', '10.0.0.3')
+        self.new['networks'][1]['allocations'].append(allocation)
+        self.assertEqual(
+            [{'op': 'replace',
+              'path': ['networks', {'network_id': 'int'}, 'allocations',
+                       {'mac_address': 'm3'}],
+              'value': allocation}],
+            self._assert_round_trip())
+
+    def test_allocation_removed_and_changed(self):
+        allocations = self.new['networks'][1]['allocations']
+        del allocations[0]
+        allocations[0]['hostname'] = 'host.local'
+        self.assertEqual(
+            [{'op': 'remove',
+              'path': ['networks', {'network_id': 'int'}, 'allocations',
+                       {'mac_address': 'm1'}]},
+             {'op': 'replace',
+              'path': ['networks', {'network_id': 'int'}, 'allocations',
+                       {'mac_address': 'm2'}, 'hostname'],
+              'value': 'host.local'}],
+            self._assert_round_trip())
+
+    def test_keys_added_and_removed(self):
+        del self.new['labels']
+        self.new['vpn'] = {}
+        self.assertEqual(
+            [{'op': 'remove', 'path': ['labels']},
+             {'op': 'replace', 'path': ['vpn'], 'value': {}}],
+            self._assert_round_trip())
+
+    def test_reordered_list_replaced(self):
+        self.new['networks'].reverse()
+        self.assertEqual(
+            [{'op': 'replace', 'path': ['networks'],
+              'value': self.new['networks']}],
+            self._assert_round_trip())
+
+    def test_unkeyed_list_replaced(self):
+        self.old['labels']['ext'] = ['a', 'b']
+        self.new['labels']['ext'] = ['b']
+        self.assertEqual(
+            [{'op': 'replace', 'path': ['labels', 'ext'], 'value': ['b']}],
+            self._assert_round_trip())
+
+    def test_apply_does_not_modify_config(self):
+        self.new['tenant_id'] = 't2'
+        delta.apply(self.old, delta.diff(self.old, self.new))
+        self.assertEqual(BASE_CONFIG, self.old)
+
+    def test_apply_mismatched_change(self):
+        self.assertRaises(
+            ValueError, delta.apply, self.old,
+            [{'op': 'remove', 'path': ['networks', {'network_id': 'foo'}]}])
+        self.assertRaises(
+            ValueError, delta.apply, self.old,
+            [{'op': 'replace', 'path': ['vpn', 'ipsec'], 'value': []}])
@@ -128,11 +128,23 @@ class TestAstaraClient(unittest.TestCase):
     @mock.patch('astara.api.config.common.network_config')
     def test_generate_network_config(self, mock_net_conf):
         mock_client = mock.Mock()
+        mgt_net_id = fakes.fake_mgt_port.network_id
+        ext_net_id = fakes.fake_ext_port.network_id
+        int_net_id = fakes.fake_int_port.network_id
+        networks = {
+            mgt_net_id: 'mgt_network',
+            ext_net_id: 'ext_network',
+            int_net_id: 'int_network',
+        }
+        mock_client.get_network_details.return_value = networks
+        mock_client.get_ports_for_networks.return_value = {
+            int_net_id: ['int_net_port']
+        }
 
         iface_map = {
-            fakes.fake_mgt_port.network_id: 'ge0',
-            fakes.fake_ext_port.network_id: 'ge1',
-            fakes.fake_int_port.network_id: 'ge2'
+            mgt_net_id: 'ge0',
+            ext_net_id: 'ge1',
+            int_net_id: 'ge2'
         }
 
         mock_net_conf.return_value = 'configured_network'
@@ -151,17 +163,23 @@ class TestAstaraClient(unittest.TestCase):
         expected_calls = [
             mock.call(
                 mock_client, fakes.fake_router.management_port,
-                'ge0', 'management'),
+                'ge0', 'management', network='mgt_network'),
             mock.call(
                 mock_client, fakes.fake_router.external_port,
-                'ge1', 'external'),
+                'ge1', 'external', network='ext_network'),
             mock.call(
                 mock_client, fakes.fake_int_port,
-                'ge2', 'internal', mock.ANY)]
+                'ge2', 'internal', ['int_net_port'], network='int_network')]
         for c in expected_calls:
             self.assertIn(c, mock_net_conf.call_args_list)
         mock_net_conf.assert_has_calls(expected_calls)
 
+        mock_client.get_network_details.assert_called_once_with(
+            set([mgt_net_id, ext_net_id, int_net_id]))
+        mock_client.get_ports_for_networks.assert_called_once_with(
+            set([int_net_id]))
+        self.assertFalse(mock_client.get_network_ports.called)
+
     def test_generate_floating_config(self):
         fip = fakes.FakeModel(
             'id',
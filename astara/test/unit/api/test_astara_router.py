@@ -16,9 +16,11 @@
 
 
 import mock
+from oslo_serialization import jsonutils
 import unittest2 as unittest
 
 from astara.api import astara_client
+from astara.api.config import delta
 
 
 class TestAstaraClient(unittest.TestCase):
@@ -30,7 +32,11 @@ class TestAstaraClient(unittest.TestCase):
         self.mock_get = self.mock_create_session.return_value.get
         self.mock_put = self.mock_create_session.return_value.put
         self.mock_post = self.mock_create_session.return_value.post
+        self.mock_patch = self.mock_create_session.return_value.patch
 
+        astara_client.SESSION_POOL.clear()
+        self.addCleanup(astara_client.SESSION_POOL.clear)
+        self.addCleanup(astara_client._DELTA_UNSUPPORTED.clear)
         self.addCleanup(mock.patch.stopall)
 
     def test_mgt_url(self):
@@ -125,6 +131,79 @@ class TestAstaraClient(unittest.TestCase):
             timeout=90
         )
 
+    def test_update_config_delta(self):
+        base = {'foo': 'bar', 'baz': 1}
+        config = {'foo': 'qux', 'baz': 1}
+        self.mock_patch.return_value.status_code = 200
+        self.mock_patch.return_value.json.return_value = config
+
+        resp = astara_client.update_config('fe80::2', 5000, config,
+                                           base_config=base)
+
+        self.assertEqual(resp, config)
+        self.assertFalse(self.mock_put.called)
+        url, = self.mock_patch.call_args[0]
+        self.assertEqual('http://[fe80::2]:5000/v1/system/config', url)
+        body = jsonutils.loads(self.mock_patch.call_args[1]['data'])
+        self.assertEqual({
+            'base_version': delta.fingerprint(base),
+            'version': delta.fingerprint(config),
+            'changes': [{'op': 'replace', 'path': ['foo'], 'value': 'qux'}],
+        }, body)
+
+    def test_update_config_delta_version_mismatch(self):
+        config = {'foo': 'qux'}
+        self.mock_patch.return_value.status_code = 409
+        self.mock_put.return_value.status_code = 200
+        self.mock_put.return_value.json.return_value = config
+
+        resp = astara_client.update_config('fe80::2', 5000, config,
+                                           base_config={'foo': 'bar'})
+
+        self.assertEqual(resp, config)
+        self.mock_put.assert_called_once_with(
+            'http://[fe80::2]:5000/v1/system/config',
+            data=b'{"foo": "qux"}',
+            headers={'Content-type': 'application/json'},
+            timeout=90)
+
+        # the appliance may accept changes next time
+        astara_client.update_config('fe80::2', 5000, config,
+                                    base_config={'foo': 'bar'})
+        self.assertEqual(2, self.mock_patch.call_count)
+
+    def test_update_config_delta_unsupported(self):
+        config = {'foo': 'qux'}
+        self.mock_patch.return_value.status_code = 405
+        self.mock_put.return_value.status_code = 200
+
+        astara_client.update_config('fe80::2', 5000, config,
+                                    base_config={'foo': 'bar'})
+        astara_client.update_config('fe80::2', 5000, config,
+                                    base_config={'foo': 'bar'})
+
+        self.assertEqual(1, self.mock_patch.call_count)
+        self.assertEqual(2, self.mock_put.call_count)
+
+    @mock.patch.object(astara_client, 'time')
+    def test_update_config_delta_unsupported_expires(self, fake_time):
+        config = {'foo': 'qux'}
+        self.mock_patch.return_value.status_code = 405
+        self.mock_put.return_value.status_code = 200
+
+        fake_time.time.return_value = 100
+        astara_client.update_config('fe80::2', 5000, config,
+                                    base_config={'foo': 'bar'})
+        fake_time.time.return_value = 100 + astara_client._DELTA_RETRY_INTERVAL
+        astara_client.update_config('fe80::3', 5000, config,
+                                    base_config={'foo': 'bar'})
+        # the entry of the first appliance was dropped with the second one
+        self.assertEqual([('fe80::3', 5000)],
+                         list(astara_client._DELTA_UNSUPPORTED))
+        astara_client.update_config('fe80::2', 5000, config,
+                                    base_config={'foo': 'bar'})
+        self.assertEqual(3, self.mock_patch.call_count)
+
     def test_read_labels(self):
         self.mock_post.return_value.status_code = 200
         self.mock_post.return_value.json.return_value = {
@@ -138,3 +217,104 @@ class TestAstaraClient(unittest.TestCase):
         )
 
         self.assertEqual(resp, ['label1', 'label2'])
+
+    def test_session_reused(self):
+        self.mock_get.return_value.status_code = 200
+        before = astara_client.SESSION_POOL.stats()
+        astara_client.is_alive('fe80::2', 5000)
+        astara_client.is_alive('fe80::2', 5000)
+        self.assertEqual(1, self.mock_create_session.call_count)
+        after = astara_client.SESSION_POOL.stats()
+        self.assertEqual(1, after['created'] - before['created'])
+        self.assertEqual(1, after['reused'] - before['reused'])
+
+    def test_session_discarded_on_connection_error(self):
+        self.mock_get.side_effect = astara_client.requests.ConnectionError
+        self.assertFalse(astara_client.is_alive('fe80::2', 5000))
+        self.assertTrue(self.mock_create_session.return_value.close.called)
+        self.assertEqual(0, astara_client.SESSION_POOL.stats()['sessions'])
+
+
+class TestSessionPool(unittest.TestCase):
+    def setUp(self):
+        self.mock_create_session = mock.patch.object(
+            astara_client,
+            '_get_proxyless_session',
+            side_effect=lambda: mock.Mock()
+        ).start()
+        self.addCleanup(mock.patch.stopall)
+        self.pool = astara_client.SessionPool()
+
+    def test_pool_size_bounded(self):
+        with mock.patch.object(astara_client, 'CONF') as conf:
+            conf.appliance_session_pool_size = 2
+            conf.appliance_session_idle_timeout = 120
+            first = self.pool.get('fe80::1', 5000)
+            self.pool.get('fe80::2', 5000)
+            self.pool.get('fe80::3', 5000)
+        # another thread may still be using it
+        self.assertFalse(first.close.called)
+        stats = self.pool.stats()
+        self.assertEqual((2, 1), (stats['sessions'], stats['evicted']))
+        self.assertIsNot(first, self.pool.get('fe80::1', 5000))
+        self.pool.release(first)
+        self.assertTrue(first.close.called)
+
+    def test_discard_waits_for_release(self):
+        session = self.pool.get('fe80::1', 5000)
+        self.assertIs(session, self.pool.get('fe80::1', 5000))
+        self.pool.discard('fe80::1', 5000)
+        self.pool.release(session)
+        self.assertFalse(session.close.called)
+        self.pool.release(session)
+        self.assertTrue(session.close.called)
+
+    def test_release_keeps_pooled_session_open(self):
+        session = self.pool.get('fe80::1', 5000)
+        self.pool.release(session)
+        self.assertFalse(session.close.called)
+        self.assertIs(session, self.pool.get('fe80::1', 5000))
+
+    @mock.patch.object(astara_client, 'metrics')
+    def test_stats_exported(self, fake_metrics):
+        self.pool.get('fe80::1', 5000)
+        self.pool.get('fe80::1', 5000)
+        self.pool.discard('fe80::1', 5000)
+        self.assertEqual(
+            [mock.call('astara_appliance_session_events_total',
+                       event=event)
+             for event in ('created', 'reused', 'discarded')],
+            fake_metrics.inc.call_args_list)
+        self.assertEqual(
+            [mock.call('astara_appliance_sessions', n) for n in (1, 1, 0)],
+            fake_metrics.set_gauge.call_args_list)
+        self.assertEqual(
+            {'sessions': 0, 'created': 1, 'reused': 1, 'evicted': 0,
+             'discarded': 1},
+            self.pool.stats())
+
+    @mock.patch.object(astara_client, 'time')
+    def test_idle_sessions_evicted(self, fake_time):
+        fake_time.time.side_effect = [100, 150, 230]
+        with mock.patch.object(astara_client, 'CONF') as conf:
+            conf.appliance_session_pool_size = 10
+            conf.appliance_session_idle_timeout = 120
+            idle = self.pool.get('fe80::1', 5000)
+            self.pool.release(idle)
+            active = self.pool.get('fe80::2', 5000)
+            self.pool.release(active)
+            self.assertIs(active, self.pool.get('fe80::2', 5000))
+        self.assertTrue(idle.close.called)
+        self.assertFalse(active.close.called)
+
+    @mock.patch.object(astara_client, 'time')
+    def test_idle_session_in_use_not_closed(self, fake_time):
+        fake_time.time.side_effect = [100, 230]
+        with mock.patch.object(astara_client, 'CONF') as conf:
+            conf.appliance_session_pool_size = 10
+            conf.appliance_session_idle_timeout = 120
+            slow = self.pool.get('fe80::1', 5000)
+            self.pool.get('fe80::2', 5000)
+        self.assertFalse(slow.close.called)
+        self.pool.release(slow)
+        self.assertTrue(slow.close.called)
@@ -36,3 +36,16 @@ class KeystoneTest(base.RugTestBase):
         mock_load_auth.assert_called_with(cfg.CONF, 'keystone_authtoken')
         mock_session.assert_called_with(auth=fake_auth)
         self.assertEqual(ks_session, fake_session)
+
+    @mock.patch('astara.api.keystone.metrics')
+    @mock.patch('keystoneclient.session.Session')
+    @mock.patch('keystoneclient.auth.load_from_conf_options')
+    def test_session_timed(self, mock_load_auth, mock_session, metrics):
+        fake_session = mock.Mock()
+        request = fake_session.request
+        mock_session.return_value = fake_session
+        ks_session = keystone.KeystoneSession(service='nova').session
+        resp = ks_session.request('/servers', 'GET', raise_exc=False)
+        request.assert_called_once_with('/servers', 'GET', raise_exc=False)
+        metrics.timed_call.assert_called_once_with('nova', 'GET')
+        self.assertEqual(request.return_value, resp)
@@ -352,6 +352,64 @@ class TestNeutronWrapper(base.RugTestBase):
                 'the_net_id'
             )
 
+    @mock.patch('astara.api.neutron.AstaraExtClientWrapper')
+    def test_create_management_ports(self, client_wrapper):
+        conf = mock.Mock()
+        conf.management_network_id = 'mgt_net_id'
+        conf.neutron_port_security_extension_enabled = False
+        neutron_wrapper = neutron.Neutron(conf)
+        api_client = neutron_wrapper.api_client
+        with mock.patch.object(api_client, 'create_port') as create_port:
+            with mock.patch.object(neutron.Port, 'from_dict') as port_from_d:
+                create_port.return_value = {'ports': ['p1', 'p2']}
+                retval = neutron_wrapper.create_management_ports('obj_id', 2)
+                self.assertEqual([port_from_d.return_value] * 2, retval)
+                port_data = {
+                    'name': 'ASTARA:MGT:obj_id',
+                    'admin_state_up': True,
+                    'network_id': 'mgt_net_id',
+                    'fixed_ips': [],
+                    'security_groups': []
+                }
+                create_port.assert_called_once_with(
+                    {'ports': [port_data, port_data]})
+
+    @mock.patch('astara.api.neutron.AstaraExtClientWrapper')
+    def test_create_management_ports_error(self, client_wrapper):
+        neutron_wrapper = neutron.Neutron(mock.Mock())
+        api_client = neutron_wrapper.api_client
+        with mock.patch.object(api_client, 'create_port') as create_port:
+            create_port.return_value = {'ports': []}
+            self.assertRaises(
+                ValueError,
+                neutron_wrapper.create_management_ports,
+                'obj_id',
+                2
+            )
+        self.assertEqual([], neutron_wrapper.create_management_ports('id', 0))
+
+    @mock.patch('astara.api.neutron.AstaraExtClientWrapper')
+    def test_create_vrrp_ports(self, client_wrapper):
+        conf = mock.Mock()
+        conf.neutron_port_security_extension_enabled = False
+        neutron_wrapper = neutron.Neutron(conf)
+        api_client = neutron_wrapper.api_client
+        with mock.patch.object(api_client, 'create_port') as create_port:
+            with mock.patch.object(neutron.Port, 'from_dict') as port_from_d:
+                create_port.return_value = {'ports': ['p1', 'p2', 'p3']}
+                retval = neutron_wrapper.create_vrrp_ports(
+                    'obj_id', 'ext_net_id', 3)
+                self.assertEqual([port_from_d.return_value] * 3, retval)
+                port_data = {
+                    'name': 'ASTARA:VRRP:obj_id',
+                    'admin_state_up': True,
+                    'network_id': 'ext_net_id',
+                    'fixed_ips': [],
+                    'security_groups': []
+                }
+                create_port.assert_called_once_with(
+                    {'ports': [port_data] * 3})
+
     @mock.patch('astara.api.neutron.AstaraExtClientWrapper')
     def test_delete_vrrp_ports(self, client_wrapper):
         conf = mock.Mock()
@@ -386,6 +444,447 @@ class TestNeutronWrapper(base.RugTestBase):
         )
         self.assertFalse(neutron_wrapper.api_client.delete_port.called)
 
+    @mock.patch('astara.api.neutron.AstaraExtClientWrapper')
+    def test_get_ports_for_instances(self, client_wrapper):
+        def _port(id_, device_id, network_id):
+            return {
+                'id': id_,
+                'device_id': device_id,
+                'fixed_ips': [],
+                'mac_address': 'aa:bb:cc:dd:ee:ff',
+                'network_id': network_id,
+                'device_owner': 'compute:None',
+                'name': id_,
+            }
+        api_client = client_wrapper.return_value
+        api_client.list_ports.return_value = {'ports': [
+            _port('mgt1', 'inst1', 'mgt-net'),
+            _port('int1', 'inst1', 'int-net'),
+            _port('int2', 'inst2', 'int-net'),
+        ]}
+        neutron_wrapper = neutron.Neutron(
+            mock.Mock(management_network_id='mgt-net'))
+        ports = neutron_wrapper.get_ports_for_instances(
+            ['inst1', 'inst2', 'inst3'])
+
+        self.assertEqual(1, api_client.list_ports.call_count)
+        self.assertEqual(
+            ['inst1', 'inst2', 'inst3'],
+            sorted(api_client.list_ports.call_args[1]['device_id']))
+        self.assertEqual('mgt1', ports['inst1'][0].id)
+        self.assertEqual(['int1'], [p.id for p in ports['inst1'][1]])
+        self.assertIsNone(ports['inst2'][0])
+        self.assertEqual(['int2'], [p.id for p in ports['inst2'][1]])
+        self.assertEqual((None, []), ports['inst3'])
+
+    @mock.patch('astara.api.neutron.AstaraExtClientWrapper')
+    def test_get_network_details(self, client_wrapper):
+        api_client = client_wrapper.return_value
+        api_client.list_networks.return_value = {'networks': [{
+            'id': 'net1',
+            'name': 'net1',
+            'tenant_id': 'tenant_id',
+            'status': 'ACTIVE',
+            'shared': False,
+            'admin_state_up': True,
+        }]}
+        api_client.list_subnets.return_value = {'subnets': [{
+            'id': 'sub1',
+            'name': 'sub1',
+            'tenant_id': 'tenant_id',
+            'network_id': 'net1',
+            'ip_version': 4,
+            'cidr': '10.0.0.0/24',
+            'gateway_ip': '10.0.0.1',
+            'enable_dhcp': True,
+            'dns_nameservers': [],
+            'host_routes': [],
+            'ipv6_ra_mode': None,
+        }, {
+            'id': 'bad',
+            'network_id': 'net1',
+        }]}
+        neutron_wrapper = neutron.Neutron(mock.Mock())
+        networks = neutron_wrapper.get_network_details(['net1', 'gone'])
+
+        self.assertEqual(['net1'], list(networks))
+        self.assertEqual(['sub1'], [s.id for s in networks['net1'].subnets])
+        ids = api_client.list_networks.call_args[1]['id']
+        self.assertEqual(['gone', 'net1'], sorted(ids))
+        self.assertEqual(1, api_client.list_subnets.call_count)
+
+    @mock.patch('astara.api.neutron.AstaraExtClientWrapper')
+    def test_get_ports_for_networks(self, client_wrapper):
+        api_client = client_wrapper.return_value
+        api_client.list_ports.return_value = {'ports': [{
+            'id': 'port1',
+            'device_id': 'device1',
+            'fixed_ips': [],
+            'mac_address': 'aa:bb:cc:dd:ee:ff',
+            'network_id': 'net1',
+            'device_owner': 'network:router_interface',
+            'name': 'port1',
+        }]}
+        neutron_wrapper = neutron.Neutron(mock.Mock())
+        ports = neutron_wrapper.get_ports_for_networks(['net1', 'net2'])
+
+        self.assertEqual(['port1'], [p.id for p in ports['net1']])
+        self.assertEqual([], ports['net2'])
+        self.assertEqual(1, api_client.list_ports.call_count)
+
+
+class TestResponseCache(base.RugTestBase):
+    def setUp(self):
+        super(TestResponseCache, self).setUp()
+        self.config(neutron_cache_ttl=10)
+        self.cache = neutron.ResponseCache()
+        self.fetch = mock.Mock(side_effect=lambda key: mock.Mock(ports=[]))
+
+    def _cache_router(self, router_id='router1', network_id='net1'):
+        router = mock.Mock(ports=[mock.Mock(network_id=network_id)])
+        self.cache.get('router', router_id, mock.Mock(return_value=router))
+        return router
+
+    def test_get_caches(self):
+        value = self.cache.get('network', 'a', self.fetch)
+        self.assertIs(value, self.cache.get('network', 'a', self.fetch))
+        self.fetch.assert_called_once_with('a')
+        self.assertEqual((1, 1), (self.cache.hits, self.cache.misses))
+
+    @mock.patch('astara.api.neutron.time')
+    def test_get_expired(self, fake_time):
+        fake_time.time.side_effect = [100, 111]
+        self.cache.get('network', 'a', self.fetch)
+        self.cache.get('network', 'a', self.fetch)
+        self.assertEqual(2, self.fetch.call_count)
+
+    @mock.patch('astara.api.neutron.time')
+    def test_expired_entries_pruned(self, fake_time):
+        fake_time.time.side_effect = [100, 105, 111]
+        self._cache_router('router1', 'net1')
+        self._cache_router('router2', 'net2')
+        self.cache.get('network', 'a', self.fetch)
+        self.assertEqual([('network', 'a'), ('router', 'router2')],
+                         sorted(self.cache._entries))
+        self.assertEqual({'net2': set(['router2'])},
+                         dict(self.cache._routers_by_network))
+
+    def test_get_disabled(self):
+        self.config(neutron_cache_ttl=0)
+        self.cache.get('network', 'a', self.fetch)
+        self.cache.get('network', 'a', self.fetch)
+        self.assertEqual(2, self.fetch.call_count)
+
+    def test_get_error_not_cached(self):
+        router = mock.Mock(ports=[])
+        self.fetch.side_effect = [neutron.RouterGone(), router]
+        self.assertRaises(neutron.RouterGone,
+                          self.cache.get, 'router', 'r', self.fetch)
+        self.assertIs(router, self.cache.get('router', 'r', self.fetch))
+        self.assertEqual({}, self.cache._fetches)
+
+    def test_get_invalidated_during_fetch_not_cached(self):
+        def fetch(key):
+            self.cache.invalidate_router(key)
+            return mock.Mock(ports=[])
+        self.cache.get('router', 'router1', fetch)
+        self.cache.get('router', 'router1', self.fetch)
+        self.fetch.assert_called_once_with('router1')
+
+    def test_get_other_invalidated_during_fetch_cached(self):
+        def fetch(key):
+            self.cache.invalidate_router('router2')
+            return mock.Mock(ports=[])
+        self.cache.get('router', 'router1', fetch)
+        self.cache.get('router', 'router1', self.fetch)
+        self.assertFalse(self.fetch.called)
+
+    def test_get_router_network_invalidated_during_fetch(self):
+        def fetch(key):
+            self.cache.invalidate_network('net1')
+            return mock.Mock(ports=[mock.Mock(network_id='net1')])
+        self.cache.get('router', 'router1', fetch)
+        self.cache.get('router', 'router1', self.fetch)
+        self.fetch.assert_called_once_with('router1')
+
+    def test_get_router_other_network_invalidated_during_fetch(self):
+        def fetch(key):
+            self.cache.invalidate_network('net2')
+            return mock.Mock(ports=[mock.Mock(network_id='net1')])
+        self.cache.get('router', 'router1', fetch)
+        self.cache.get('router', 'router1', self.fetch)
+        self.assertFalse(self.fetch.called)
+
+    def test_get_many_invalidated_during_fetch_not_cached(self):
+        def fetch_many(keys):
+            self.cache.invalidate_network('a')
+            return dict((k, 'net-' + k) for k in keys)
+        self.cache.get_many('network', ['a', 'b'], fetch_many)
+        self.cache.get('network', 'a', self.fetch)
+        self.cache.get('network', 'b', self.fetch)
+        self.fetch.assert_called_once_with('a')
+
+    def test_get_many_fetches_missing_once(self):
+        self.cache.get('network', 'a', self.fetch)
+        fetch_many = mock.Mock(
+            side_effect=lambda keys: dict((k, 'net-' + k) for k in keys))
+        result = self.cache.get_many('network', ['a', 'b', 'c'], fetch_many)
+        fetch_many.assert_called_once_with(['b', 'c'])
+        self.assertEqual(['a', 'b', 'c'], sorted(result))
+        self.assertEqual('net-b', self.cache.get('network', 'b', self.fetch))
+        self.assertEqual(1, self.fetch.call_count)
+
+    def test_get_many_all_cached(self):
+        self.cache.get('network', 'a', self.fetch)
+        fetch_many = mock.Mock()
+        self.assertEqual(['a'], list(
+            self.cache.get_many('network', ['a'], fetch_many)))
+        self.assertFalse(fetch_many.called)
+
+    def test_get_many_disabled(self):
+        self.config(neutron_cache_ttl=0)
+        fetch_many = mock.Mock(return_value={'a': 'net-a'})
+        self.cache.get_many('network', ['a'], fetch_many)
+        self.cache.get_many('network', ['a'], fetch_many)
+        self.assertEqual(2, fetch_many.call_count)
+
+    def test_invalidate_network_drops_routers(self):
+        self._cache_router()
+        for kind in ('network', 'subnets', 'ports'):
+            self.cache.get(kind, 'net1', self.fetch)
+        self.cache.invalidate_network('net1')
+        for kind in ('network', 'subnets', 'ports', 'router'):
+            self.cache.get(kind, 'router1' if kind == 'router' else 'net1',
+                           self.fetch)
+        # three initial fetches, then all four entries are fetched again
+        self.assertEqual(7, self.fetch.call_count)
+
+    def test_invalidate_for_port_payload(self):
+        self._cache_router(router_id='router1', network_id='net9')
+        self.cache.get('ports', 'net1', self.fetch)
+        self.cache.get('ports', 'net2', self.fetch)
+        self.cache.invalidate_for_payload(
+            {'port': {'network_id': 'net1', 'device_id': 'router1'}})
+        self.cache.get('ports', 'net1', self.fetch)
+        self.cache.get('ports', 'net2', self.fetch)
+        self.cache.get('router', 'router1', self.fetch)
+        self.assertEqual(
+            [mock.call('net1'), mock.call('net2'),
+             mock.call('net1'), mock.call('router1')],
+            self.fetch.call_args_list)
+
+    def test_invalidate_for_router_payloads(self):
+        payloads = [
+            {'router': {'id': 'router1'}},
+            {'router.interface': {'id': 'router1'}},
+            {'router_id': 'router1'},
+            {'floatingip': {'router_id': 'router1'}},
+        ]
+        for payload in payloads:
+            self._cache_router()
+            self.cache.invalidate_for_payload(payload)
+            self.cache.get('router', 'router1', self.fetch)
+        self.assertEqual(4, self.fetch.call_count)
+
+    def _cache_router_with_fip(self, router_id, tenant_id, fip_id=None):
+        router = mock.Mock(
+            ports=[mock.Mock(id='port-' + router_id, network_id='net1',
+                             fixed_ips=[mock.Mock(subnet_id='subnet1')])],
+            floating_ips=[mock.Mock(id=fip_id)] if fip_id else [],
+            tenant_id=tenant_id)
+        self.cache.get('router', router_id, mock.Mock(return_value=router))
+
+    def _refetched_routers(self, *router_ids):
+        self.fetch.reset_mock()
+        for router_id in router_ids:
+            self.cache.get('router', router_id, self.fetch)
+        return [c[0][0] for c in self.fetch.call_args_list]
+
+    def test_invalidate_for_floatingip_delete_payload(self):
+        self._cache_router_with_fip('router1', 't1', fip_id='fip1')
+        self._cache_router_with_fip('router2', 't1')
+        self.cache.invalidate_for_payload({'floatingip_id': 'fip1'}, 't1')
+        self.assertEqual(['router1'],
+                         self._refetched_routers('router1', 'router2'))
+
+    def test_invalidate_for_floatingip_disassociate_payload(self):
+        self._cache_router_with_fip('router1', 't1', fip_id='fip1')
+        self._cache_router_with_fip('router2', 't1')
+        self.cache.invalidate_for_payload(
+            {'floatingip': {'id': 'fip1', 'router_id': None}}, 't1')
+        self.assertEqual(['router1'],
+                         self._refetched_routers('router1', 'router2'))
+
+    def test_invalidate_for_delete_payload_falls_back_to_tenant(self):
+        self._cache_router_with_fip('router1', 't1')
+        self._cache_router_with_fip('router2', 't2')
+        self.cache.invalidate_for_payload({'floatingip_id': 'fip1'}, 't1')
+        self.assertEqual(['router1'],
+                         self._refetched_routers('router1', 'router2'))
+
+    def test_invalidate_for_port_delete_payload(self):
+        self._cache_router_with_fip('router1', 't1')
+        self._cache_router_with_fip('router2', 't1')
+        self.cache.invalidate_for_payload({'port_id': 'port-router2'})
+        self.assertEqual(['router2'],
+                         self._refetched_routers('router1', 'router2'))
+
+    def test_invalidate_for_subnet_delete_payload(self):
+        self._cache_router_with_fip('router1', 't1')
+        self._cache_router_with_fip('router2', 't1')
+        self.cache.invalidate_for_payload({'subnet_id': 'subnet1'})
+        self.assertEqual(['router1', 'router2'],
+                         self._refetched_routers('router1', 'router2'))
+
+    def test_invalidate_for_network_delete_payload(self):
+        self._cache_router()
+        self.cache.invalidate_for_payload({'network_id': 'net1'})
+        self.assertEqual(['router1'], self._refetched_routers('router1'))
+
+    def test_invalidate_for_coalesced_payloads(self):
+        self.cache.get('ports', 'net1', self.fetch)
+        self.cache.get('ports', 'net2', self.fetch)
+        self.cache.invalidate_for_payload({
+            'port': {'network_id': 'net2'},
+            'coalesced_payloads': [{'port': {'network_id': 'net1'}}],
+        })
+        self.cache.get('ports', 'net1', self.fetch)
+        self.cache.get('ports', 'net2', self.fetch)
+        self.assertEqual(4, self.fetch.call_count)
+
+    def test_invalidate_for_payload_none(self):
+        self.cache.invalidate_for_payload(None)
+
+    @mock.patch('astara.api.neutron.AstaraExtClientWrapper')
+    @mock.patch('astara.api.neutron.L3PluginApi')
+    def test_neutron_get_router_detail_cached(self, l3_api, client_wrapper):
+        l3_api.return_value.get_routers.return_value = [{
+            'id': 'router1',
+            'tenant_id': 'tenant_id',
+            'name': 'name',
+            'admin_state_up': True,
+            'status': 'ACTIVE',
+        }]
+        neutron_wrapper = neutron.Neutron(mock.Mock(), cache=self.cache)
+        router = neutron_wrapper.get_router_detail('router1')
+        self.assertIs(router, neutron_wrapper.get_router_detail('router1'))
+        self.assertEqual(1, l3_api.return_value.get_routers.call_count)
+
+        neutron_wrapper.update_router_status('router1', 'ACTIVE')
+        neutron_wrapper.get_router_detail('router1')
+        self.assertEqual(2, l3_api.return_value.get_routers.call_count)
+
+
+class TestStatusWriter(base.RugTestBase):
+    def setUp(self):
+        super(TestStatusWriter, self).setUp()
+        self.writer = neutron.StatusWriter()
+        # the flush thread would race with the flushes of the tests
+        self.writer._thread = mock.Mock(is_alive=mock.Mock(return_value=True))
+        self.client = mock.Mock()
+        self.writer._client = self.client
+
+    def test_flush_keeps_latest_status(self):
+        for status in ('DOWN', 'BUILD', 'ACTIVE'):
+            self.writer.set_status('router', 'r1', status)
+        self.writer.set_status('loadbalancer', 'lb1', 'ERROR')
+        self.writer.set_status('router', 'r2', 'BUILD')
+        self.writer.flush()
+
+        self.assertEqual(
+            [mock.call('r1', 'ACTIVE'), mock.call('r2', 'BUILD')],
+            self.client.update_router_status.call_args_list)
+        self.client.update_loadbalancer_status.assert_called_once_with(
+            'lb1', 'ERROR')
+        self.assertEqual((3, 2), (self.writer.written, self.writer.coalesced))
+
+        self.client.reset_mock()
+        self.writer.flush()
+        self.assertFalse(self.client.update_router_status.called)
+
+    def test_flush_requeues_unwritten(self):
+        self.client.update_router_status.side_effect = [
+            None, Exception('boom')]
+        for router_id in ('r1', 'r2', 'r3'):
+            self.writer.set_status('router', router_id, 'BUILD')
+        self.assertRaises(Exception, self.writer.flush)
+        self.writer.set_status('router', 'r4', 'BUILD')
+        self.writer.set_status('router', 'r3', 'ACTIVE')
+
+        self.client.reset_mock()
+        self.client.update_router_status.side_effect = None
+        self.writer.flush()
+        self.assertEqual(
+            [mock.call('r2', 'BUILD'), mock.call('r3', 'ACTIVE'),
+             mock.call('r4', 'BUILD')],
+            self.client.update_router_status.call_args_list)
+
+    def test_flush_requeues_without_client(self):
+        self.writer._client = None
+        self.writer.set_status('router', 'r1', 'ACTIVE')
+        with mock.patch.object(neutron, 'Neutron') as client:
+            client.side_effect = Exception('boom')
+            self.assertRaises(Exception, self.writer.flush)
+        self.writer._client = self.client
+        self.writer.flush()
+        self.client.update_router_status.assert_called_once_with(
+            'r1', 'ACTIVE')
+
+    @mock.patch('astara.api.neutron.AstaraExtClientWrapper')
+    def test_cached_router_dropped_once_written(self, client_wrapper):
+        self.config(neutron_status_flush_interval=1)
+        api_client = client_wrapper.return_value
+        cache = mock.Mock()
+        cache.invalidate_router.side_effect = (
+            lambda router_id: self.assertTrue(
+                api_client.update_router_status.called))
+        neutron_wrapper = neutron.Neutron(
+            mock.Mock(), cache=cache, status_writer=self.writer)
+        self.writer._client = neutron.Neutron(mock.Mock(), cache=cache)
+
+        neutron_wrapper.update_router_status('r1', 'ACTIVE')
+        self.assertFalse(cache.invalidate_router.called)
+        self.writer.flush()
+        cache.invalidate_router.assert_called_once_with('r1')
+
+    def test_flush_thread_started(self):
+        self.writer._thread = None
+        with mock.patch.object(neutron.threading, 'Thread') as thread:
+            self.writer.set_status('router', 'r1', 'ACTIVE')
+            self.writer.set_status('router', 'r1', 'DOWN')
+        thread.assert_called_once_with(
+            target=self.writer._run, name='NeutronStatusWriter')
+        thread.return_value.start.assert_called_once_with()
+
+    @mock.patch('astara.api.neutron.AstaraExtClientWrapper')
+    def test_neutron_status_deferred(self, client_wrapper):
+        self.config(neutron_status_flush_interval=1)
+        neutron_wrapper = neutron.Neutron(mock.Mock(),
+                                          status_writer=self.writer)
+        neutron_wrapper.update_router_status('r1', 'ACTIVE')
+        neutron_wrapper.update_loadbalancer_status('lb1', 'ACTIVE')
+        self.assertFalse(
+            client_wrapper.return_value.update_router_status.called)
+        self.assertFalse(
+            client_wrapper.return_value.update_loadbalancer_status.called)
+        self.writer.flush()
+        self.client.update_router_status.assert_called_once_with(
+            'r1', 'ACTIVE')
+        self.client.update_loadbalancer_status.assert_called_once_with(
+            'lb1', 'ACTIVE')
+
+    @mock.patch('astara.api.neutron.AstaraExtClientWrapper')
+    def test_neutron_status_immediate(self, client_wrapper):
+        self.config(neutron_status_flush_interval=0)
+        neutron_wrapper = neutron.Neutron(mock.Mock(),
+                                          status_writer=self.writer)
+        neutron_wrapper.update_router_status('r1', 'ACTIVE')
+        api_client = client_wrapper.return_value
+        api_client.update_router_status.assert_called_once_with(
+            'r1', 'ACTIVE')
+        self.writer.flush()
+        self.assertFalse(self.client.update_router_status.called)
+
 
 class TestLocalServicePorts(base.RugTestBase):
     def setUp(self):
@@ -42,17 +42,20 @@ class FakeModel(object):
 
 fake_ext_port = FakeModel(
     '1',
+    name='ASTARA:VRRP:router_id',
     mac_address='aa:bb:cc:dd:ee:ff',
     network_id='ext-net',
     fixed_ips=[FakeModel('', ip_address='9.9.9.9', subnet_id='s2')])
 
 fake_mgt_port = FakeModel(
     '2',
+    name='ASTARA:MGT:router_id',
     mac_address='aa:bb:cc:cc:bb:aa',
     network_id='mgt-net')
 
 fake_int_port = FakeModel(
     '3',
+    name='ASTARA:VRRP:router_id',
     mac_address='aa:aa:aa:aa:aa:aa',
     network_id='int-net',
     fixed_ips=[FakeModel('', ip_address='192.168.1.1', subnet_id='s1')])
@@ -192,6 +195,47 @@ class TestNovaWrapper(base.RugTestBase):
         result = self.nova.get_instance_by_id('instance_id')
         self.assertIsNone(result)
 
+    def _ha_instance_infos(self):
+        return [
+            nova.InstanceInfo(instance_id='id_%d' % i,
+                              name='ak-router-foo_%d' % i)
+            for i in range(2)
+        ]
+
+    @mock.patch('time.sleep')
+    def test_delete_instances_and_wait(self, fake_sleep):
+        instances = self._ha_instance_infos()
+        self.client.servers.list.side_effect = [
+            [FakeModel('id_0'), FakeModel('id_1')],
+            [],
+        ]
+        self.nova.delete_instances_and_wait(instances)
+        self.assertEqual(
+            [mock.call('id_0'), mock.call('id_1')],
+            self.client.servers.delete.call_args_list)
+        self.client.servers.list.assert_called_with(
+            search_opts={'name': '^ak-router-foo_.*$'})
+        self.assertEqual(2, self.client.servers.list.call_count)
+        self.assertEqual(1, fake_sleep.call_count)
+        self.assertFalse(self.client.servers.get.called)
+
+    @mock.patch('time.sleep')
+    def test_delete_instances_and_wait_single(self, fake_sleep):
+        self.client.servers.get.side_effect = [
+            'instance', novaclient_exceptions.NotFound('fake_instance_id')]
+        self.nova.delete_instances_and_wait([self.INSTANCE_INFO])
+        self.assertEqual(2, self.client.servers.get.call_count)
+        self.assertFalse(self.client.servers.list.called)
+
+    @mock.patch.object(nova, 'time')
+    def test_delete_instances_and_wait_timeout(self, fake_time):
+        self.config(boot_timeout=10)
+        fake_time.time.side_effect = [0, 0, 11]
+        self.client.servers.list.return_value = [FakeModel('id_0')]
+        self.assertRaises(nova.NovaInstanceDeleteTimeout,
+                          self.nova.delete_instances_and_wait,
+                          self._ha_instance_infos())
+
     def test_destroy_instance(self):
         self.nova.destroy_instance(self.INSTANCE_INFO)
         self.client.servers.delete.assert_called_with(self.INSTANCE_INFO.id_)
@@ -384,6 +428,109 @@ class TestNovaWrapper(base.RugTestBase):
         self.assertIsNotNone(self.nova.instance_provider.create_instance)
 
 
+class TestServerIndex(base.RugTestBase):
+    def setUp(self):
+        super(TestServerIndex, self).setUp()
+        self.config(nova_server_index_ttl=10)
+        self.client = mock.Mock()
+        self.client.servers.list.return_value = [
+            FakeModel('id_a0', name='ak-router-a_0'),
+            FakeModel('id_a1', name='ak-router-a_1'),
+            FakeModel('id_b0', name='ak-router-b_0'),
+        ]
+        self.get_server = mock.Mock(return_value=None)
+        self.index = nova.ServerIndex()
+
+    def _find(self, prefix):
+        return sorted(s.id for s in self.index.find(
+            self.client, prefix, self.get_server))
+
+    def test_find_by_prefix(self):
+        self.assertEqual(['id_a0', 'id_a1'], self._find('ak-router-a'))
+        self.assertEqual(['id_b0'], self._find('ak-router-b'))
+        self.assertEqual([], self._find('ak-router-c'))
+        self.client.servers.list.assert_called_once_with(
+            detailed=True, marker=None, limit=nova.SERVER_INDEX_PAGE_SIZE)
+
+    @mock.patch.object(nova, 'time')
+    def test_rebuilt_after_ttl(self, fake_time):
+        fake_time.time.side_effect = [100, 105, 111]
+        for i in range(3):
+            self._find('ak-router-a')
+        self.assertEqual(2, self.index.rebuilds)
+
+    @mock.patch.object(nova, 'SERVER_INDEX_PAGE_SIZE', 2)
+    def test_paginated(self):
+        servers = self.client.servers.list.return_value
+        self.client.servers.list.side_effect = [servers[:2], servers[2:]]
+        self.assertEqual(['id_b0'], self._find('ak-router-b'))
+        self.assertEqual(
+            mock.call(detailed=True, marker='id_a1', limit=2),
+            self.client.servers.list.call_args)
+
+    def test_booted_since_rebuild(self):
+        self._find('ak-router-a')
+        new_server = FakeModel('id_c0', name='ak-router-c_0')
+        self.get_server.return_value = new_server
+        self.index.add_booted('id_c0', 'ak-router-c_0')
+        self.assertEqual(['id_a0', 'id_a1'], self._find('ak-router-a'))
+        self.assertFalse(self.get_server.called)
+        self.assertEqual(['id_c0'], self._find('ak-router-c'))
+        self.get_server.assert_called_once_with('id_c0')
+
+    def test_booted_renamed_from_pool(self):
+        self._find('ak-router-a')
+        renamed = FakeModel('id_b0', name='ak-router-c_0')
+        self.get_server.return_value = renamed
+        self.index.add_booted('id_b0', 'ak-router-c_0')
+        self.assertEqual([], self._find('ak-router-b'))
+        self.assertEqual(['id_b0'], self._find('ak-router-c'))
+        self.get_server.assert_called_once_with('id_b0')
+
+    def test_forget(self):
+        self._find('ak-router-a')
+        self.index.forget('id_a1')
+        self.assertEqual(['id_a0'], self._find('ak-router-a'))
+
+    def test_update(self):
+        self._find('ak-router-a')
+        fetched = FakeModel('id_a0', name='ak-router-a_0', status='ACTIVE')
+        self.index.update(fetched)
+        self.index.update(FakeModel('id_c0', name='ak-router-c_0'))
+        self.assertIn(fetched, self.index.find(
+            self.client, 'ak-router-a', self.get_server))
+        self.assertEqual([], self._find('ak-router-c'))
+
+    @mock.patch('novaclient.client.Client')
+    @mock.patch.object(nova, 'get_instance_provider')
+    def test_nova_uses_index(self, get_provider, client_cls):
+        client_cls.return_value = self.client
+        self.client.servers.list.return_value = [FakeNovaServer()]
+        nova_client = nova.Nova(FakeConf, server_index=self.index)
+        result = nova_client.get_instances_for_obj('ak-796aafbc')
+        self.assertEqual([FakeNovaServer.id], [i.id_ for i in result])
+        nova_client.get_instances_for_obj('ak-796aafbc')
+        self.assertEqual(1, self.client.servers.list.call_count)
+
+        nova_client.destroy_instance(result[0])
+        self.assertEqual([], nova_client.get_instances_for_obj('ak-796aafbc'))
+
+    @mock.patch('novaclient.client.Client')
+    @mock.patch.object(nova, 'get_instance_provider')
+    def test_nova_get_instance_by_id_updates_index(self, get_provider,
+                                                   client_cls):
+        client_cls.return_value = self.client
+        nova_client = nova.Nova(FakeConf, server_index=self.index)
+        self._find('ak-router-a')
+        fetched = FakeModel('id_a0', name='ak-router-a_0', status='ERROR')
+        self.client.servers.get.side_effect = [
+            fetched, novaclient_exceptions.NotFound('id_a1')]
+        nova_client.get_instance_by_id('id_a0')
+        self.assertIsNone(nova_client.get_instance_by_id('id_a1'))
+        self.assertEqual([fetched], self.index.find(
+            self.client, 'ak-router-a', self.get_server))
+
+
 class TestOnDemandInstanceProvider(base.RugTestBase):
     def setUp(self):
         super(TestOnDemandInstanceProvider, self).setUp()
@@ -473,9 +620,12 @@ class TestPezInstanceProvider(base.RugTestBase):
             1, fake_make_ports_callback)
         self.rpc_client.get_instance.assert_called_with(
             'router', 'ak-instance-name',
-            {'network_id': 'mgt-net', 'id': '2'},
-            [{'network_id': 'ext-net', 'id': '1'},
-             {'network_id': 'int-net', 'id': '3'}])
+            {'network_id': 'mgt-net', 'id': '2',
+             'name': 'ASTARA:MGT:router_id'},
+            [{'network_id': 'ext-net', 'id': '1',
+              'name': 'ASTARA:VRRP:router_id'},
+             {'network_id': 'int-net', 'id': '3',
+              'name': 'ASTARA:VRRP:router_id'}])
         self.nova_client.servers.get.assert_called_with(fake_server.id)
         exp_instance_info = nova.InstanceInfo.from_nova(fake_server)
         self.assertEqual(exp_instance_info.id_, res.id_)
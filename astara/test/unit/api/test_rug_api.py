@@ -157,6 +157,26 @@ class TestRugAPI(unittest.TestCase):
         assert isinstance(resp, webob.exc.HTTPMethodNotAllowed)
         assert not self.ctl.run.called
 
+    def test_metrics(self):
+        aggregator = mock.Mock()
+        aggregator.render.return_value = 'astara_state_machines 1\n'
+        api = rug.RugAPI(mock.Mock(), aggregator=aggregator)
+        resp = api(webob.Request({
+            'REQUEST_METHOD': 'GET',
+            'PATH_INFO': '/metrics'
+        }))
+        assert resp.status_int == 200
+        assert resp.body == b'astara_state_machines 1\n'
+        assert resp.headers['Content-Type'].startswith('text/plain')
+        assert not self.ctl.run.called
+
+    def test_metrics_not_collected(self):
+        resp = self.api(webob.Request({
+            'REQUEST_METHOD': 'GET',
+            'PATH_INFO': '/metrics'
+        }))
+        assert isinstance(resp, webob.exc.HTTPNotFound)
+
 
 class TestRugAPIServer(unittest.TestCase):
 
@@ -0,0 +1,104 @@
+# Copyright (c) 2016 Akanda, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import mock
+
+from astara.common import debug_cache
+from astara.test.unit import base
+
+
+class TestDebugModeCache(base.RugTestBase):
+    def setUp(self):
+        super(TestDebugModeCache, self).setUp()
+        self.db_api = mock.Mock()
+        self.db_api.global_debug.return_value = (False, None)
+        self.db_api.tenants_in_debug.return_value = set([
+            ('tenant1', 'tenant reason'),
+        ])
+        self.db_api.resources_in_debug.return_value = set([
+            ('resource1', 'resource reason'),
+        ])
+        self.time = mock.patch.object(debug_cache, 'time').start()
+        self.time.time.return_value = 100
+        self.addCleanup(mock.patch.stopall)
+        self.cache = debug_cache.DebugModeCache(self.db_api, 10)
+
+    def test_lookups(self):
+        self.assertEqual((False, None), self.cache.global_debug())
+        self.assertEqual((True, 'tenant reason'),
+                         self.cache.tenant_in_debug('tenant1'))
+        self.assertEqual((False, None), self.cache.tenant_in_debug('tenant2'))
+        self.assertEqual((True, 'resource reason'),
+                         self.cache.resource_in_debug('resource1'))
+        self.assertEqual((False, None),
+                         self.cache.resource_in_debug('resource2'))
+        self.assertEqual(1, self.db_api.tenants_in_debug.call_count)
+        self.assertFalse(self.db_api.tenant_in_debug.called)
+        self.assertFalse(self.db_api.resource_in_debug.called)
+        self.assertEqual(1, self.cache.version)
+
+    def test_reload_after_interval(self):
+        self.cache.global_debug()
+        self.time.time.return_value = 109
+        self.cache.global_debug()
+        self.assertEqual(1, self.db_api.global_debug.call_count)
+        self.db_api.global_debug.return_value = (True, 'maintenance')
+        self.time.time.return_value = 110
+        self.assertEqual((True, 'maintenance'), self.cache.global_debug())
+        self.assertEqual(2, self.cache.version)
+
+    def test_invalidate(self):
+        self.cache.resource_in_debug('resource2')
+        self.db_api.resources_in_debug.return_value = set([
+            ('resource2', None),
+        ])
+        self.cache.invalidate()
+        self.assertEqual((True, None),
+                         self.cache.resource_in_debug('resource2'))
+        self.assertEqual((False, None),
+                         self.cache.resource_in_debug('resource1'))
+
+    def test_reload_error_keeps_snapshot(self):
+        self.cache.tenant_in_debug('tenant1')
+        self.db_api.global_debug.side_effect = Exception('db is down')
+        self.cache.invalidate()
+        self.assertEqual((True, 'tenant reason'),
+                         self.cache.tenant_in_debug('tenant1'))
+        self.assertEqual(1, self.cache.version)
+
+    def test_reload_error_backs_off(self):
+        self.cache.global_debug()
+        self.db_api.global_debug.side_effect = Exception('db is down')
+        self.time.time.return_value = 110
+        self.cache.global_debug()
+        self.time.time.return_value = 119
+        self.cache.global_debug()
+        self.assertEqual(2, self.db_api.global_debug.call_count)
+
+        self.db_api.global_debug.side_effect = None
+        self.db_api.global_debug.return_value = (True, 'maintenance')
+        self.time.time.return_value = 120
+        self.assertEqual((True, 'maintenance'), self.cache.global_debug())
+        self.assertEqual(2, self.cache.version)
+
+    def test_initial_load_error(self):
+        self.db_api.global_debug.side_effect = Exception('db is down')
+        self.assertRaises(Exception, self.cache.global_debug)
+
+    def test_disabled(self):
+        cache = debug_cache.DebugModeCache(self.db_api, 0)
+        self.db_api.tenant_in_debug.return_value = (True, 'reason')
+        self.assertEqual((True, 'reason'), cache.tenant_in_debug('tenant3'))
+        self.db_api.tenant_in_debug.assert_called_once_with('tenant3')
+        self.assertFalse(self.db_api.tenants_in_debug.called)
@@ -211,6 +211,30 @@ class HashRingTestCase(base.RugTestBase):
                           ring.get_hosts,
                           None)
 
+    def test_get_hosts_bulk(self):
+        hosts = ['foo', 'bar', 'baz']
+        ring = hash_ring.HashRing(hosts, replicas=2)
+        nodes = [str(x) for x in range(100)]
+        bulk = ring.get_hosts_bulk(nodes)
+        self.assertEqual(
+            dict((node, ring.get_hosts(node)) for node in nodes), bulk)
+
+    def test_get_hosts_bulk_ignore_hosts(self):
+        hosts = ['foo', 'bar', 'baz']
+        ring = hash_ring.HashRing(hosts, replicas=2)
+        nodes = [str(x) for x in range(100)]
+        bulk = ring.get_hosts_bulk(nodes, ignore_hosts=['bar'])
+        self.assertEqual(
+            dict((node, ring.get_hosts(node, ignore_hosts=['bar']))
+                 for node in nodes),
+            bulk)
+
+    def test_get_hosts_bulk_invalid_data(self):
+        ring = hash_ring.HashRing(['foo', 'bar'])
+        self.assertRaises(hash_ring.Invalid,
+                          ring.get_hosts_bulk,
+                          ['fake', None])
+
 
 class HashRingManagerTestCase(base.RugTestBase):
 
@@ -0,0 +1,212 @@
+# Copyright (c) 2016 Akanda, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import mock
+from six.moves import queue as Queue
+
+from astara.common import metrics
+from astara.test.unit import base
+
+
+class TestHistogram(base.RugTestBase):
+    def test_observe(self):
+        hist = metrics.Histogram(buckets=(1, 5))
+        for value in (0.5, 1, 3, 10):
+            hist.observe(value)
+        self.assertEqual([2, 1, 1], hist.counts)
+        self.assertEqual(14.5, hist.sum)
+        self.assertEqual(4, hist.count)
+
+
+class TestRegistry(base.RugTestBase):
+    def setUp(self):
+        super(TestRegistry, self).setUp()
+        self.registry = metrics.Registry()
+
+    def test_labels_are_keys(self):
+        self.registry.inc('calls', service='nova')
+        self.registry.inc('calls', service='nova')
+        self.registry.inc('calls', 3, service='neutron')
+        counters = self.registry.snapshot()[metrics.COUNTER]
+        self.assertEqual(2, counters[('calls', (('service', 'nova'),))])
+        self.assertEqual(3, counters[('calls', (('service', 'neutron'),))])
+
+    def test_set_gauge(self):
+        self.registry.set_gauge('depth', 4)
+        self.registry.set_gauge('depth', 2)
+        self.assertEqual({('depth', ()): 2},
+                         self.registry.snapshot()[metrics.GAUGE])
+
+    def test_timed(self):
+        with mock.patch.object(metrics, 'time') as time:
+            time.time.side_effect = [10.0, 10.25]
+            with self.registry.timed('latency', state='CheckBoot'):
+                pass
+        hist = self.registry.snapshot()[metrics.HISTOGRAM][
+            ('latency', (('state', 'CheckBoot'),))]
+        self.assertEqual(1, hist['count'])
+        self.assertEqual(0.25, hist['sum'])
+
+    def test_timed_records_failures(self):
+        def fail():
+            with self.registry.timed('latency'):
+                raise ValueError()
+        self.assertRaises(ValueError, fail)
+        hist = self.registry.snapshot()[metrics.HISTOGRAM][('latency', ())]
+        self.assertEqual(1, hist['count'])
+
+    def test_snapshot_is_a_copy(self):
+        self.registry.observe('latency', 1)
+        snap = self.registry.snapshot()
+        self.registry.observe('latency', 1)
+        self.assertEqual(1, snap[metrics.HISTOGRAM][('latency', ())]['count'])
+
+
+class TestTimedCall(base.RugTestBase):
+    def setUp(self):
+        super(TestTimedCall, self).setUp()
+        self.registry = metrics.Registry()
+        for name in ('timed', 'inc'):
+            p = mock.patch.object(metrics, name,
+                                  getattr(self.registry, name))
+            p.start()
+
+    def test_success(self):
+        with metrics.timed_call('nova', 'GET'):
+            pass
+        snap = self.registry.snapshot()
+        key = ('astara_api_request_duration_seconds',
+               (('method', 'GET'), ('service', 'nova')))
+        self.assertEqual(1, snap[metrics.HISTOGRAM][key]['count'])
+        self.assertEqual({}, snap[metrics.COUNTER])
+
+    def test_error(self):
+        def fail():
+            with metrics.timed_call('appliance', 'PUT'):
+                raise IOError()
+        self.assertRaises(IOError, fail)
+        snap = self.registry.snapshot()
+        key = ('astara_api_request_errors_total',
+               (('method', 'PUT'), ('service', 'appliance')))
+        self.assertEqual(1, snap[metrics.COUNTER][key])
+
+
+class TestAggregator(base.RugTestBase):
+    def _snapshot(self, latency, calls, depth):
+        registry = metrics.Registry()
+        registry.observe('astara_state_duration_seconds', latency,
+                         driver='router', state='CheckBoot')
+        registry.inc('astara_api_request_errors_total', calls,
+                     service='nova', method='GET')
+        registry.set_gauge('astara_queue_depth', depth, queue='work')
+        return registry.snapshot()
+
+    def test_merged(self):
+        aggregator = metrics.Aggregator()
+        aggregator.update('p00', self._snapshot(0.1, 1, 3))
+        aggregator.update('p01', self._snapshot(50, 2, 4))
+        merged = aggregator.merged()
+
+        hist = merged[metrics.HISTOGRAM][(
+            'astara_state_duration_seconds',
+            (('driver', 'router'), ('state', 'CheckBoot')))]
+        self.assertEqual(2, hist['count'])
+        self.assertEqual(50.1, hist['sum'])
+        counters = merged[metrics.COUNTER]
+        self.assertEqual(3, counters[(
+            'astara_api_request_errors_total',
+            (('method', 'GET'), ('service', 'nova')))])
+        gauges = merged[metrics.GAUGE]
+        self.assertEqual(3, gauges[(
+            'astara_queue_depth', (('process', 'p00'), ('queue', 'work')))])
+        self.assertEqual(4, gauges[(
+            'astara_queue_depth', (('process', 'p01'), ('queue', 'work')))])
+
+    def test_latest_snapshot_replaces_previous(self):
+        aggregator = metrics.Aggregator()
+        aggregator.update('p00', self._snapshot(0.1, 1, 3))
+        aggregator.update('p00', self._snapshot(0.1, 5, 3))
+        counters = aggregator.merged()[metrics.COUNTER]
+        self.assertEqual([5], list(counters.values()))
+
+    def test_stale_snapshots_dropped(self):
+        aggregator = metrics.Aggregator(max_age=30)
+        with mock.patch.object(metrics, 'time') as time:
+            time.time.return_value = 100
+            aggregator.update('p00', self._snapshot(0.1, 1, 3))
+            time.time.return_value = 120
+            aggregator.update('p01', self._snapshot(0.1, 2, 3))
+            time.time.return_value = 140
+            counters = aggregator.merged()[metrics.COUNTER]
+        self.assertEqual([2], list(counters.values()))
+
+    def test_render(self):
+        aggregator = metrics.Aggregator()
+        registry = metrics.Registry()
+        registry.observe('astara_update_duration_seconds', 0.2,
+                         driver='router')
+        registry.set_gauge('astara_state_machines', 7)
+        aggregator.update('p00', registry.snapshot())
+        text = aggregator.render()
+        lines = text.splitlines()
+        self.assertIn('# TYPE astara_update_duration_seconds histogram',
+                      lines)
+        self.assertIn(
+            'astara_update_duration_seconds_bucket'
+            '{driver="router",le="0.1"} 0', lines)
+        self.assertIn(
+            'astara_update_duration_seconds_bucket'
+            '{driver="router",le="0.25"} 1', lines)
+        self.assertIn(
+            'astara_update_duration_seconds_bucket'
+            '{driver="router",le="+Inf"} 1', lines)
+        self.assertIn(
+            'astara_update_duration_seconds_count{driver="router"} 1', lines)
+        self.assertIn('# TYPE astara_state_machines gauge', lines)
+        self.assertIn('astara_state_machines{process="p00"} 7', lines)
+        self.assertTrue(text.endswith('\n'))
+
+    def test_render_escapes_labels(self):
+        aggregator = metrics.Aggregator()
+        registry = metrics.Registry()
+        registry.inc('errors', reason='say "hi"')
+        aggregator.update('p00', registry.snapshot())
+        self.assertIn('errors{reason="say \\"hi\\""} 1',
+                      aggregator.render().splitlines())
+
+
+class TestReporter(base.RugTestBase):
+    def test_disabled(self):
+        self.assertIsNone(metrics.start_reporter(None, 'p00'))
+        self.assertIsNone(
+            metrics.start_reporter(mock.Mock(), 'p00', interval=0))
+
+    def test_report_loop(self):
+        registry = metrics.Registry()
+        registry.inc('calls')
+        queue = mock.Mock()
+        queue.put_nowait.side_effect = [Queue.Full, None, SystemExit]
+        collect = mock.Mock()
+        self.assertRaises(SystemExit, metrics._report_loop,
+                          queue, 'p00', collect, 10, registry)
+        self.assertEqual(3, collect.call_count)
+        queue.put_nowait.assert_called_with(('p00', registry.snapshot()))
+
+    def test_collect_loop(self):
+        aggregator = mock.Mock()
+        queue = mock.Mock()
+        queue.get.side_effect = [IOError, ('p00', {}), SystemExit]
+        self.assertRaises(SystemExit, metrics._collect_loop,
+                          queue, aggregator)
+        aggregator.update.assert_called_once_with('p00', {})
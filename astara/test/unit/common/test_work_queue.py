@@ -0,0 +1,133 @@
+# Copyright (c) 2016 Akanda, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import mock
+
+from astara.common import work_queue
+from astara import event
+from astara.test.unit import base
+
+
+def _fake_sm(resource_id, pending=(), more_work=False):
+    return mock.Mock(
+        resource_id=resource_id,
+        pending_actions=mock.Mock(return_value=set(pending)),
+        has_more_work=mock.Mock(return_value=more_work),
+    )
+
+
+class TestWorkQueue(base.RugTestBase):
+    def setUp(self):
+        super(TestWorkQueue, self).setUp()
+        self.queue = work_queue.WorkQueue(consumers=1, batch_size=10)
+
+    def test_put_coalesces(self):
+        sm = _fake_sm('r1')
+        self.assertTrue(self.queue.put(sm, event.POLL))
+        self.assertFalse(self.queue.put(sm, event.POLL))
+        self.assertEqual(1, self.queue.qsize())
+        self.assertEqual([sm], self.queue.get_batch(timeout=0))
+
+    def test_priority_order(self):
+        poll = _fake_sm('poll')
+        update = _fake_sm('update')
+        delete = _fake_sm('delete')
+        self.queue.put(poll, event.POLL)
+        self.queue.put(update, event.UPDATE)
+        self.queue.put(delete, event.DELETE)
+        self.assertEqual([delete, update, poll],
+                         self.queue.get_batch(timeout=0))
+
+    def test_fifo_within_priority(self):
+        sms = [_fake_sm('r%d' % i) for i in range(3)]
+        for sm in sms:
+            self.queue.put(sm, event.UPDATE)
+        self.assertEqual(sms, self.queue.get_batch(timeout=0))
+
+    def test_coalesce_upgrades_priority(self):
+        first = _fake_sm('first')
+        second = _fake_sm('second')
+        self.queue.put(first, event.POLL)
+        self.queue.put(second, event.POLL)
+        self.queue.put(second, event.REBUILD)
+        self.assertEqual(2, self.queue.qsize())
+        self.assertEqual([second, first], self.queue.get_batch(timeout=0))
+
+    def test_put_priority_from_pending_actions(self):
+        poll = _fake_sm('poll', pending=[event.POLL])
+        delete = _fake_sm('delete', pending=[event.POLL, event.DELETE])
+        self.queue.put(poll)
+        self.queue.put(delete)
+        self.assertEqual([delete, poll], self.queue.get_batch(timeout=0))
+
+    def test_batch_size(self):
+        queue = work_queue.WorkQueue(consumers=1, batch_size=2)
+        for i in range(3):
+            queue.put(_fake_sm('r%d' % i), event.UPDATE)
+        self.assertEqual(2, len(queue.get_batch(timeout=0)))
+        self.assertEqual(1, len(queue.get_batch(timeout=0)))
+
+    def test_batch_shared_with_consumers(self):
+        queue = work_queue.WorkQueue(consumers=4, batch_size=10)
+        for i in range(8):
+            queue.put(_fake_sm('r%d' % i), event.UPDATE)
+        self.assertEqual(2, len(queue.get_batch(timeout=0)))
+
+    def test_get_batch_timeout(self):
+        self.assertEqual([], self.queue.get_batch(timeout=0))
+
+    def test_in_progress_not_requeued(self):
+        sm = _fake_sm('r1')
+        self.queue.put(sm, event.UPDATE)
+        self.queue.get_batch(timeout=0)
+        self.assertTrue(self.queue.is_in_progress('r1'))
+        self.assertFalse(self.queue.put(sm, event.UPDATE))
+        self.assertEqual(0, self.queue.qsize())
+
+    def test_task_done_requeues_more_work(self):
+        sm = _fake_sm('r1', pending=[event.UPDATE], more_work=True)
+        self.queue.put(sm, event.UPDATE)
+        self.queue.get_batch(timeout=0)
+        self.assertTrue(self.queue.task_done(sm))
+        self.assertFalse(self.queue.is_in_progress('r1'))
+        self.assertEqual([sm], self.queue.get_batch(timeout=0))
+
+    def test_task_done_no_more_work(self):
+        sm = _fake_sm('r1')
+        self.queue.put(sm, event.UPDATE)
+        self.queue.get_batch(timeout=0)
+        self.assertFalse(self.queue.task_done(sm))
+        self.assertEqual(0, self.queue.qsize())
+
+    def test_task_done_no_requeue(self):
+        sm = _fake_sm('r1', more_work=True)
+        self.queue.put(sm, event.UPDATE)
+        self.queue.get_batch(timeout=0)
+        self.assertFalse(self.queue.task_done(sm, requeue=False))
+        self.assertEqual(0, self.queue.qsize())
+
+    def test_release(self):
+        sm = _fake_sm('r1')
+        self.queue.put(sm, event.UPDATE)
+        self.queue.get_batch(timeout=0)
+        self.assertTrue(self.queue.release('r1'))
+        self.assertFalse(self.queue.release('r1'))
+        self.assertTrue(self.queue.put(sm, event.UPDATE))
+
+    def test_close(self):
+        self.queue.put(_fake_sm('r1'), event.UPDATE)
+        self.queue.close()
+        self.assertEqual(0, self.queue.qsize())
+        self.assertIsNone(self.queue.get_batch(timeout=0))
+        self.assertFalse(self.queue.put(_fake_sm('r2'), event.UPDATE))
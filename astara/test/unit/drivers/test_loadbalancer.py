@@ -101,7 +101,8 @@ class LoadBalancerDriverTest(base.RugTestBase):
         mock_update_config.assert_called_with(
             '10.0.0.1',
             lb.mgt_port,
-            'fake_config',)
+            'fake_config',
+            base_config=None)
 
     @mock.patch('astara.drivers.loadbalancer.LoadBalancer._ensure_cache')
     def test_make_ports(self, mock_ensure_cache):
@@ -244,6 +245,12 @@ class LoadBalancerDriverTest(base.RugTestBase):
             tenant_id, event_type, payload)
         self.assertEqual(res, expected)
 
+    def test_notification_event_types(self):
+        event_types = loadbalancer.LoadBalancer.notification_event_types()
+        self.assertIn('loadbalancer.create.end', event_types)
+        self.assertIn('member.create.end', event_types)
+        self.assertNotIn('loadbalancerstatus.update', event_types)
+
     def test_process_notification_loadbalancerstatus(self):
         self._test_notification('loadbalancerstatus.update', {}, None)
 
@@ -115,7 +115,8 @@ class RouterDriverTest(base.RugTestBase):
         mock_update_config.assert_called_with(
             '10.0.0.1',
             rtr.mgt_port,
-            'fake_config',)
+            'fake_config',
+            base_config=None)
 
     @mock.patch('astara.drivers.router.Router._ensure_cache')
     def test_make_ports(self, mock_ensure_cache):
@@ -237,6 +238,36 @@ class RouterDriverTest(base.RugTestBase):
             tenant_id, event_type, payload)
         self.assertEqual(res, expected)
 
+    def test_process_notification_router_port(self):
+        payload = {'port': {'device_id': 'fake_router_id',
+                            'device_owner': 'network:router_interface'}}
+        r = event.Resource(
+            driver=router.Router.RESOURCE_NAME,
+            id='fake_router_id',
+            tenant_id='fake_tenant_id')
+        e = event.Event(
+            resource=r,
+            crud=event.UPDATE,
+            body=payload,
+        )
+        self._test_notification('port.change.end', payload, e)
+
+    def test_process_notification_instance_port(self):
+        payload = {'port': {'device_id': 'fake_instance_id',
+                            'device_owner': 'compute:nova'}}
+        res = router.Router.process_notification(
+            'fake_tenant_id', 'port.change.end', payload)
+        self.assertIsNone(res.resource.id)
+
+    def test_notification_event_types(self):
+        event_types = router.Router.notification_event_types()
+        self.assertIn('router.create.end', event_types)
+        self.assertIn('port.change.end', event_types)
+        self.assertNotIn('vpnservice.change.end', event_types)
+        self.config(ipsec_vpn=True, group='router')
+        self.assertIn('vpnservice.change.end',
+                      router.Router.notification_event_types())
+
     def test_process_notifications_floatingips(self):
         payload = {'router': {'id': 'fake_router_id'}}
         r = event.Resource(
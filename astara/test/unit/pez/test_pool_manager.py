@@ -83,3 +83,242 @@ class PoolManagerTest(base.RugTestBase):
         self.pool_manager._check_del_instances({self.resource: []})
         self.assertNotIn(
             pool[self.resource][0], self.pool_manager._delete_counters)
+
+    def _server(self, id, status='ACTIVE'):
+        server = mock.Mock(id=id, status=status)
+        server.name = ak_pool.INSTANCE_FREE % {'resource_name': self.resource}
+        return server
+
+    def test_get_instance_uses_inventory(self):
+        self.pool_manager.ctxt = mock.Mock()
+        client = self.pool_manager.ctxt.nova_client.client
+        neutron = self.pool_manager.ctxt.neutron_client
+        neutron.get_ports_for_instance.return_value = ('mgt', [])
+        self.pool_manager.inventory.update(
+            {self.resource: [self._server('a')]})
+
+        res = self.pool_manager.get_instance(self.resource, 'ak-router-1')
+
+        self.assertFalse(client.servers.list.called)
+        client.servers.update.assert_called_with(mock.ANY, name='ak-router-1')
+        self.assertEqual((client.servers.get.return_value, 'mgt', []), res)
+        self.assertRaises(ak_pool.PezPoolExhausted,
+                          self.pool_manager.get_instance,
+                          self.resource, 'ak-router-2')
+
+    def test_get_instance_loads_pools_once(self):
+        self.pool_manager.ctxt = mock.Mock()
+        client = self.pool_manager.ctxt.nova_client.client
+        client.servers.list.return_value = []
+        self.assertRaises(ak_pool.PezPoolExhausted,
+                          self.pool_manager.get_instance,
+                          self.resource, 'ak-router-1')
+        self.assertRaises(ak_pool.PezPoolExhausted,
+                          self.pool_manager.get_instance,
+                          self.resource, 'ak-router-1')
+        self.assertEqual(1, client.servers.list.call_count)
+
+    def test_get_instance_rename_failure_releases(self):
+        self.pool_manager.ctxt = mock.Mock()
+        client = self.pool_manager.ctxt.nova_client.client
+        client.servers.update.side_effect = ValueError()
+        server = self._server('a')
+        self.pool_manager.inventory.update({self.resource: [server]})
+        self.assertRaises(ValueError, self.pool_manager.get_instance,
+                          self.resource, 'ak-router-1')
+        self.pool_manager.inventory.update({self.resource: [server]})
+        self.assertEqual(1, self.pool_manager.inventory.count(self.resource))
+
+    def _port(self, id, network_id, name=ak_pool.PLACEHOLDER_PORT):
+        port = mock.Mock(id=id, network_id=network_id)
+        port.name = name
+        return port
+
+    def test_get_instance_uses_placeholders(self):
+        self.pool_manager.preplugged_networks = ['ext', 'other']
+        self.pool_manager.ctxt = mock.Mock()
+        client = self.pool_manager.ctxt.nova_client.client
+        neutron = self.pool_manager.ctxt.neutron_client
+        renamed = self._port('ph-ext', 'ext', 'ASTARA:VRRP:r1')
+        attached = self._port('p-int', 'int', 'ASTARA:VRRP:r1')
+        neutron.get_ports_for_instance.side_effect = [
+            ('mgt', [self._port('ph-ext', 'ext'),
+                     self._port('ph-other', 'other')]),
+            ('mgt', [renamed, attached, self._port('ph-other', 'other')]),
+        ]
+        self.pool_manager.inventory.update(
+            {self.resource: [self._server('a')]})
+
+        server, mgt_port, ports = self.pool_manager.get_instance(
+            self.resource, 'ak-router-1', instance_ports=[
+                {'id': 'p-ext', 'network_id': 'ext',
+                 'name': 'ASTARA:VRRP:r1'},
+                {'id': 'p-int', 'network_id': 'int',
+                 'name': 'ASTARA:VRRP:r1'},
+            ])
+
+        neutron.api_client.update_port.assert_called_once_with(
+            'ph-ext', {'port': {'name': 'ASTARA:VRRP:r1'}})
+        self.assertEqual(
+            [mock.call('p-ext'), mock.call('ph-other')],
+            neutron.api_client.delete_port.call_args_list)
+        client.servers.interface_attach.assert_called_once_with(
+            server=mock.ANY, port_id='p-int', net_id=None, fixed_ip=None)
+        self.assertEqual([renamed, attached], ports)
+
+
+class PezInventoryTest(base.RugTestBase):
+    def setUp(self):
+        super(PezInventoryTest, self).setUp()
+        self.inventory = ak_pool.PezInventory()
+
+    def _server(self, id, status='ACTIVE'):
+        return mock.Mock(id=id, status=status)
+
+    def test_reserve_prefers_ready(self):
+        self.inventory.update({'router': [
+            self._server('booting', 'BUILD'),
+            self._server('ready'),
+            self._server('broken', 'ERROR'),
+        ]})
+        self.assertEqual(2, self.inventory.count('router'))
+        self.assertEqual('ready', self.inventory.reserve('router').id)
+        self.assertEqual('booting', self.inventory.reserve('router').id)
+        self.assertIsNone(self.inventory.reserve('router'))
+        self.assertIsNone(self.inventory.reserve('loadbalancer'))
+
+    def test_reserved_not_offered_again(self):
+        server = self._server('a')
+        self.inventory.update({'router': [server]})
+        self.inventory.reserve('router')
+        # a listing made before the instance was renamed still shows it
+        self.inventory.update({'router': [server]})
+        self.assertIsNone(self.inventory.reserve('router'))
+        # once renamed, the reservation is forgotten
+        self.inventory.update({'router': []})
+        self.assertEqual(set(), self.inventory._claimed)
+
+    def test_remove(self):
+        server = self._server('a')
+        self.inventory.update({'router': [server]})
+        self.inventory.remove('a')
+        self.assertEqual(0, self.inventory.count('router'))
+        self.inventory.update({'router': [server]})
+        self.assertEqual(0, self.inventory.count('router'))
+
+
+class PoolSizerTest(base.RugTestBase):
+    def test_fixed_size(self):
+        sizer = ak_pool.PoolSizer(3, 0, 60, 120)
+        for i in range(100):
+            sizer.reserved(now=i)
+        self.assertEqual(3, sizer.target(now=100))
+
+    def test_target_follows_demand(self):
+        sizer = ak_pool.PoolSizer(2, 10, 60, 30)
+        self.assertEqual(2, sizer.target(now=1000))
+        # 12 reservations a minute, 30 seconds to replenish
+        for i in range(12):
+            sizer.reserved(now=1000 + i * 5)
+        self.assertEqual(0.2, sizer.rate(now=1059))
+        self.assertEqual(6, sizer.target(now=1059))
+        # the burst is forgotten after the window
+        self.assertEqual(2, sizer.target(now=1200))
+
+    def test_target_bounded(self):
+        sizer = ak_pool.PoolSizer(2, 4, 60, 120)
+        for i in range(60):
+            sizer.reserved(now=i)
+        self.assertEqual(4, sizer.target(now=60))
+
+    def test_replenished(self):
+        sizer = ak_pool.PoolSizer(2, 4, 60, 100)
+        sizer.replenished(50)
+        self.assertEqual(85, sizer.replenish_time)
+
+
+class LaunchInstancesTest(base.RugTestBase):
+    def setUp(self):
+        super(LaunchInstancesTest, self).setUp()
+        self.pool_manager = ak_pool.PezPoolManager(
+            'fake_image', 'fake_flavor', 1, 'fake_mgt_net_id',
+            max_pool_size=5, launch_concurrency=2)
+        self.pool_manager.ctxt = mock.Mock()
+        self.pool_manager.images = {'router': 'image'}
+        self.pool_manager.flavors = {'router': 'flavor'}
+        self.driver = mock.Mock(RESOURCE_NAME='router')
+        self.launch_ctxt = mock.Mock()
+        p = mock.patch.object(ak_pool, 'WorkerContext',
+                              return_value=self.launch_ctxt)
+        p.start()
+        self.addCleanup(p.stop)
+        p = mock.patch.object(ak_pool.nova, 'format_userdata')
+        p.start()
+        self.addCleanup(p.stop)
+
+    def _ports(self, count):
+        return [mock.Mock(id='port%d' % i, network_id='mgt')
+                for i in range(count)]
+
+    def test_launch_instances(self):
+        neutron = self.pool_manager.ctxt.neutron_client
+        neutron.create_management_ports.return_value = self._ports(3)
+        servers = self.launch_ctxt.nova_client.client.servers
+        servers.create.side_effect = [
+            mock.Mock(id='s%d' % i) for i in range(3)]
+
+        self.pool_manager.launch_instances(3, self.driver)
+
+        neutron.create_management_ports.assert_called_once_with(
+            ak_pool.FREE_PORT_OWNER, 3)
+        self.assertEqual(3, servers.create.call_count)
+        self.assertEqual(
+            sorted('port%d' % i for i in range(3)),
+            sorted(c[1]['nics'][0]['port-id']
+                   for c in servers.create.call_args_list))
+        self.assertEqual(['s0', 's1', 's2'],
+                         sorted(self.pool_manager._launches))
+        # one client context per launching thread
+        self.assertEqual(2, len(self.pool_manager._launch_contexts))
+
+    def test_launch_instances_with_placeholders(self):
+        self.pool_manager.preplugged_networks = ['ext']
+        neutron = self.pool_manager.ctxt.neutron_client
+        neutron.create_management_ports.return_value = self._ports(2)
+        neutron.create_vrrp_ports.return_value = [
+            mock.Mock(id='ph%d' % i, network_id='ext') for i in range(2)]
+        servers = self.launch_ctxt.nova_client.client.servers
+
+        self.pool_manager.launch_instances(2, self.driver)
+
+        neutron.create_vrrp_ports.assert_called_once_with(
+            ak_pool.FREE_PORT_OWNER, 'ext', 2)
+        self.assertEqual(
+            [['port0', 'ph0'], ['port1', 'ph1']],
+            sorted([n['port-id'] for n in c[1]['nics']]
+                   for c in servers.create.call_args_list))
+
+    def test_launch_failure_deletes_port(self):
+        neutron = self.pool_manager.ctxt.neutron_client
+        neutron.create_management_ports.return_value = self._ports(1)
+        servers = self.launch_ctxt.nova_client.client.servers
+        servers.create.side_effect = ValueError()
+
+        self.pool_manager.launch_instances(1, self.driver)
+
+        self.launch_ctxt.neutron_client.api_client.delete_port.\
+            assert_called_once_with('port0')
+        self.assertEqual({}, self.pool_manager._launches)
+
+    def test_launched_instances_measure_replenish_time(self):
+        sizer = self.pool_manager.sizers['router'] = ak_pool.PoolSizer(
+            1, 5, 60, 100)
+        self.pool_manager._launches = {'s0': ('router', 0),
+                                       's1': ('router', 0)}
+        server = mock.Mock(id='s0', status='ACTIVE')
+        self.pool_manager.inventory.update({'router': [server]})
+        with mock.patch.object(ak_pool, 'time') as time:
+            time.time.return_value = 50
+            self.pool_manager._check_launched_instances()
+        self.assertEqual(85, sizer.replenish_time)
+        self.assertEqual(['s1'], list(self.pool_manager._launches))
@@ -0,0 +1,178 @@
+# Copyright (c) 2016 Akanda, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import mock
+from oslo_config import cfg
+import requests
+from six.moves import queue as Queue
+
+from astara.api import astara_client
+from astara.api import neutron
+from astara.api import nova
+from astara.test.benchmark import fakes
+from astara.test.benchmark import fleet
+from astara.test.unit import base
+
+
+class TestFakeCloud(base.RugTestBase):
+    def setUp(self):
+        super(TestFakeCloud, self).setUp()
+        self.config(management_network_id=fakes.MGT_NETWORK_ID)
+        self.results = Queue.Queue()
+        self.cloud = fakes.FakeCloud(2, routers_per_tenant=2,
+                                     networks_per_router=2,
+                                     results=self.results)
+        for p in fakes.install(self.cloud):
+            self.addCleanup(p.stop)
+        astara_client.SESSION_POOL.clear()
+        self.addCleanup(astara_client.SESSION_POOL.clear)
+
+    def test_topology_is_deterministic(self):
+        other = fakes.FakeCloud(2, routers_per_tenant=2,
+                                networks_per_router=2)
+        self.assertEqual(list(self.cloud.routers), list(other.routers))
+        self.assertEqual(4, len(self.cloud.routers))
+        self.assertEqual(2, len(self.cloud.tenant_ids))
+
+    def test_router_detail(self):
+        router_id = list(self.cloud.routers)[0]
+        router = neutron.Neutron(cfg.CONF).get_router_detail(router_id)
+        self.assertEqual(router_id, router.id)
+        self.assertEqual(fakes.EXT_NETWORK_ID, router.external_port.network_id)
+        self.assertEqual(2, len(router.internal_ports))
+        self.assertEqual(1, len(router.floating_ips))
+
+    def test_network_details(self):
+        router_id = list(self.cloud.routers)[0]
+        client = neutron.Neutron(cfg.CONF)
+        router = client.get_router_detail(router_id)
+        network_ids = [p.network_id for p in router.internal_ports]
+        networks = client.get_network_details(network_ids)
+        self.assertEqual(set(network_ids), set(networks))
+        for network in networks.values():
+            self.assertEqual(1, len(network.subnets))
+
+    def test_boot_and_configure(self):
+        router_id = list(self.cloud.routers)[0]
+        client = neutron.Neutron(cfg.CONF)
+        mgt_port = client.create_management_port(router_id)
+        self.assertEqual(1, len(mgt_port.fixed_ips))
+
+        with mock.patch.object(fakes, 'time') as time:
+            time.time.return_value = 100
+            self.cloud.boot_time = 30
+            info = nova.Nova(cfg.CONF).instance_provider.create_instance(
+                'router', 'ak-router', 'image', 'flavor',
+                lambda: (mgt_port, []))
+            address = str(mgt_port.fixed_ips[0].ip_address)
+            server = self.cloud.servers[info.id_]
+            self.assertEqual('BUILD', server.status)
+            self.assertRaises(requests.ConnectionError,
+                              astara_client.get_interfaces, address, 5000)
+
+            time.time.return_value = 130
+            self.assertEqual('ACTIVE', server.status)
+            interfaces = astara_client.get_interfaces(address, 5000)
+            self.assertEqual(
+                [mgt_port.mac_address], [i['lladdr'] for i in interfaces])
+
+            time.time.side_effect = [140, 140, 141]
+            astara_client.update_config(address, 5000, {})
+        self.assertEqual((router_id, 140, 141), self.results.get_nowait())
+
+    def test_delta_config(self):
+        client = neutron.Neutron(cfg.CONF)
+        mgt_port = client.create_management_port('r1')
+        info = nova.Nova(cfg.CONF).instance_provider.create_instance(
+            'router', 'ak-router', 'image', 'flavor', lambda: (mgt_port, []))
+        address = str(mgt_port.fixed_ips[0].ip_address)
+        server = self.cloud.servers[info.id_]
+
+        old = {'networks': [{'network_id': 'n1', 'allocations': []}]}
+        new = {'networks': [{'network_id': 'n1', 'allocations': [
+            {'mac_address': 'm1'}]}]}
+        with mock.patch.object(astara_client, '_request',
+                               wraps=astara_client._request) as request:
+            # the appliance runs no config yet and asks for all of it
+            self.assertEqual(old, astara_client.update_config(
+                address, 5000, old, base_config={}))
+            self.assertEqual(['patch', 'put'],
+                             [c[0][0] for c in request.call_args_list])
+            request.reset_mock()
+
+            self.assertEqual(new, astara_client.update_config(
+                address, 5000, new, base_config=old))
+            self.assertEqual(['patch'],
+                             [c[0][0] for c in request.call_args_list])
+        self.assertEqual(new, server.config)
+
+    def test_delete_server_releases_ports(self):
+        client = neutron.Neutron(cfg.CONF)
+        mgt_port = client.create_management_port('r1')
+        info = nova.Nova(cfg.CONF).instance_provider.create_instance(
+            'router', 'ak-router', 'image', 'flavor', lambda: (mgt_port, []))
+        self.assertEqual(
+            [mgt_port.id],
+            [p['id'] for p in self.cloud.list_ports(device_id=info.id_)])
+        nova.Nova(cfg.CONF).client.servers.delete(info.id_)
+        self.assertEqual([], self.cloud.list_ports(device_id=info.id_))
+
+
+class TestFleet(base.RugTestBase):
+    def setUp(self):
+        super(TestFleet, self).setUp()
+        self.cloud = fakes.FakeCloud(3, routers_per_tenant=2)
+
+    def test_generate_trace(self):
+        trace = fleet.generate_trace(self.cloud, 10, 2, ramp=5, seed=1)
+        self.assertEqual(6 + 20, len(trace))
+        self.assertEqual(
+            sorted(self.cloud.routers),
+            sorted(n.router_id for n in trace
+                   if n.event_type == 'router.create.end'))
+        self.assertEqual(sorted(n.offset for n in trace),
+                         [n.offset for n in trace])
+        self.assertEqual(
+            trace, fleet.generate_trace(self.cloud, 10, 2, ramp=5, seed=1))
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(50, fleet.percentile(values, 50))
+        self.assertEqual(99, fleet.percentile(values, 99))
+        self.assertEqual(1, fleet.percentile([1], 50))
+        self.assertIsNone(fleet.percentile([], 50))
+
+    def test_convergence(self):
+        tracker = fleet.ConvergenceTracker()
+        tracker.sent('r1', 10)
+        tracker.sent('r2', 10)
+        tracker.pushed('r1', 9, 11)
+        self.assertEqual(2, tracker.pending())
+        tracker.pushed('r1', 12, 15)
+        tracker.sent('r1', 13)
+        tracker.pushed('r1', 14, 16)
+        self.assertEqual(1, tracker.pending())
+        self.assertEqual(([5, 3], 1), tracker.latencies())
+        self.assertEqual(3, tracker.push_count)
+
+    def test_replay_batches(self):
+        trace = fleet.generate_trace(self.cloud, 0, 0, ramp=0, seed=1)
+        endpoint = mock.Mock()
+        tracker = fleet.ConvergenceTracker()
+        with mock.patch.object(fleet, 'time') as time:
+            time.time.return_value = 0
+            fleet.replay(trace, endpoint, tracker, batch_size=4, start=0)
+        self.assertEqual([4, 2], [len(c[0][0])
+                                  for c in endpoint.info.call_args_list])
+        self.assertEqual(6, tracker.pending())
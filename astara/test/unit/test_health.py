@@ -16,6 +16,7 @@ import mock
 
 from astara import event
 from astara import health
+from astara.drivers import states
 from astara.test.unit import base
 
 
@@ -48,3 +49,53 @@ class HealthTest(base.RugTestBase):
             body={},
         )
         fake_scheduler.handle_message.assert_called_with('*', exp_event)
+
+
+def _fake_sm(state=states.CONFIGURED, addresses=('fe80::1',), degraded=False):
+    instances = [mock.Mock(management_address=a) for a in addresses]
+    sm = mock.Mock(deleted=False)
+    sm.instance.state = state
+    sm.instance.instances.instances = instances
+    sm.instance.instances.cluster_degraded = degraded
+    return sm
+
+
+class HealthProberTest(base.RugTestBase):
+    def setUp(self):
+        super(HealthProberTest, self).setUp()
+        self.prober = health.HealthProber(4)
+
+    def test_probe(self):
+        checks = {
+            'fe80::1': lambda addr: True,
+            'fe80::2': lambda addr: False,
+            'fe80::3': mock.Mock(side_effect=Exception('boom')),
+        }
+        self.assertEqual(set(['fe80::1']), self.prober.probe(checks))
+
+    def test_probe_empty(self):
+        self.assertEqual(set(), self.prober.probe({}))
+
+    def test_find_changed_skips_healthy(self):
+        healthy = _fake_sm(addresses=['fe80::1'])
+        dead = _fake_sm(addresses=['fe80::2'])
+        for sm in (healthy, dead):
+            sm.resource.is_alive.side_effect = lambda a: a == 'fe80::1'
+        self.assertEqual([dead], self.prober.find_changed([healthy, dead]))
+
+    def test_find_changed_partial_cluster(self):
+        sm = _fake_sm(addresses=['fe80::1', 'fe80::2'])
+        sm.resource.is_alive.side_effect = lambda a: a == 'fe80::1'
+        self.assertEqual([sm], self.prober.find_changed([sm]))
+
+    def test_find_changed_not_configured(self):
+        booting = _fake_sm(state=states.BOOTING)
+        degraded = _fake_sm(degraded=True)
+        no_address = _fake_sm(addresses=[None])
+        deleted = _fake_sm()
+        deleted.deleted = True
+        sms = [booting, degraded, no_address, deleted]
+        self.assertEqual([booting, degraded, no_address],
+                         self.prober.find_changed(sms))
+        for sm in sms:
+            self.assertFalse(sm.resource.is_alive.called)
@@ -18,6 +18,7 @@
 import collections
 import mock
 import six
+import threading
 import uuid
 
 from datetime import datetime, timedelta
@@ -255,24 +256,31 @@ class TestInstanceManager(base.RugTestBase):
         self.instance_mgr.instances.validate_ports.return_value = \
             ([mock.Mock()], [])  # (has_ports, no_ports)
         self.instance_mgr.instances.are_alive.return_value = \
-            ([mock.Mock(booting=False)], [])  # (alive, dead)
+            ([mock.Mock(booting=False,
+                        time_since_boot=timedelta(seconds=30))],
+             [])  # (alive, dead)
 
-        self.assertEqual(
-            self.instance_mgr.update_state(self.ctx),
-            states.CONFIGURED
-        )
+        with mock.patch.object(instance_manager, 'metrics') as metrics:
+            self.assertEqual(
+                self.instance_mgr.update_state(self.ctx),
+                states.CONFIGURED
+            )
 
-        self.instance_mgr.update_state(self.ctx),
-        self.instance_mgr.update_state(self.ctx),
-        self.instance_mgr.update_state(self.ctx),
+            self.instance_mgr.update_state(self.ctx),
+            self.instance_mgr.update_state(self.ctx),
+            self.instance_mgr.update_state(self.ctx),
         # ensure the boot was logged only once
         self.assertEqual(len(self.instance_mgr.log.info.call_args_list), 1)
+        metrics.observe.assert_called_once_with(
+            'astara_instance_boot_seconds', 30.0,
+            driver=self.instance_mgr.resource.RESOURCE_NAME)
 
     @mock.patch('time.sleep')
     def test_boot_success(self, sleep):
         self.next_state = states.UP
         self.instance_mgr.boot(self.ctx)
         self.assertEqual(self.instance_mgr.state, states.BOOTING)
+        self.instance_mgr.instances.refresh.assert_called_once_with(self.ctx)
         self.instance_mgr.instances.create.assert_called_with(
             self.ctx)
         self.assertEqual(1, self.instance_mgr.attempts)
@@ -297,13 +305,16 @@ class TestInstanceManager(base.RugTestBase):
     def test_stop_success(self):
         self.instance_mgr.state = states.UP
         instance = instance_info()
+        self.ctx.nova_client.get_instances_for_obj.return_value = [instance]
         self.set_instances_container_mocks(
             instances=[instance],
             mocks=[
                 ('destroy', mock.Mock()),
+                ('refresh', mock.Mock()),
                 ('update_ports', mock.Mock())])
 
         self.instance_mgr.stop(self.ctx)
+        self.instance_mgr.instances.refresh.assert_called_once_with(self.ctx)
         self.instance_mgr.instances.destroy.assert_called_with(self.ctx)
         self.instance_mgr.resource.delete_ports.assert_called_once_with(
             self.ctx)
@@ -311,8 +322,10 @@ class TestInstanceManager(base.RugTestBase):
 
     def test_stop_fail(self):
         self.instance_mgr.state = states.UP
+        instance = instance_info()
+        self.ctx.nova_client.get_instances_for_obj.return_value = [instance]
         self.set_instances_container_mocks(
-            instances=[instance_info()],
+            instances=[instance],
             mocks=[
                 ('destroy', mock.Mock()),
                 ('update_ports', mock.Mock())])
@@ -324,6 +337,7 @@ class TestInstanceManager(base.RugTestBase):
     def test_stop_router_already_deleted_from_neutron(self):
         self.instance_mgr.state = states.GONE
         instance = instance_info()
+        self.ctx.nova_client.get_instances_for_obj.return_value = [instance]
         self.set_instances_container_mocks(
             instances=[instance],
             mocks=[
@@ -397,7 +411,8 @@ class TestInstanceManager(base.RugTestBase):
             }
         )
         self.set_instances_container_mocks(
-            instances=[instance], mocks=[('get_interfaces', get_interfaces)])
+            instances=[instance], mocks=[('get_interfaces', get_interfaces),
+                                         ('refresh', mock.Mock())])
 
         fake_instance = mock.MagicMock()
         self.ctx.nova_client.get_instance_by_id = mock.Mock(
@@ -417,6 +432,7 @@ class TestInstanceManager(base.RugTestBase):
         wait_for_hotplug.return_value = True
         self.instance_mgr.replug(self.ctx)
 
+        self.instance_mgr.instances.refresh.assert_called_once_with(self.ctx)
         self.ctx.neutron.create_vrrp_port.assert_called_with(
             self.fake_driver.id, 'additional-net'
         )
@@ -769,6 +785,50 @@ class TestInstanceManager(base.RugTestBase):
             self.instance_mgr.instances, exp_updated_instances)
         self.instance_mgr.instances.update_ports.assert_called_with(self.ctx)
 
+    def test_ensure_cache_drops_missing(self):
+        self.set_instances_container_mocks(mocks=[
+            ('update_ports', mock.Mock())
+        ])
+        self.instance_mgr.instances['fake_instance_id1'] = 'gone_instance'
+        self.ctx.nova_client.get_instances_for_obj.return_value = []
+
+        wrapped = instance_manager.ensure_cache(lambda self, ctx: None)
+        wrapped(self.instance_mgr, self.ctx)
+        self.assertEqual({}, self.instance_mgr.instances)
+
+    def test_ensure_cache_reused_during_update_cycle(self):
+        self.set_instances_container_mocks(mocks=[
+            ('update_ports', mock.Mock())
+        ])
+        self.ctx.nova_client.get_instances_for_obj.return_value = []
+        wrapped = instance_manager.ensure_cache(lambda self, ctx: None)
+
+        self.instance_mgr.begin_update_cycle()
+        wrapped(self.instance_mgr, self.ctx)
+        wrapped(self.instance_mgr, self.ctx)
+        self.assertEqual(
+            1, self.ctx.nova_client.get_instances_for_obj.call_count)
+
+        self.instance_mgr.end_update_cycle()
+        wrapped(self.instance_mgr, self.ctx)
+        wrapped(self.instance_mgr, self.ctx)
+        self.assertEqual(
+            3, self.ctx.nova_client.get_instances_for_obj.call_count)
+
+    def test_ensure_cache_expired_by_boot(self):
+        self.set_instances_container_mocks(mocks=[
+            ('update_ports', mock.Mock()),
+            ('create', mock.Mock()),
+        ])
+        self.ctx.nova_client.get_instances_for_obj.return_value = []
+        wrapped = instance_manager.ensure_cache(lambda self, ctx: None)
+
+        self.instance_mgr.begin_update_cycle()
+        self.instance_mgr.boot(self.ctx)
+        wrapped(self.instance_mgr, self.ctx)
+        self.assertEqual(
+            2, self.ctx.nova_client.get_instances_for_obj.call_count)
+
 
 class TestBootAttemptCounter(base.RugTestBase):
     def setUp(self):
@@ -841,11 +901,15 @@ class TestInstanceGroupManager(base.RugTestBase):
         self.assertEqual(alive, [self.instance_1])
 
     def test_update_ports(self):
-        self.ctx.neutron.get_ports_for_instance.side_effect = [
-            ('instance1_mgt_port', ['instance1_inst_port']),
-            ('instance2_mgt_port', ['instance2_inst_port']),
-        ]
+        self.ctx.neutron.get_ports_for_instances.return_value = {
+            self.instance_1.id_: (
+                'instance1_mgt_port', ['instance1_inst_port']),
+            self.instance_2.id_: (
+                'instance2_mgt_port', ['instance2_inst_port']),
+        }
         self.group_mgr.update_ports(self.ctx)
+        self.assertEqual(
+            1, self.ctx.neutron.get_ports_for_instances.call_count)
         self.assertEqual(self.instance_1.management_port, 'instance1_mgt_port')
         self.assertEqual(self.instance_1.ports, ['instance1_inst_port'])
         self.assertEqual(self.instance_2.management_port, 'instance2_mgt_port')
@@ -936,13 +1000,13 @@ class TestInstanceGroupManager(base.RugTestBase):
             Exception, Exception, True]
         self.assertTrue(self.group_mgr._update_config(self.instance_1, {}))
         self.fake_driver.update_config.assert_called_with(
-            self.instance_1.management_address, {})
+            self.instance_1.management_address, {}, base_config=None)
 
     def test__update_config_fail(self):
         self.fake_driver.update_config.side_effect = Exception
         self.assertFalse(self.group_mgr._update_config(self.instance_1, {}))
         self.fake_driver.update_config.assert_called_with(
-            self.instance_1.management_address, {})
+            self.instance_1.management_address, {}, base_config=None)
 
     def test__ha_config(self):
         instance_1_ha_config = self.group_mgr._ha_config(self.instance_1)
@@ -989,7 +1053,8 @@ class TestInstanceGroupManager(base.RugTestBase):
                 {
                     'instance_1_config': 'config',
                     'ha_config': {'fake_ha_config': 'peers'}
-                }),
+                },
+                None),
             fake_update_config.call_args_list)
         self.assertIn(
             mock.call(
@@ -997,7 +1062,8 @@ class TestInstanceGroupManager(base.RugTestBase):
                 {
                     'instance_2_config': 'config',
                     'ha_config': {'fake_ha_config': 'peers'}
-                }),
+                },
+                None),
             fake_update_config.call_args_list)
 
     @mock.patch('astara.instance_manager.InstanceGroupManager._update_config')
@@ -1071,6 +1137,171 @@ class TestInstanceGroupManager(base.RugTestBase):
         fake_update_config.return_value = True
         self.assertEqual(self.group_mgr.configure(self.ctx), states.DEGRADED)
 
+    @mock.patch('astara.instance_manager.InstanceGroupManager._update_config')
+    @mock.patch('astara.instance_manager._generate_interface_map')
+    @mock.patch('astara.instance_manager.InstanceGroupManager.get_interfaces')
+    @mock.patch.object(instance_manager, 'time')
+    def test_configure_skips_unchanged_config(self, fake_time,
+                                              fake_get_interfaces,
+                                              fake_gen_iface_map,
+                                              fake_update_config):
+        self.config(config_resync_interval=600)
+        self.fake_driver.is_ha = False
+        self.fake_driver.build_config.return_value = {'config': 'a'}
+        fake_get_interfaces.return_value = {
+            self.instance_1: [], self.instance_2: []}
+        fake_update_config.return_value = True
+
+        fake_time.time.return_value = 100
+        self.assertEqual(self.group_mgr.configure(self.ctx), states.CONFIGURED)
+        self.assertEqual(2, fake_update_config.call_count)
+
+        # unchanged config is not pushed again
+        fake_time.time.return_value = 699
+        self.assertEqual(self.group_mgr.configure(self.ctx), states.CONFIGURED)
+        self.assertEqual(2, fake_update_config.call_count)
+
+        # a changed config is pushed as changes from the previous one
+        self.fake_driver.build_config.return_value = {'config': 'b'}
+        self.assertEqual(self.group_mgr.configure(self.ctx), states.CONFIGURED)
+        self.assertEqual(4, fake_update_config.call_count)
+        fake_update_config.assert_called_with(
+            mock.ANY, {'config': 'b'}, {'config': 'a'})
+
+        # and pushed again in full once the resync interval has passed
+        fake_time.time.return_value = 1299
+        self.group_mgr.configure(self.ctx)
+        self.assertEqual(6, fake_update_config.call_count)
+        fake_update_config.assert_called_with(
+            mock.ANY, {'config': 'b'}, None)
+
+    @mock.patch('astara.instance_manager.InstanceGroupManager._update_config')
+    @mock.patch('astara.instance_manager._generate_interface_map')
+    @mock.patch('astara.instance_manager.InstanceGroupManager.get_interfaces')
+    def test_configure_retries_failed_config(self, fake_get_interfaces,
+                                             fake_gen_iface_map,
+                                             fake_update_config):
+        self.fake_driver.is_ha = False
+        self.fake_driver.build_config.return_value = {'config': 'a'}
+        fake_get_interfaces.return_value = {
+            self.instance_1: [], self.instance_2: []}
+
+        fake_update_config.side_effect = (
+            lambda i, c, b: i is self.instance_1)
+        self.assertEqual(self.group_mgr.configure(self.ctx), states.DEGRADED)
+
+        fake_update_config.reset_mock()
+        fake_update_config.side_effect = None
+        fake_update_config.return_value = True
+        self.assertEqual(self.group_mgr.configure(self.ctx), states.CONFIGURED)
+        fake_update_config.assert_called_once_with(
+            self.instance_2, {'config': 'a'}, None)
+
+        # an instance that stops answering gets its config pushed again
+        self.fake_driver.is_alive.side_effect = (
+            lambda addr: addr == self.instance_2.management_address)
+        self.group_mgr.are_alive()
+        fake_update_config.reset_mock()
+        self.group_mgr.configure(self.ctx)
+        fake_update_config.assert_called_once_with(
+            self.instance_1, {'config': 'a'}, None)
+
+    @mock.patch('astara.instance_manager.InstanceGroupManager._update_config')
+    @mock.patch('astara.instance_manager._generate_interface_map')
+    @mock.patch('astara.instance_manager.InstanceGroupManager.get_interfaces')
+    def test_configure_pushes_concurrently(self, fake_get_interfaces,
+                                           fake_gen_iface_map,
+                                           fake_update_config):
+        self.fake_driver.is_ha = False
+        self.fake_driver.build_config.return_value = {'config': 'a'}
+        fake_get_interfaces.return_value = {
+            self.instance_1: [], self.instance_2: []}
+        started = dict((i.id_, threading.Event()) for i in self.instances)
+
+        def _update_config(inst, config, base_config):
+            started[inst.id_].set()
+            # each push only returns once the other one has started
+            return all(e.wait(5) for e in started.values())
+
+        fake_update_config.side_effect = _update_config
+        self.assertEqual(self.group_mgr.configure(self.ctx), states.CONFIGURED)
+
+    @mock.patch('astara.instance_manager.InstanceGroupManager._update_config')
+    @mock.patch('astara.instance_manager._generate_interface_map')
+    @mock.patch('astara.instance_manager.InstanceGroupManager.get_interfaces')
+    def test_configure_push_deadline(self, fake_get_interfaces,
+                                     fake_gen_iface_map, fake_update_config):
+        self.config(max_retries=1, config_timeout=1, retry_delay=0)
+        self.fake_driver.is_ha = False
+        self.fake_driver.build_config.return_value = {'config': 'a'}
+        fake_get_interfaces.return_value = {
+            self.instance_1: [], self.instance_2: []}
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def _update_config(inst, config, base_config):
+            if inst is self.instance_2:
+                release.wait(10)
+            return True
+
+        fake_update_config.side_effect = _update_config
+        self.assertEqual(self.group_mgr.configure(self.ctx), states.DEGRADED)
+
+        # only the instance that answered in time is considered configured
+        release.set()
+        fake_update_config.reset_mock()
+        self.assertEqual(self.group_mgr.configure(self.ctx), states.CONFIGURED)
+        fake_update_config.assert_called_once_with(
+            self.instance_2, {'config': 'a'}, None)
+
+    @mock.patch('astara.instance_manager._generate_interface_map')
+    @mock.patch('astara.instance_manager.InstanceGroupManager.get_interfaces')
+    @mock.patch.object(instance_manager, 'time')
+    def test_configure_push_outlives_deadline(self, fake_time,
+                                              fake_get_interfaces,
+                                              fake_gen_iface_map):
+        self.config(max_retries=3, config_timeout=0, retry_delay=0)
+        self.fake_driver.is_ha = False
+        self.fake_driver.build_config.return_value = {'config': 'a'}
+        fake_get_interfaces.return_value = {
+            self.instance_1: [], self.instance_2: []}
+        slow_addr = self.instance_2.management_address
+        in_flight = threading.Event()
+        release = threading.Event()
+        self.addCleanup(release.set)
+        pushed = []
+
+        def _update_config(addr, config, base_config=None):
+            pushed.append((addr, config))
+            if addr == slow_addr and not release.is_set():
+                in_flight.set()
+                release.wait(10)
+                raise Exception('timed out')
+
+        def _now():
+            # the deadline passes while the slow request is on the wire
+            in_flight.wait(5)
+            return 0
+
+        fake_time.time.side_effect = _now
+        self.fake_driver.update_config.side_effect = _update_config
+        self.assertEqual(self.group_mgr.configure(self.ctx), states.DEGRADED)
+        straggler = [t for t in threading.enumerate()
+                     if t.name == 'ConfigPush-%s' % self.instance_2.id_]
+
+        # the newer push waits for the abandoned request to finish and the
+        # abandoned push does not retry after it
+        newer = threading.Thread(
+            target=self.group_mgr._update_config,
+            args=(self.instance_2, {'config': 'b'}))
+        newer.start()
+        release.set()
+        newer.join(5)
+        [t.join(5) for t in straggler]
+        self.assertEqual(
+            [(slow_addr, {'config': 'a'}), (slow_addr, {'config': 'b'})],
+            [p for p in pushed if p[0] == slow_addr])
+
     def test_delete(self):
         self.group_mgr.delete(self.instance_2)
         self.assertNotIn(
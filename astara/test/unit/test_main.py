@@ -28,6 +28,11 @@ from astara.test.unit import base
 @mock.patch('astara.main.populate')
 @mock.patch('astara.main.health')
 class TestMainPippo(base.RugTestBase):
+    def setUp(self):
+        super(TestMainPippo, self).setUp()
+        # time.sleep is mocked, so a reporter thread would never rest.
+        self.config(metrics_report_interval=0)
+
     def test_shuffle_notifications(self, health, populate, scheduler,
                                    notifications, multiprocessing,
                                    neutron_api):
@@ -43,6 +48,40 @@ class TestMainPippo(base.RugTestBase):
             'message'
         )
 
+    def test_shuffle_notifications_rebalance(self, health, populate,
+                                             scheduler, notifications,
+                                             multiprocessing, neutron_api):
+        queue = mock.Mock()
+        message = mock.Mock(crud='rebalance')
+        queue.get.side_effect = [
+            ('*', message),
+            KeyboardInterrupt,
+        ]
+        sched = scheduler.Scheduler.return_value
+        main.shuffle_notifications(queue, sched)
+        populate.add_rebalance_inventory.assert_called_once_with(message)
+        sched.handle_message.assert_called_once_with(
+            '*', populate.add_rebalance_inventory.return_value
+        )
+
+    def test_shuffle_notifications_batch(self, health, populate,
+                                         scheduler, notifications,
+                                         multiprocessing, neutron_api):
+        queue = mock.Mock()
+        queue.get.side_effect = [
+            ('t1', 'm1'),
+            ('t2', 'm2'),
+            ('t3', 'm3'),
+            (None, None),
+        ]
+        queue.empty.side_effect = [False, False, False]
+        sched = scheduler.Scheduler.return_value
+        main.shuffle_notifications(queue, sched)
+        sched.handle_messages.assert_called_once_with(
+            [('t1', 'm1'), ('t2', 'm2'), ('t3', 'm3')]
+        )
+        self.assertFalse(sched.handle_message.called)
+
     def test_shuffle_notifications_error(
             self, health, populate, scheduler, notifications,
             multiprocessing, neutron_api):
@@ -89,3 +128,34 @@ class TestMainPippo(base.RugTestBase):
         main.main(argv=self.argv)
         self.assertEqual(len(notifications.Publisher.mock_calls), 2)
         self.assertEqual(len(notifications.NoopPublisher.mock_calls), 0)
+
+    @mock.patch('astara.main.metrics')
+    @mock.patch('astara.main.shuffle_notifications')
+    def test_metrics_queue(self, shuffle_notifications, metrics, health,
+                           populate, scheduler, notifications,
+                           multiprocessing, neutron_api):
+        main.main(argv=self.argv)
+        metrics_queue = multiprocessing.Queue.return_value
+        metrics.start_reporter.assert_called_once_with(
+            metrics_queue, 'pmain', collect=mock.ANY)
+        self.assertIn(
+            mock.call(target=mock.ANY,
+                      kwargs={'metrics_queue': metrics_queue},
+                      name='rug-api'),
+            multiprocessing.Process.call_args_list)
+        worker_factory = scheduler.Scheduler.call_args[1]['worker_factory']
+        self.assertIs(metrics_queue, worker_factory.keywords['metrics_queue'])
+
+    def test_collect_metrics(self, health, populate, scheduler,
+                             notifications, multiprocessing, neutron_api):
+        queue = mock.Mock()
+        queue.qsize.return_value = 3
+        sched = mock.Mock()
+        sched.queue_depths.return_value = {'p00': 5}
+        with mock.patch.object(main, 'metrics') as metrics:
+            main._collect_metrics(queue, sched)
+        metrics.set_gauge.assert_has_calls([
+            mock.call('astara_queue_depth', 3, queue='notification'),
+            mock.call('astara_queue_depth', 5, queue='scheduler',
+                      worker='p00'),
+        ])
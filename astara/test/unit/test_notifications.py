@@ -19,6 +19,7 @@ import mock
 import uuid
 
 import multiprocessing
+import threading
 
 from astara import commands
 from astara import event
@@ -251,3 +252,239 @@ class TestGetCRUD(base.RugTestBase):
         tenant, e = self.queue.get()
         self.assertEqual('*', tenant)
         self.assertEqual(expected_event, e)
+
+
+class TestNotificationRouter(base.RugTestBase):
+    def _driver(self, event_types):
+        return mock.Mock(**{
+            'notification_event_types.return_value': event_types})
+
+    def test_drivers_for(self):
+        one = self._driver(set(['port.create.end', 'router.create.end']))
+        two = self._driver(set(['port.create.end']))
+        router = notifications.NotificationRouter([one, two])
+        self.assertEqual([one, two], router.drivers_for('port.create.end'))
+        self.assertEqual([one], router.drivers_for('router.create.end'))
+        self.assertEqual([], router.drivers_for('port.create.start'))
+
+    def test_catch_all(self):
+        one = self._driver(set(['port.create.end']))
+        everything = self._driver(None)
+        router = notifications.NotificationRouter([one, everything])
+        self.assertEqual([one, everything],
+                         router.drivers_for('port.create.end'))
+        self.assertEqual([everything], router.drivers_for('anything'))
+
+    def test_uninteresting_event_dropped(self):
+        driver = self._driver(set(['port.create.end']))
+        queue = mock.Mock()
+        endpoint = notifications.NotificationsEndpoint(
+            queue, notifications.NotificationRouter([driver]))
+        endpoint.info(CTXT, 'network.neutron', 'port.create.start', {}, {})
+        self.assertFalse(driver.process_notification.called)
+        self.assertFalse(queue.put.called)
+
+
+class TestCoalesceEvents(base.RugTestBase):
+    def _event(self, crud, resource_id='r1', body=None):
+        return ('t1', event.Event(
+            resource=event.Resource('router', resource_id, 't1'),
+            crud=crud,
+            body=body if body is not None else {},
+        ))
+
+    def test_updates_merged(self):
+        events = [
+            self._event(event.UPDATE, body={'port': {'id': 'p1'}}),
+            self._event(event.UPDATE, resource_id='r2'),
+            self._event(event.UPDATE, body={'port': {'id': 'p2'}}),
+            self._event(event.UPDATE, body={'port': {'id': 'p3'}}),
+        ]
+        result = notifications.coalesce_events(events)
+        self.assertEqual(2, len(result))
+        target, merged = result[0]
+        self.assertEqual('t1', target)
+        self.assertEqual('r1', merged.resource.id)
+        self.assertEqual({'id': 'p3'}, merged.body['port'])
+        self.assertEqual(
+            [{'port': {'id': 'p1'}}, {'port': {'id': 'p2'}}],
+            merged.body['coalesced_payloads'])
+        self.assertEqual('r2', result[1][1].resource.id)
+
+    def test_other_cruds_not_merged(self):
+        events = [
+            self._event(event.UPDATE),
+            self._event(event.DELETE),
+            self._event(event.UPDATE),
+        ]
+        result = notifications.coalesce_events(events)
+        self.assertEqual(
+            [event.UPDATE, event.DELETE, event.UPDATE],
+            [e.crud for t, e in result])
+
+    def test_unknown_resource_not_merged(self):
+        events = [
+            self._event(event.UPDATE, resource_id=None),
+            self._event(event.UPDATE, resource_id=None),
+        ]
+        self.assertEqual(events, notifications.coalesce_events(events))
+
+
+class TestBatchNotificationsEndpoint(base.RugTestBase):
+    def test_info(self):
+        queue = mock.Mock()
+        endpoint = notifications.BatchNotificationsEndpoint(queue)
+        router_id = u'f95fb32d-0072-4675-b4bd-61d829a46aca'
+        port = {
+            'id': 'fake_port_id',
+            'device_id': router_id,
+            'device_owner': 'network:router_interface',
+            'network_id': 'fake_network_id',
+            'tenant_id': CTXT['tenant_id'],
+        }
+        messages = [
+            {'ctxt': CTXT, 'publisher_id': 'network.neutron',
+             'event_type': event_type, 'payload': payload, 'metadata': {}}
+            for event_type, payload in [
+                ('router.interface.create',
+                 {'router.interface': {'id': router_id}}),
+                ('port.create.start', {'port': port}),
+                ('port.create.end', {'port': port}),
+                ('port.change.end', {'port': port}),
+            ]
+        ]
+        endpoint.info(messages)
+        queue.put.assert_called_once_with((CTXT['tenant_id'], mock.ANY))
+        e = queue.put.call_args[0][0][1]
+        self.assertEqual(router_id, e.resource.id)
+        self.assertEqual(event.UPDATE, e.crud)
+        self.assertEqual(2, len(e.body['coalesced_payloads']))
+
+    def test_info_bad_message(self):
+        queue = mock.Mock()
+        endpoint = notifications.BatchNotificationsEndpoint(queue)
+        messages = [
+            {'ctxt': CTXT, 'publisher_id': 'network.neutron',
+             'event_type': 'astara.command', 'payload': None,
+             'metadata': {}},
+            {'ctxt': CTXT, 'publisher_id': 'network.neutron',
+             'event_type': 'astara.command',
+             'payload': {'command': commands.POLL}, 'metadata': {}},
+        ]
+        endpoint.info(messages)
+        queue.put.assert_called_once_with(('*', mock.ANY))
+        self.assertEqual(event.POLL, queue.put.call_args[0][0][1].crud)
+
+
+class TestPublisher(base.RugTestBase):
+    def setUp(self):
+        super(TestPublisher, self).setUp()
+        self.publisher = notifications.Publisher(
+            topic='topic', queue_size=3, bandwidth_interval=60, batch_size=2)
+        self.publisher._notifier = mock.Mock()
+        get_admin_context = mock.patch.object(
+            notifications.context, 'get_admin_context').start()
+        self.addCleanup(mock.patch.stopall)
+        get_admin_context.return_value.to_dict.return_value = {
+            'is_admin': True}
+        self.get_admin_context = get_admin_context
+        self.sent = self.publisher._notifier.info
+
+    def _bandwidth(self, tenant_id, router_id, value):
+        return {
+            'tenant_id': tenant_id,
+            'timestamp': 'ts-%s' % value,
+            'event_type': notifications.BANDWIDTH_EVENT,
+            'payload': {'eth0': {'value': value}},
+            'uuid': router_id,
+        }
+
+    def test_publish_drops_when_full(self):
+        for i in range(5):
+            self.publisher.publish({'event_type': 'e', 'payload': i})
+        self.assertEqual(3, self.publisher._q.qsize())
+        self.assertEqual(2, self.publisher.dropped)
+
+    def test_publish_drops_bandwidth_first(self):
+        self.publisher.publish({'event_type': 'e', 'payload': 1})
+        self.publisher.publish(self._bandwidth('t1', 'r1', 1))
+        self.publisher.publish(self._bandwidth('t1', 'r2', 2))
+        self.publisher.publish({'event_type': 'e', 'payload': 2})
+        self.publisher.publish(self._bandwidth('t1', 'r3', 3))
+        self.assertEqual(
+            [{'event_type': 'e', 'payload': 1},
+             self._bandwidth('t1', 'r2', 2),
+             {'event_type': 'e', 'payload': 2}],
+            list(self.publisher._q.queue))
+        self.assertEqual(2, self.publisher.dropped)
+
+    def test_other_notifications_sent_immediately(self):
+        self.publisher._handle({'event_type': 'e', 'payload': {'a': 1}})
+        self.sent.assert_called_once_with({'is_admin': True}, 'e', {'a': 1})
+
+    def test_bandwidth_aggregated_per_tenant(self):
+        for msg in [self._bandwidth('t1', 'r1', 1),
+                    self._bandwidth('t1', 'r1', 2),
+                    self._bandwidth('t1', 'r2', 3),
+                    self._bandwidth('t1', 'r3', 4),
+                    self._bandwidth('t2', 'r4', 5)]:
+            self.publisher._handle(msg)
+        self.assertFalse(self.sent.called)
+
+        self.publisher._flush_bandwidth()
+        self.assertEqual([
+            mock.call({'is_admin': True}, notifications.BANDWIDTH_BATCH_EVENT,
+                      {'tenant_id': 't1', 'routers': [
+                          {'uuid': 'r1', 'timestamp': 'ts-2',
+                           'bandwidth': {'eth0': {'value': 2}}},
+                          {'uuid': 'r2', 'timestamp': 'ts-3',
+                           'bandwidth': {'eth0': {'value': 3}}}]}),
+            mock.call({'is_admin': True}, notifications.BANDWIDTH_BATCH_EVENT,
+                      {'tenant_id': 't1', 'routers': [
+                          {'uuid': 'r3', 'timestamp': 'ts-4',
+                           'bandwidth': {'eth0': {'value': 4}}}]}),
+            mock.call({'is_admin': True}, notifications.BANDWIDTH_BATCH_EVENT,
+                      {'tenant_id': 't2', 'routers': [
+                          {'uuid': 'r4', 'timestamp': 'ts-5',
+                           'bandwidth': {'eth0': {'value': 5}}}]}),
+        ], self.sent.call_args_list)
+
+        self.sent.reset_mock()
+        self.publisher._flush_bandwidth()
+        self.assertFalse(self.sent.called)
+
+    def test_bandwidth_not_aggregated(self):
+        self.publisher._bandwidth_interval = 0
+        self.publisher._handle(self._bandwidth('t1', 'r1', 1))
+        self.sent.assert_called_once_with(
+            {'is_admin': True}, notifications.BANDWIDTH_EVENT,
+            {'eth0': {'value': 1}})
+
+    def test_context_per_notification(self):
+        # each notification gets its own request id
+        self.publisher.send('e', {})
+        self.publisher.send('e', {})
+        self.assertEqual(2, self.get_admin_context.call_count)
+        self.assertEqual(2, self.sent.call_count)
+
+    def test_publish_counts_drops_from_threads(self):
+        publisher = notifications.Publisher(queue_size=1)
+        threads = [
+            threading.Thread(
+                target=lambda: [publisher.publish({}) for i in range(500)])
+            for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(1999, publisher.dropped)
+
+    def test_stop_flushes_bandwidth(self):
+        self.publisher.start()
+        self.publisher.publish(self._bandwidth('t1', 'r1', 1))
+        self.publisher.stop()
+        self.sent.assert_called_once_with(
+            {'is_admin': True}, notifications.BANDWIDTH_BATCH_EVENT,
+            {'tenant_id': 't1', 'routers': [
+                {'uuid': 'r1', 'timestamp': 'ts-1',
+                 'bandwidth': {'eth0': {'value': 1}}}]})
@@ -92,3 +92,65 @@ class TestPrePopulateWorkers(base.RugTestBase):
         res = populate.repopulate()
         self.assertEqual(
             set(res), set(['driver_0_resource', 'driver_1_resource']))
+
+
+class TestAddRebalanceInventory(base.RugTestBase):
+    def _rebalance(self, **body):
+        body.setdefault('members', ['foo', 'bar'])
+        return event.Event(
+            resource=Resource(id='*', tenant_id='*', driver='*'),
+            crud=event.REBALANCE,
+            body=body,
+        )
+
+    @mock.patch.object(populate, 'repopulate')
+    def test_adds_resources(self, repopulate):
+        repopulate.return_value = ['resource']
+        msg = populate.add_rebalance_inventory(self._rebalance())
+        self.assertEqual(['resource'], msg.body['resources'])
+        self.assertEqual(['foo', 'bar'], msg.body['members'])
+        self.assertEqual(event.REBALANCE, msg.crud)
+
+    @mock.patch.object(populate, 'repopulate')
+    def test_bootstrap_skipped(self, repopulate):
+        msg = self._rebalance(node_bootstrap=True)
+        self.assertIs(msg, populate.add_rebalance_inventory(msg))
+        self.assertFalse(repopulate.called)
+
+    @mock.patch.object(populate, 'repopulate')
+    def test_error(self, repopulate):
+        repopulate.side_effect = Exception('neutron is down')
+        msg = self._rebalance()
+        self.assertIs(msg, populate.add_rebalance_inventory(msg))
+
+
+class TestAddRedistributeInventory(base.RugTestBase):
+    tenant_id = '79f418c8-a849-11e5-9c36-df27538e1b7e'
+
+    def _redistribute(self):
+        return event.Event(
+            resource=Resource(id='*', tenant_id='*', driver='*'),
+            crud=event.REDISTRIBUTE,
+            body={'split_tenants': [self.tenant_id],
+                  'tenants': [self.tenant_id]},
+        )
+
+    @mock.patch.object(populate, 'repopulate')
+    def test_adds_tenant_resources(self, repopulate):
+        resources = [
+            Resource(id='r1', driver='router',
+                     tenant_id=self.tenant_id.replace('-', '')),
+            Resource(id='r2', driver='router',
+                     tenant_id='8d55fdb4-a849-11e5-958f-0b870649546d'),
+        ]
+        repopulate.return_value = resources
+        msg = populate.add_redistribute_inventory(self._redistribute())
+        self.assertEqual(resources[:1], msg.body['resources'])
+        self.assertEqual([self.tenant_id], msg.body['tenants'])
+        self.assertEqual(event.REDISTRIBUTE, msg.crud)
+
+    @mock.patch.object(populate, 'repopulate')
+    def test_error(self, repopulate):
+        repopulate.side_effect = Exception('neutron is down')
+        msg = self._redistribute()
+        self.assertIs(msg, populate.add_redistribute_inventory(msg))
@@ -146,6 +146,20 @@ class TestMessagingService(testtools.TestCase):
         self.connection._add_server.assert_called_with(
             'fake_listener_server')
 
+    @mock.patch.object(oslo_messaging, 'get_batch_notification_listener')
+    def test_create_batch_notification_listener(self, fake_get_listener):
+        self.connection._add_server = mock.MagicMock()
+        fake_get_listener.return_value = 'fake_listener_server'
+        self.connection.create_notification_listener(
+            endpoints=[], exchange='foo_exchange', topic='foo_topic',
+            batch_size=10, batch_timeout=0.5)
+        fake_get_listener.assert_called_with(
+            'fake_transport', ['fake_target'], [],
+            pool='astara.foo_topic.test_host', executor='threading',
+            batch_size=10, batch_timeout=0.5)
+        self.connection._add_server.assert_called_with(
+            'fake_listener_server')
+
     def test__add_server(self):
         fake_server = mock.MagicMock(
             start=mock.MagicMock())
@@ -18,10 +18,13 @@
 import uuid
 
 import mock
+from six.moves import queue as Queue
 from six.moves import range
 from oslo_config import cfg
 import unittest2 as unittest
 
+from astara import commands
+from astara import event
 from astara import scheduler
 
 
@@ -53,12 +56,230 @@ class TestScheduler(unittest.TestCase):
             self.assertEqual(w['queue'].close.call_count, 2)
             self.assertEqual(w['worker'].join.call_count, 2)
 
+    def _mk_process(self, name, **kwargs):
+        process = mock.Mock()
+        process.name = name
+        return process
+
+    def _mk_scheduler(self):
+        cfg.CONF.num_worker_processes = 2
+        with mock.patch('multiprocessing.Process') as process:
+            with mock.patch('multiprocessing.JoinableQueue') as queue:
+                process.side_effect = self._mk_process
+                queue.side_effect = lambda: mock.Mock(
+                    **{'qsize.return_value': 0})
+                with mock.patch('multiprocessing.Queue', Queue.Queue):
+                    return scheduler.Scheduler(mock.Mock)
+
+    def _decode(self, w):
+        return [[scheduler.pickle.loads(d) for d in c[0][0]]
+                for c in w['queue'].put.call_args_list]
+
+    def test_handle_messages_batches_per_worker(self):
+        s = self._mk_scheduler()
+        tenants = {}
+        for i in range(100):
+            tenant_id = str(uuid.UUID(fields=(1, 2, 3, 4, 5, i)))
+            w = s.dispatcher.pick_workers(tenant_id)[0]
+            tenants.setdefault(w['worker'].name, tenant_id)
+        r0, r1 = tenants['p00'], tenants['p01']
+        s.handle_messages([(r0, 'a'), (r1, 'b'), (r0, 'c')])
+        self.assertEqual([[(r0, 'a'), (r0, 'c')]], self._decode(s.workers[0]))
+        self.assertEqual([[(r1, 'b')]], self._decode(s.workers[1]))
+        stats = s.stats()
+        self.assertEqual(3, stats['messages'])
+        self.assertEqual(2, stats['batches'])
+
+    @mock.patch.object(scheduler, '_encode')
+    def test_wildcard_encoded_once(self, encode):
+        encode.return_value = 'data'
+        s = self._mk_scheduler()
+        s.handle_message('*', 'message')
+        encode.assert_called_once_with('*', 'message')
+        for w in s.workers:
+            w['queue'].put.assert_called_once_with(['data'])
+
+    def test_handle_message_no_workers(self):
+        s = self._mk_scheduler()
+        s.handle_message('not-a-uuid', 'message')
+        for w in s.workers:
+            self.assertFalse(w['queue'].put.called)
+
+    def test_workers_debug_reports_status(self):
+        s = self._mk_scheduler()
+        msg = event.Event('*', event.COMMAND,
+                          {'command': commands.WORKERS_DEBUG})
+        with mock.patch.object(s, 'report_status') as report:
+            s.handle_message('*', msg)
+        report.assert_called_once_with()
+
+    def test_queue_depths(self):
+        s = self._mk_scheduler()
+        s.workers[0]['queue'].qsize.return_value = 3
+        s.workers[1]['queue'].qsize.side_effect = NotImplementedError
+        depths = s.queue_depths()
+        self.assertEqual(
+            [3, None],
+            [depths[w['worker'].name] for w in s.workers])
+
+    def _tenant_msg(self, tenant_id, resource_id):
+        return event.Event(
+            resource=event.Resource('router', resource_id, tenant_id),
+            crud=event.UPDATE,
+            body={},
+        )
+
+    def _last_message(self, w):
+        target, message = scheduler.pickle.loads(
+            w['queue'].put.call_args[0][0][-1])
+        return target, message
+
+    def _split(self, s, tenant_id):
+        home = s.dispatcher.pick_workers(tenant_id)[0]
+        home['queue'].qsize.return_value = 10
+        s.handle_message(tenant_id, self._tenant_msg(tenant_id, 'r1'))
+        return self._last_message(s.workers[0])[1].body['handover']
+
+    @mock.patch.object(scheduler.populate, 'repopulate')
+    def test_hot_tenant_split(self, repopulate):
+        cfg.CONF.worker_split_queue_depth = 10
+        self.addCleanup(cfg.CONF.clear_override, 'worker_split_queue_depth')
+        s = self._mk_scheduler()
+        hot = str(uuid.UUID(fields=(1, 2, 3, 4, 5, 1)))
+        other = str(uuid.UUID(fields=(1, 2, 3, 4, 5, 2)))
+        resources = [event.Resource('router', 'r1', hot),
+                     event.Resource('router', 'r2', other)]
+        repopulate.return_value = resources
+        home = s.dispatcher.pick_workers(hot)[0]
+        home['queue'].qsize.return_value = 5
+        s.handle_message(hot, self._tenant_msg(hot, 'r1'))
+        self.assertFalse(s.dispatcher.is_split(hot))
+
+        # the workers are asked to release the tenant's state machines
+        home['queue'].qsize.return_value = 10
+        s.handle_message(hot, self._tenant_msg(hot, 'r2'))
+        self.assertFalse(s.dispatcher.is_split(hot))
+        for w in s.workers:
+            target, message = self._last_message(w)
+            self.assertEqual('*', target)
+            self.assertEqual(event.REDISTRIBUTE, message.crud)
+            self.assertEqual([hot], message.body['tenants'])
+            self.assertEqual([hot], message.body['split_tenants'])
+        handover = message.body['handover']
+
+        # and the tenant's messages are held until they all did
+        for w in s.workers:
+            w['queue'].reset_mock()
+        s.handover_done(handover, s.workers[0]['worker'].name)
+        s.handle_message(hot, self._tenant_msg(hot, 'r3'))
+        for w in s.workers:
+            self.assertFalse(w['queue'].put.called)
+
+        s.handover_done(handover, s.workers[1]['worker'].name)
+        s.handle_message(other, self._tenant_msg(other, 'r4'))
+        self.assertTrue(s.dispatcher.is_split(hot))
+        repopulate.assert_called_once_with()
+        for w in s.workers:
+            target, message = scheduler.pickle.loads(
+                w['queue'].put.call_args_list[0][0][0][0])
+            self.assertEqual(event.REDISTRIBUTE, message.crud)
+            self.assertNotIn('handover', message.body)
+            self.assertEqual([hot], message.body['tenants'])
+            self.assertEqual(['r1'],
+                             [r.id for r in message.body['resources']])
+        held = [m for w in s.workers for batch in self._decode(w)
+                for t, m in batch
+                if getattr(m, 'crud', None) == event.UPDATE]
+        self.assertEqual(['r3', 'r4'], sorted(m.resource.id for m in held))
+
+    @mock.patch.object(scheduler, 'HANDOVER_TIMEOUT', 0)
+    @mock.patch.object(scheduler.populate, 'repopulate')
+    def test_handover_timeout(self, repopulate):
+        cfg.CONF.worker_split_queue_depth = 10
+        self.addCleanup(cfg.CONF.clear_override, 'worker_split_queue_depth')
+        repopulate.return_value = []
+        s = self._mk_scheduler()
+        hot = str(uuid.UUID(fields=(1, 2, 3, 4, 5, 1)))
+        self._split(s, hot)
+        s.handle_message(hot, self._tenant_msg(hot, 'r2'))
+        self.assertTrue(s.dispatcher.is_split(hot))
+
+    @mock.patch.object(scheduler, 'time')
+    @mock.patch.object(scheduler.populate, 'repopulate')
+    def test_cool_tenant_merged(self, repopulate, fake_time):
+        cfg.CONF.worker_split_queue_depth = 10
+        self.addCleanup(cfg.CONF.clear_override, 'worker_split_queue_depth')
+        repopulate.return_value = []
+        fake_time.time.return_value = 100
+        s = self._mk_scheduler()
+        hot = str(uuid.UUID(fields=(1, 2, 3, 4, 5, 1)))
+        handover = self._split(s, hot)
+        for w in s.workers:
+            s.handover_done(handover, w['worker'].name)
+        s.handle_message(hot, self._tenant_msg(hot, 'r2'))
+        self.assertTrue(s.dispatcher.is_split(hot))
+
+        # still busy
+        home = s.dispatcher.pick_workers(hot)[0]
+        fake_time.time.return_value = 100 + scheduler.SPLIT_CHECK_INTERVAL
+        s.handle_message(hot, self._tenant_msg(hot, 'r2'))
+        self.assertNotIn(hot, s._handing_over)
+
+        # the tenant has calmed down
+        home['queue'].qsize.return_value = 4
+        fake_time.time.return_value = 100 + 2 * scheduler.SPLIT_CHECK_INTERVAL
+        s.handle_message(hot, self._tenant_msg(hot, 'r2'))
+        target, message = self._last_message(s.workers[0])
+        self.assertEqual([], message.body['split_tenants'])
+        for w in s.workers:
+            s.handover_done(message.body['handover'], w['worker'].name)
+        s.handle_message(hot, self._tenant_msg(hot, 'r2'))
+        self.assertFalse(s.dispatcher.is_split(hot))
+
+    def test_hot_tenant_split_disabled(self):
+        cfg.CONF.worker_split_queue_depth = 0
+        self.addCleanup(cfg.CONF.clear_override, 'worker_split_queue_depth')
+        s = self._mk_scheduler()
+        hot = str(uuid.UUID(fields=(1, 2, 3, 4, 5, 1)))
+        s.dispatcher.pick_workers(hot)[0]['queue'].qsize.return_value = 1000
+        s.handle_message(hot, self._tenant_msg(hot, 'r1'))
+        self.assertFalse(s.dispatcher.is_split(hot))
+
+    def test_forward(self):
+        s = self._mk_scheduler()
+        s.forward(s.workers[1], 't1', 'm1')
+        self.assertEqual([[('t1', 'm1')]], self._decode(s.workers[1]))
+        self.assertFalse(s.workers[0]['queue'].put.called)
+
+    @mock.patch('astara.daemon.ignore_signals')
+    def test_worker_unpacks_batches(self, ignore_signals):
+        inq = mock.Mock()
+        inq.get.side_effect = [
+            [scheduler._encode('t1', 'm1'), scheduler._encode('t2', 'm2')],
+            None,
+        ]
+        worker = mock.Mock()
+        scheduler._worker(inq, mock.Mock(return_value=worker), None, 'p00')
+        self.assertEqual(
+            [mock.call('t1', 'm1'), mock.call('t2', 'm2'),
+             mock.call(None, None)],
+            worker.handle_message.call_args_list)
+
+
+def _mk_workers(count):
+    workers = []
+    for i in range(count):
+        process = mock.Mock()
+        process.name = 'p%02d' % i
+        workers.append({'queue': mock.Mock(), 'worker': process})
+    return workers
+
 
 class TestDispatcher(unittest.TestCase):
 
     def setUp(self):
         super(TestDispatcher, self).setUp()
-        self.workers = list(range(5))
+        self.workers = _mk_workers(5)
         self.d = scheduler.Dispatcher(self.workers)
 
     def _mk_uuid(self, i):
@@ -66,13 +287,30 @@ class TestDispatcher(unittest.TestCase):
         return str(uuid.UUID(fields=(1, 2, 3, 4, 5, i)))
 
     def test_pick(self):
-        for i in range(len(self.workers)):
+        for i in range(20):
             router_id = self._mk_uuid(i)
-            self.assertEqual(
-                [i],
-                self.d.pick_workers(router_id),
-                'Incorrect index for %s' % router_id,
-            )
+            picked = self.d.pick_workers(router_id)
+            self.assertEqual(1, len(picked))
+            self.assertIn(picked[0], self.workers)
+            self.assertEqual(picked, self.d.pick_workers(router_id))
+
+    def test_pick_spreads_tenants(self):
+        picked = set(self.d.pick_workers(self._mk_uuid(i))[0]['worker'].name
+                     for i in range(100))
+        self.assertEqual(len(self.workers), len(picked))
+
+    def test_pick_stable_when_resized(self):
+        bigger = scheduler.Dispatcher(self.workers + _mk_workers(6)[5:])
+        moved = 0
+        for i in range(200):
+            tenant_id = self._mk_uuid(i)
+            before = self.d.pick_workers(tenant_id)[0]['worker'].name
+            after = bigger.pick_workers(tenant_id)[0]['worker'].name
+            if before != after:
+                # Tenants only ever move to the new worker.
+                self.assertEqual('p05', after)
+                moved += 1
+        self.assertTrue(0 < moved < 100)
 
     def test_pick_none(self):
         router_id = None
@@ -84,11 +322,11 @@ class TestDispatcher(unittest.TestCase):
 
     def test_pick_with_spaces(self):
         for i in range(len(self.workers)):
-            router_id = ' %s ' % self._mk_uuid(i)
+            router_id = self._mk_uuid(i)
             self.assertEqual(
-                [i],
                 self.d.pick_workers(router_id),
-                'Incorrect index for %s' % router_id,
+                self.d.pick_workers(' %s ' % router_id),
+                'Incorrect worker for %s' % router_id,
             )
 
     def test_pick_invalid(self):
@@ -100,6 +338,41 @@ class TestDispatcher(unittest.TestCase):
                 'Found unexpected worker for %r' % router_id,
             )
 
+    def test_pick_resource_id_ignored_unless_split(self):
+        tenant_id = self._mk_uuid(1)
+        expected = self.d.pick_workers(tenant_id)
+        for i in range(20):
+            self.assertEqual(
+                expected,
+                self.d.pick_workers(tenant_id, 'resource-%d' % i))
+
+    def test_split_tenant(self):
+        tenant_id = self._mk_uuid(1)
+        self.assertFalse(self.d.is_split(tenant_id))
+        self.assertTrue(self.d.split_tenant(tenant_id.replace('-', '')))
+        self.assertFalse(self.d.split_tenant(tenant_id))
+        self.assertTrue(self.d.is_split(tenant_id))
+        self.assertFalse(self.d.is_split('not-a-uuid'))
+
+    def test_merge_tenant(self):
+        tenant_id = str(uuid.UUID(fields=(1, 2, 3, 4, 5, 6)))
+        self.assertFalse(self.d.merge_tenant(tenant_id))
+        self.d.split_tenant(tenant_id)
+        self.assertTrue(self.d.merge_tenant(tenant_id.replace('-', '')))
+        self.assertFalse(self.d.is_split(tenant_id))
+
+    def test_set_split_tenants(self):
+        tenant_id = str(uuid.UUID(fields=(1, 2, 3, 4, 5, 6)))
+        self.d.split_tenant(str(uuid.UUID(fields=(1, 2, 3, 4, 5, 7))))
+        self.d.set_split_tenants([tenant_id.replace('-', '')])
+        self.assertEqual(set([tenant_id]), self.d.split_tenants)
+        picked = set(
+            self.d.pick_workers(tenant_id, 'resource-%d' % i)[0]['worker']
+            .name for i in range(100))
+        self.assertEqual(len(self.workers), len(picked))
+        # Without a resource id the tenant's usual worker is used.
+        self.assertEqual(1, len(self.d.pick_workers(tenant_id)))
+
     def test_wildcard(self):
         self.assertEqual(
             self.workers,
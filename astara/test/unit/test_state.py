@@ -15,9 +15,8 @@
 # under the License.
 
 
-from collections import deque
-
 import mock
+import threading
 import unittest2 as unittest
 
 from six.moves import range
@@ -43,7 +42,7 @@ class BaseTestStateCase(unittest.TestCase):
         self.params = state.StateParams(
             driver=self.fake_driver,
             instance=self.instance,
-            queue=deque(),
+            queue=state.Inbox(),
             bandwidth_callback=mock.Mock(),
             reboot_error_threshold=3,
         )
@@ -71,12 +70,69 @@ class TestBaseState(BaseTestStateCase):
         )
 
 
+class TestInbox(unittest.TestCase):
+    def test_put_and_count(self):
+        inbox = state.Inbox([event.UPDATE, event.POLL, event.UPDATE])
+        self.assertEqual(3, len(inbox))
+        self.assertEqual(2, inbox.count(event.UPDATE))
+        self.assertEqual(1, inbox.count(event.POLL))
+        self.assertIn(event.UPDATE, inbox)
+        self.assertNotIn(event.DELETE, inbox)
+
+    def test_actions_in_lane_order(self):
+        inbox = state.Inbox(
+            [event.POLL, event.READ, event.UPDATE, event.DELETE])
+        self.assertEqual(
+            [event.DELETE, event.UPDATE, event.READ, event.POLL],
+            inbox.actions())
+        self.assertEqual(event.DELETE, inbox.most_urgent())
+
+    def test_unknown_actions(self):
+        inbox = state.Inbox(['foo', event.POLL, event.READ])
+        self.assertEqual([event.READ, 'foo', event.POLL], inbox.actions())
+        self.assertLess(inbox.rank(event.READ), inbox.rank('foo'))
+
+    def test_take(self):
+        inbox = state.Inbox([event.UPDATE, event.POLL, event.UPDATE])
+        self.assertEqual(2, inbox.take(event.UPDATE, event.CREATE))
+        self.assertEqual(1, len(inbox))
+        self.assertEqual([event.POLL], list(inbox))
+
+    def test_clear(self):
+        inbox = state.Inbox([event.UPDATE, 'foo', event.POLL])
+        inbox.clear()
+        self.assertFalse(inbox)
+        self.assertEqual(0, len(inbox))
+        self.assertIsNone(inbox.most_urgent())
+
+    def test_concurrent_put_and_take(self):
+        inbox = state.Inbox()
+        taken = []
+        done = threading.Event()
+
+        def _take():
+            while not done.is_set():
+                taken.append(inbox.take(event.UPDATE, event.POLL))
+
+        takers = [threading.Thread(target=_take) for i in range(2)]
+        for t in takers:
+            t.start()
+        for i in range(20000):
+            inbox.put(event.UPDATE if i % 2 else event.POLL)
+        done.set()
+        for t in takers:
+            t.join()
+        taken.append(inbox.take(event.UPDATE, event.POLL))
+        self.assertEqual(20000, sum(taken))
+        self.assertEqual(0, len(inbox))
+
+
 class TestCalcActionState(BaseTestStateCase):
     state_cls = state.CalcAction
 
     def _test_hlpr(self, expected_action, queue_states,
                    leftover=0, initial_action=event.POLL):
-        self.params.queue = deque(queue_states)
+        self.params.queue = state.Inbox(queue_states)
         self.assertEqual(
             self.state.execute(initial_action, self.ctx),
             expected_action
@@ -131,6 +187,32 @@ class TestCalcActionState(BaseTestStateCase):
         ]
         self._test_hlpr(event.UPDATE, events, 0)
 
+    def test_execute_upgrade_to_rebuild(self):
+        events = [event.UPDATE, event.CREATE, event.REBUILD, event.UPDATE]
+        self._test_hlpr(event.REBUILD, events, 0)
+
+    def test_execute_read_after_update(self):
+        events = [event.READ, event.UPDATE, event.POLL]
+        self._test_hlpr(event.UPDATE, events, 1)
+        self.assertEqual([event.READ], list(self.params.queue))
+
+    def test_execute_cluster_rebuild_before_update(self):
+        events = [event.UPDATE, event.CLUSTER_REBUILD]
+        self._test_hlpr(event.CLUSTER_REBUILD, events, 1)
+        self.assertEqual([event.UPDATE], list(self.params.queue))
+
+    def test_execute_carried_action_absorbs_queue(self):
+        self._test_hlpr(event.CREATE, [event.UPDATE, event.POLL],
+                        initial_action=event.CREATE)
+
+    def test_execute_carried_action_kept(self):
+        self._test_hlpr(event.UPDATE, [event.UPDATE], leftover=1,
+                        initial_action=event.READ)
+        self.assertEqual([event.READ], list(self.params.queue))
+
+    def test_execute_many_updates(self):
+        self._test_hlpr(event.UPDATE, [event.UPDATE] * 1000)
+
     def test_transition_update_missing_router_down(self):
         self.ctx.neutron = mock.Mock()
         self.ctx.neutron.get_router_detail.side_effect = RouterGone
@@ -634,6 +716,33 @@ class TestAutomaton(unittest.TestCase):
         self.sm.update(self.ctx)
         self.delete_callback.called_once_with()
 
+    def test_update_cycle(self):
+        message = mock.Mock()
+        message.crud = event.UPDATE
+        self.sm.send_message(message)
+        self.sm.state = state.Exit(mock.Mock())
+        instance = self.instance_mgr_cls.return_value
+        self.sm.update(self.ctx)
+        instance.assert_has_calls([
+            mock.call.begin_update_cycle(),
+            mock.call.end_update_cycle(),
+        ])
+
+    def test_update_records_timings(self):
+        message = mock.Mock()
+        message.crud = event.UPDATE
+        self.sm.send_message(message)
+        self.sm.state = state.Exit(mock.Mock())
+        with mock.patch.object(state, 'metrics') as metrics:
+            self.sm.update(self.ctx)
+        metrics.timed.assert_has_calls([
+            mock.call('astara_update_duration_seconds',
+                      driver=self.fake_driver.RESOURCE_NAME),
+            mock.call('astara_state_duration_seconds',
+                      driver=self.fake_driver.RESOURCE_NAME,
+                      state='Exit'),
+        ], any_order=True)
+
     def test_update_exception_during_excute(self):
         message = mock.Mock()
         message.crud = 'fake'
@@ -705,7 +814,7 @@ class TestAutomaton(unittest.TestCase):
             self.assertFalse(self.sm.has_error())
 
     def test_drop_queue(self):
-        self.sm._queue.append('foo_item')
+        self.sm._queue.put('foo_item')
         self.assertEqual(1, len(self.sm._queue))
         self.sm.drop_queue()
         self.assertEqual(0, len(self.sm._queue))
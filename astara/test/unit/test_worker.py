@@ -15,8 +15,6 @@
 # under the License.
 
 
-import threading
-
 import mock
 from oslo_config import cfg
 import unittest2 as unittest
@@ -55,12 +53,14 @@ class WorkerTestBase(base.DbTestCase):
             neutron, 'Neutron', autospec=True).start()
         fake_neutron_obj.get_ports_for_instance.return_value = (
             'mgt_port', ['ext_port', 'int_port'])
+        fake_neutron_obj.get_ports_for_instances.return_value = {}
         fake_neutron_obj.get_router_for_tenant.return_value = (
             FakeFetchedResource())
         self.fake_neutron = mock.patch.object(
             neutron, 'Neutron', return_value=fake_neutron_obj).start()
 
         self.fake_scheduler = mock.Mock()
+        self.fake_scheduler.dispatcher.is_split.return_value = False
         self.proc_name = 'p0x'
         self.w = worker.Worker(
             notifier=mock.Mock(),
@@ -178,6 +178,35 @@ class TestWorker(WorkerTestBase):
             expected,
             self.w._should_process_message(self.target, msg))
 
+    @mock.patch('astara.worker.hash_ring', autospec=True)
+    def test__should_process_no_router_id_split_tenant(self, fake_hash):
+        fake_ring_manager = fake_hash.HashRingManager()
+        fake_ring_manager.ring.get_hosts.return_value = [self.w.host]
+        self.w.hash_ring_mgr = fake_ring_manager
+        self.fake_cache.get_by_tenant.return_value = (
+            '9846d012-3c75-11e5-b476-8321b3ff1a1d')
+        other = {'worker': mock.Mock()}
+        other['worker'].name = 'p01'
+        dispatcher = self.fake_scheduler.dispatcher
+        dispatcher.is_split.return_value = True
+        dispatcher.pick_workers.return_value = [other]
+        msg = event.Event(
+            resource=event.Resource(
+                driver=router.Router.RESOURCE_NAME,
+                id=None,
+                tenant_id='fake_tenant_id',
+            ),
+            crud=event.CREATE,
+            body={'key': 'value'},
+        )
+        self.assertFalse(self.w._should_process_message(self.target, msg))
+        dispatcher.pick_workers.assert_called_once_with(
+            self.target, '9846d012-3c75-11e5-b476-8321b3ff1a1d')
+        forwarded = self.fake_scheduler.forward.call_args[0]
+        self.assertEqual((other, self.target), forwarded[:2])
+        self.assertEqual('9846d012-3c75-11e5-b476-8321b3ff1a1d',
+                         forwarded[2].resource.id)
+
     def test__should_process_no_router_id_no_router_found(self):
         self.fake_cache.get_by_tenant.return_value = None
         r = event.Resource(
@@ -210,6 +239,25 @@ class TestWorker(WorkerTestBase):
         fake_deliver.assert_called_with(self.target, new_msg)
         fake_should_process.assert_called_with(self.target, self.msg)
 
+    @mock.patch('astara.worker.Worker._deliver_message')
+    @mock.patch('astara.worker.Worker._should_process_message')
+    def test_handle_message_invalidates_cache(self, fake_should_process,
+                                              fake_deliver):
+        fake_should_process.return_value = False
+        self.w.handle_message(self.target, self.msg)
+        self.w._context.neutron.invalidate_cache.assert_called_once_with(
+            self.msg.body, self.resource_id, self.tenant_id)
+
+    @mock.patch('astara.worker.Worker._deliver_message')
+    @mock.patch('astara.worker.Worker._should_process_message')
+    def test_handle_message_wildcard_invalidates_payload(
+            self, fake_should_process, fake_deliver):
+        fake_should_process.return_value = False
+        self.msg.resource = event.Resource(self.driver, '*', '*')
+        self.w.handle_message(self.target, self.msg)
+        self.w._context.neutron.invalidate_cache.assert_called_once_with(
+            self.msg.body, None, None)
+
     @mock.patch('astara.worker.Worker._deliver_message')
     @mock.patch('astara.worker.Worker._should_process_message')
     def test_handle_message_should_not_process(self, fake_should_process,
@@ -355,27 +403,18 @@ class TestWorker(WorkerTestBase):
         self._test__should_process_command(
             fake_hash, cmds=cmds, key=DC_KEY, negative=True)
 
-    def test__release_resource_lock(self):
-        resource_id = '0ae77286-c0d6-11e5-9181-525400137dfc'
-        fake_lock = mock.Mock(release=mock.Mock())
+    def test__add_resource_to_work_queue_coalesces(self):
+        fake_sm = mock.Mock(resource_id='0ae77286-c0d6-11e5-9181-525400137dfc')
+        self.w._add_resource_to_work_queue(fake_sm, event.UPDATE)
+        self.w._add_resource_to_work_queue(fake_sm, event.UPDATE)
+        self.assertEqual(1, self.w.work_queue.qsize())
 
-        self.w._resource_locks = {
-            resource_id: fake_lock
-        }
-        fake_sm = mock.Mock(resource_id=resource_id)
-        self.w._release_resource_lock(fake_sm)
-        self.assertTrue(fake_lock.release.called)
-
-    def test__release_resource_lock_unlocked(self):
-        resource_id = '0ae77286-c0d6-11e5-9181-525400137dfc'
-        fake_lock = mock.Mock(release=mock.Mock())
-        fake_lock.release.side_effect = threading.ThreadError()
-        self.w._resource_locks = {
-            resource_id: fake_lock
-        }
-        fake_sm = mock.Mock(resource_id=resource_id)
-        # just ensure we dont raise
-        self.w._release_resource_lock(fake_sm)
+    def test__add_resource_to_work_queue_in_progress(self):
+        fake_sm = mock.Mock(resource_id='0ae77286-c0d6-11e5-9181-525400137dfc')
+        self.w._add_resource_to_work_queue(fake_sm, event.UPDATE)
+        self.assertEqual([fake_sm], self.w.work_queue.get_batch(timeout=0))
+        self.w._add_resource_to_work_queue(fake_sm, event.UPDATE)
+        self.assertEqual(0, self.w.work_queue.qsize())
 
     def test_worker_context_config(self):
         self.config(astara_metadata_port=1234)
@@ -586,6 +625,60 @@ class TestWildcardMessages(WorkerTestBase):
         ids = sorted(trm.tenant_id for trm in trms)
         self.assertEqual(ids, [self.tenant_id_1, self.tenant_id_2])
 
+    def _poll_all(self):
+        return event.Event(
+            resource=event.Resource(id='*', tenant_id='*', driver='*'),
+            crud=event.POLL,
+            body={},
+        )
+
+    def test_wildcard_poll_probes_health(self):
+        msg = self._poll_all()
+        self.w._should_process_message.return_value = msg
+        sms = self.w._get_all_state_machines()
+        with mock.patch.object(self.w, '_health_sweep') as sweep:
+            self.w.handle_message('*', msg)
+            self.w._health_sweep_thread.join()
+        sweep.assert_called_once_with(mock.ANY, msg)
+        self.assertEqual(sms, set(sweep.call_args[0][0]))
+
+    def test_wildcard_poll_probing_disabled(self):
+        self.config(health_probe_threads=0)
+        msg = self._poll_all()
+        self.w._should_process_message.return_value = msg
+        with mock.patch.object(self.w, '_deliver_message') as deliver:
+            self.w.handle_message('*', msg)
+        deliver.assert_called_once_with('*', msg)
+        self.assertIsNone(self.w._health_sweep_thread)
+
+    def _drain_work_queue(self):
+        while self.w.work_queue.qsize():
+            for sm in self.w.work_queue.get_batch(timeout=0):
+                self.w.work_queue.task_done(sm, requeue=False)
+
+    def test_health_sweep_polls_changed(self):
+        msg = self._poll_all()
+        sms = list(self.w._get_all_state_machines())
+        self._drain_work_queue()
+        with mock.patch.object(self.w.health_prober, 'find_changed') as fc:
+            fc.return_value = sms[:1]
+            self.w._health_sweep(sms, msg)
+        self.assertEqual(1, self.w.work_queue.qsize())
+        self.assertEqual([sms[0]], self.w.work_queue.get_batch(timeout=0))
+
+    def test_health_sweep_skips_released(self):
+        msg = self._poll_all()
+        sms = list(self.w._get_all_state_machines())
+        self._drain_work_queue()
+        trm = self.w.tenant_managers[sms[0].tenant_id]
+        trm.unmanage_resource(sms[0].resource_id)
+        with mock.patch.object(self.w.health_prober, 'find_changed') as fc:
+            fc.return_value = sms[:1]
+            with mock.patch.object(self.w, 'lock') as lock:
+                self.w._health_sweep(sms, msg)
+        lock.__enter__.assert_called_once_with()
+        self.assertEqual(0, self.w.work_queue.qsize())
+
 
 class TestShutdown(WorkerTestBase):
     def test_shutdown_on_null_message(self):
@@ -594,12 +687,12 @@ class TestShutdown(WorkerTestBase):
             meth.assert_called_once_with()
 
     def test_stop_threads(self):
-        original_queue = self.w.work_queue
         self.assertTrue(self.w._keep_going)
+        self.assertFalse(self.w.work_queue.closed)
         self.w._shutdown()
         self.assertFalse(self.w._keep_going)
-        new_queue = self.w.work_queue
-        self.assertIsNot(original_queue, new_queue)
+        self.assertTrue(self.w.work_queue.closed)
+        self.assertIsNone(self.w.work_queue.get_batch(timeout=0))
 
     @mock.patch('kombu.connection.BrokerConnection')
     @mock.patch('kombu.entity.Exchange')
@@ -635,15 +728,17 @@ class TestUpdateStateMachine(WorkerTestBase):
         sm = trm.get_state_machines(self.msg, self.worker_context)[0]
         with mock.patch.object(sm, 'update') as meth:
             self.w.handle_message(self.tenant_id, self.msg)
-            # Add a null message so the worker loop will exit. We have
-            # to do this directly, because if we do it through
-            # handle_message() that triggers shutdown logic that keeps
-            # the loop from working properly.
-            self.w.work_queue.put(None)
+            # Follow the queued batch with a stop message so the worker
+            # loop will exit. We have to do this directly, because if we
+            # do it through handle_message() that triggers shutdown logic
+            # that keeps the loop from working properly.
+            batch = self.w.work_queue.get_batch(timeout=0)
             # We aren't using threads (and we trust that threads do
             # work) so we just invoke the thread target ourselves to
             # pretend.
-            used_context = self.w._thread_target()
+            with mock.patch.object(self.w.work_queue, 'get_batch',
+                                   side_effect=[batch, None]):
+                used_context = self.w._thread_target()
 
             if not negative:
                 meth.assert_called_once_with(used_context)
@@ -680,6 +775,30 @@ class TestReportStatus(WorkerTestBase):
             self.assertTrue(conf.log_opt_values.called)
 
 
+class TestMetrics(WorkerTestBase):
+    def test_no_reporter_without_queue(self):
+        with mock.patch.object(worker.metrics, 'start_reporter') as start:
+            worker.Worker(
+                notifier=mock.Mock(),
+                management_address=fakes.FAKE_MGT_ADDR,
+                scheduler=self.fake_scheduler,
+                proc_name=self.proc_name)._shutdown()
+            start.assert_called_once_with(None, self.proc_name,
+                                          collect=mock.ANY)
+
+    def test_collect_metrics(self):
+        tm = mock.Mock()
+        tm.state_machines.values.return_value = ['sm1', 'sm2']
+        self.w.tenant_managers = {self.tenant_id: tm}
+        self.w.work_queue.put(mock.Mock(resource_id='r1'), event.UPDATE)
+        with mock.patch.object(worker, 'metrics') as metrics:
+            self.w._collect_metrics()
+        metrics.set_gauge.assert_has_calls([
+            mock.call('astara_queue_depth', 1, queue='work'),
+            mock.call('astara_state_machines', 2),
+        ])
+
+
 class TestDebugRouters(WorkerTestBase):
     def setUp(self):
         super(TestDebugRouters, self).setUp()
@@ -700,10 +819,28 @@ class TestDebugRouters(WorkerTestBase):
         self.assertIn(('this-resource-id', 'foo'),
                       self.dbapi.resources_in_debug())
 
+    def testDebugCommandRefreshesCache(self):
+        self.assertEqual(
+            (False, None),
+            self.w.debug_state.resource_in_debug('this-resource-id'))
+        self.w.handle_message(
+            '*',
+            event.Event('*', event.COMMAND,
+                        {'command': commands.RESOURCE_DEBUG,
+                         'resource_id': 'this-resource-id',
+                         'reason': 'foo'}),
+        )
+        self.assertEqual(
+            (True, 'foo'),
+            self.w.debug_state.resource_in_debug('this-resource-id'))
+
     def testManage(self):
         self.enable_debug(resource_id='this-resource-id')
-        lock = mock.Mock()
-        self.w._resource_locks['this-resource-id'] = lock
+        fake_sm = mock.Mock(resource_id='this-resource-id')
+        fake_sm.pending_actions.return_value = [event.POLL]
+        self.w.work_queue.put(fake_sm)
+        self.w.work_queue.get_batch(timeout=0)
+        self.assertTrue(self.w.work_queue.is_in_progress('this-resource-id'))
         r = event.Resource(
             tenant_id='*',
             id='*',
@@ -718,7 +855,8 @@ class TestDebugRouters(WorkerTestBase):
                       'resource_id': 'this-resource-id'}),
         )
         self.assert_not_in_debug(resource_id='this-resource-id')
-        self.assertEqual(lock.release.call_count, 1)
+        self.assertFalse(
+            self.w.work_queue.is_in_progress('this-resource-id'))
 
     def testManageNoLock(self):
         self.enable_debug(resource_id='this-resource-id')
@@ -732,8 +870,6 @@ class TestDebugRouters(WorkerTestBase):
 
     def testManageUnlocked(self):
         self.enable_debug(resource_id='this-resource-id')
-        lock = threading.Lock()
-        self.w._resource_locks['this-resource-id'] = lock
         self.w.handle_message(
             '*',
             event.Event('*', event.COMMAND,
@@ -952,6 +1088,129 @@ class TestRebalance(WorkerTestBase):
         sm2.send_message.assert_called_with(exp_event)
         sm2._add_resource_to_work_queue(sm2)
 
+    @mock.patch('astara.worker.Worker._repopulate')
+    def test_rebalance_shares_inventory_and_old_ring(self, fake_repop):
+        fake_hash = mock.Mock(balanced=True)
+        old_ring = fake_hash.ring
+        self.w.hash_ring_mgr = fake_hash
+        msg = event.Event(
+            resource=self.resource,
+            crud=event.REBALANCE,
+            body={
+                'members': ['foo', 'bar'],
+                'resources': [self.resource],
+            },
+        )
+        self.w.handle_message('*', msg)
+        fake_repop.assert_called_once_with(
+            resources=[self.resource], old_ring=old_ring)
+
+    @mock.patch('astara.populate.repopulate')
+    def test__repopulate_only_moved(self, fake_repopulate):
+        resources = [
+            event.Resource(
+                driver='router',
+                tenant_id='79f418c8-a849-11e5-9c36-df27538e1b7e',
+                id='7f2a1d56-a849-11e5-a0ce-a74ef0b18fa%d' % i,
+            ) for i in range(3)
+        ]
+        old_ring = mock.Mock()
+        old_ring.get_hosts_bulk.return_value = {
+            resources[0].id: [self.fake_host],
+            resources[1].id: ['foo'],
+            resources[2].id: ['foo'],
+        }
+        self.w.hash_ring_mgr = mock.Mock()
+        self.w.hash_ring_mgr.ring.get_hosts_bulk.return_value = {
+            resources[0].id: [self.fake_host],
+            resources[1].id: [self.fake_host],
+            resources[2].id: ['foo'],
+        }
+
+        class FakeWorker(object):
+            name = self.w.proc_name
+        tgt = [{'worker': FakeWorker()}]
+        self.w.scheduler.dispatcher.pick_workers = mock.Mock(return_value=tgt)
+
+        self.w._repopulate(resources=resources, old_ring=old_ring)
+        self.assertFalse(fake_repopulate.called)
+        self.assertEqual(
+            set([resources[1].id]),
+            set(sm.resource_id for sm in self.w._get_all_state_machines()))
+
+    def _redistribute_setup(self):
+        tenant_id = '79f418c8-a849-11e5-9c36-df27538e1b7e'
+        resources = [
+            event.Resource(
+                driver='router',
+                tenant_id=tenant_id,
+                id='7f2a1d56-a849-11e5-a0ce-a74ef0b18fa%d' % i,
+            ) for i in range(2)
+        ] + [
+            event.Resource(
+                driver='router',
+                tenant_id='8d55fdb4-a849-11e5-958f-0b870649546d',
+                id='9005cd5a-a849-11e5-a434-27c4c7c70a8b',
+            ),
+        ]
+
+        class FakeWorker(object):
+            def __init__(self, name):
+                self.name = name
+
+        here = {'worker': FakeWorker(self.w.proc_name)}
+        there = {'worker': FakeWorker('p01')}
+        owners = {resources[0].id: there, resources[1].id: here}
+        dispatcher = self.w.scheduler.dispatcher
+        dispatcher.pick_workers.side_effect = (
+            lambda tenant, resource_id: [owners[resource_id]])
+        return tenant_id, resources
+
+    def _managed_ids(self):
+        return set(sm.resource_id for sm in self.w._get_all_state_machines())
+
+    def test__redistribute_release(self):
+        tenant_id, resources = self._redistribute_setup()
+        # The tenant used to be handled entirely by this worker.
+        for r in resources[:2]:
+            for trm in self.w._get_trms(r.tenant_id):
+                e = event.Event(resource=r, crud=None, body={})
+                trm.get_state_machines(e, self.w._context)
+        self.w.work_queue._in_progress.add(resources[0].id)
+
+        msg = event.Event(
+            resource=event.Resource(driver='*', id='*', tenant_id='*'),
+            crud=event.REDISTRIBUTE,
+            body={'split_tenants': [tenant_id],
+                  'tenants': [tenant_id],
+                  'handover': 7},
+        )
+        self.w.handle_message('*', msg)
+        self.w.scheduler.dispatcher.set_split_tenants.assert_called_once_with(
+            [tenant_id])
+        self.assertEqual(set([resources[1].id]), self._managed_ids())
+        # the update under way for the released resource is waited for
+        self.assertFalse(self.w.scheduler.handover_done.called)
+        self.w.work_queue.release(resources[0].id)
+        self.w._ack_handovers()
+        self.w.scheduler.handover_done.assert_called_once_with(
+            7, self.w.proc_name)
+
+    @mock.patch('astara.populate.repopulate')
+    def test__redistribute_place(self, fake_repopulate):
+        tenant_id, resources = self._redistribute_setup()
+        msg = event.Event(
+            resource=event.Resource(driver='*', id='*', tenant_id='*'),
+            crud=event.REDISTRIBUTE,
+            body={'split_tenants': [tenant_id],
+                  'tenants': [tenant_id],
+                  'resources': resources},
+        )
+        self.w.handle_message('*', msg)
+        self.assertFalse(fake_repopulate.called)
+        self.assertFalse(self.w.scheduler.handover_done.called)
+        self.assertEqual(set([resources[1].id]), self._managed_ids())
+
     @mock.patch('astara.populate.repopulate')
     def test__repopulate_sm_removed(self, fake_repopulate):
         fake_ring = mock.Mock(
@@ -978,9 +1237,10 @@ class TestRebalance(WorkerTestBase):
                 e = event.Event(resource=r, crud=None, body={})
                 trm.get_state_machines(e, self.w._context)
 
-        fake_hash.ring.get_hosts.side_effect = [
-            'foo', self.fake_host
-        ]
+        fake_hash.ring.get_hosts_bulk.return_value = {
+            rsc1.id: ['foo'],
+            rsc2.id: [self.fake_host],
+        }
         fake_repopulate.return_value = resources
 
         # mock doesn't like to have its .name overwritten?
@@ -1027,9 +1287,8 @@ class TestRebalance(WorkerTestBase):
                 e = event.Event(resource=r, crud=None, body={})
                 trm.get_state_machines(e, self.w._context)
 
-        fake_hash.ring.get_hosts.side_effect = [
-            self.fake_host, self.fake_host, self.fake_host
-        ]
+        fake_hash.ring.get_hosts_bulk.return_value = dict(
+            (r.id, [self.fake_host]) for r in resources)
         fake_repopulate.return_value = resources
 
         # mock doesn't like to have its .name overwritten?
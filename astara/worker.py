@@ -18,8 +18,6 @@
 """Worker process parts.
 """
 
-import collections
-import Queue
 import threading
 import uuid
 import six
@@ -34,8 +32,12 @@ from astara import commands
 from astara import drivers
 from astara.common.i18n import _LE, _LI, _LW
 from astara import event
+from astara import health
 from astara import tenant
+from astara.common import debug_cache
 from astara.common import hash_ring
+from astara.common import metrics
+from astara.common import work_queue
 from astara.api import nova
 from astara.api import neutron
 from astara.db import api as db_api
@@ -65,7 +67,17 @@ WORKER_OPTS = [
         'num_worker_threads',
         default=4,
         help='the number of worker threads to run per process'),
-
+    cfg.IntOpt(
+        'work_queue_batch_size',
+        default=1,
+        help=('the maximum number of state machines a worker thread takes '
+              'from the work queue at once')),
+    cfg.IntOpt(
+        'debug_state_refresh_interval',
+        default=10,
+        help=('the maximum number of seconds a worker process answers debug '
+              'mode checks from its cached copy of the debug mode tables; '
+              '0 queries the database for every check')),
 ]
 CONF.register_opts(WORKER_OPTS)
 
@@ -127,8 +139,10 @@ class WorkerContext(object):
     """
 
     def __init__(self, management_address=None):
-        self.neutron = neutron.Neutron(cfg.CONF)
-        self.nova_client = nova.Nova(cfg.CONF)
+        self.neutron = neutron.Neutron(cfg.CONF, cache=neutron.RESPONSE_CACHE,
+                                       status_writer=neutron.STATUS_WRITER)
+        self.nova_client = nova.Nova(cfg.CONF,
+                                     server_index=nova.SERVER_INDEX)
         self.management_address = management_address
 
     @property
@@ -147,12 +161,16 @@ class Worker(object):
     track of a bunch of the state machines, so the callable is a
     method of an instance of this class instead of a simple function.
     """
-    def __init__(self, notifier, management_address, scheduler, proc_name):
+    def __init__(self, notifier, management_address, scheduler, proc_name,
+                 metrics_queue=None):
         self._ignore_directory = cfg.CONF.ignored_router_directory
         self._queue_warning_threshold = cfg.CONF.queue_warning_threshold
         self._reboot_error_threshold = cfg.CONF.reboot_error_threshold
         self.host = cfg.CONF.host
-        self.work_queue = Queue.Queue()
+        self.work_queue = work_queue.WorkQueue(
+            consumers=cfg.CONF.num_worker_threads,
+            batch_size=cfg.CONF.work_queue_batch_size,
+        )
         self.lock = threading.Lock()
         self._keep_going = True
         self.tenant_managers = {}
@@ -171,10 +189,9 @@ class Worker(object):
 
         # The DB is used for tracking debug modes
         self.db_api = db_api.get_instance()
+        self.debug_state = debug_cache.DebugModeCache(
+            self.db_api, cfg.CONF.debug_state_refresh_interval)
 
-        # Thread locks for the routers so we only put one copy in the
-        # work queue at a time
-        self._resource_locks = collections.defaultdict(threading.Lock)
         # Messages about what each thread is doing, keyed by thread id
         # and reported by the debug command.
         self._thread_status = {}
@@ -190,11 +207,33 @@ class Worker(object):
 
         self.hash_ring_mgr = hash_ring.HashRingManager()
         self._deferred_messages = []
+        # (handover id, ids of the released resources still being updated)
+        # of the handovers to acknowledge once those updates are done
+        self._handover_lock = threading.Lock()
+        self._handovers = []
+
+        self.health_prober = health.HealthProber(
+            cfg.CONF.health_probe_threads)
+        self._health_sweep_thread = None
 
         for t in self.threads:
             t.setDaemon(True)
             t.start()
 
+        # Send our metrics to the rug-api so it can combine them with
+        # those of the other worker processes.
+        metrics.start_reporter(metrics_queue, proc_name,
+                               collect=self._collect_metrics)
+
+    def _collect_metrics(self):
+        metrics.set_gauge('astara_queue_depth', self.work_queue.qsize(),
+                          queue='work')
+        metrics.set_gauge(
+            'astara_state_machines',
+            sum(len(tm.state_machines.values())
+                for tm in list(self.tenant_managers.values())),
+        )
+
     def _thread_target(self):
         """This method runs in each worker thread.
         """
@@ -206,82 +245,76 @@ class Worker(object):
         # thread-safe.
         context = WorkerContext(self.management_address)
         while self._keep_going:
-            try:
-                # Try to get a state machine from the work queue. If
-                # there's nothing to do, we will block for a while.
-                self._thread_status[my_id] = 'waiting for task'
-                sm = self.work_queue.get(timeout=10)
-            except Queue.Empty:
-                continue
-            if sm is None:
+            # Try to get some state machines from the work queue. If
+            # there's nothing to do, we will block for a while.
+            self._thread_status[my_id] = 'waiting for task'
+            batch = self.work_queue.get_batch(timeout=10)
+            if batch is None:
                 LOG.info(_LI('received stop message'))
                 break
-
-            # Make sure we didn't already have some updates under way
-            # for a router we've been told to ignore for debug mode.
-            should_ignore, reason = \
-                self.db_api.resource_in_debug(sm.resource_id)
-            if should_ignore:
-                LOG.debug('Skipping update of resource %s in debug mode. '
-                          '(reason: %s)', sm.resource_id, reason)
-                continue
-
-            # In the event that a rebalance took place while processing an
-            # event, it may have been put back into the work queue. Check
-            # the hash table once more to find out if we still manage it
-            # and do some cleanup if not.
-            if cfg.CONF.coordination.enabled:
-                target_hosts = self.hash_ring_mgr.ring.get_hosts(
-                    sm.resource_id)
-                if self.host not in target_hosts:
-                    LOG.debug('Skipping update of router %s, it no longer '
-                              'maps here.', sm.resource_id)
-                    trm = self.tenant_managers[sm.tenant_id]
-                    trm.unmanage_resource(sm.resource_id)
-                    self.work_queue.task_done()
-                    with self.lock:
-                        self._release_resource_lock(sm)
-                    continue
-
-            # FIXME(dhellmann): Need to look at the router to see if
-            # it belongs to a tenant which is in debug mode, but we
-            # don't have that data in the sm, yet.
-            LOG.debug('performing work on %s for tenant %s',
-                      sm.resource_id, sm.tenant_id)
-            try:
-                self._thread_status[my_id] = 'updating %s' % sm.resource_id
-                sm.update(context)
-            except:
-                LOG.exception(_LE('could not complete update for %s'),
-                              sm.resource_id)
-            finally:
-                self._thread_status[my_id] = (
-                    'finalizing task for %s' % sm.resource_id
-                )
-                self.work_queue.task_done()
-                with self.lock:
-                    # Release the lock that prevents us from adding
-                    # the state machine back into the queue. If we
-                    # find more work, we will re-acquire it. If we do
-                    # not find more work, we hold the primary work
-                    # queue lock so the main thread cannot put the
-                    # state machine back into the queue until we
-                    # release that lock.
-                    self._release_resource_lock(sm)
-                    # The state machine has indicated that it is done
-                    # by returning. If there is more work for it to
-                    # do, reschedule it by placing it at the end of
-                    # the queue.
-                    if sm.has_more_work():
-                        LOG.debug('%s has more work, returning to work queue',
-                                  sm.resource_id)
-                        self._add_resource_to_work_queue(sm)
-                    else:
-                        LOG.debug('%s has no more work', sm.resource_id)
+            for sm in batch:
+                self._process_state_machine(my_id, sm, context)
         # Return the context object so tests can look at it
         self._thread_status[my_id] = 'exiting'
         return context
 
+    def _process_state_machine(self, my_id, sm, context):
+        """Run one update of a state machine taken from the work queue.
+        """
+        # Make sure we didn't already have some updates under way
+        # for a router we've been told to ignore for debug mode.
+        should_ignore, reason = \
+            self.debug_state.resource_in_debug(sm.resource_id)
+        if should_ignore:
+            LOG.debug('Skipping update of resource %s in debug mode. '
+                      '(reason: %s)', sm.resource_id, reason)
+            # Leave the state machine marked as in progress so it is not
+            # queued again until the resource is managed again.
+            return
+
+        # In the event that a rebalance took place while processing an
+        # event, it may have been put back into the work queue. Check
+        # the hash table once more to find out if we still manage it
+        # and do some cleanup if not.
+        if cfg.CONF.coordination.enabled:
+            target_hosts = self.hash_ring_mgr.ring.get_hosts(
+                sm.resource_id)
+            if self.host not in target_hosts:
+                LOG.debug('Skipping update of router %s, it no longer '
+                          'maps here.', sm.resource_id)
+                trm = self.tenant_managers[sm.tenant_id]
+                trm.unmanage_resource(sm.resource_id)
+                self.work_queue.task_done(sm, requeue=False)
+                return
+
+        # FIXME(dhellmann): Need to look at the router to see if
+        # it belongs to a tenant which is in debug mode, but we
+        # don't have that data in the sm, yet.
+        LOG.debug('performing work on %s for tenant %s',
+                  sm.resource_id, sm.tenant_id)
+        try:
+            self._thread_status[my_id] = 'updating %s' % sm.resource_id
+            sm.update(context)
+        except:
+            LOG.exception(_LE('could not complete update for %s'),
+                          sm.resource_id)
+        finally:
+            self._thread_status[my_id] = (
+                'finalizing task for %s' % sm.resource_id
+            )
+            # The state machine has indicated that it is done by
+            # returning. If there is more work for it to do, the work
+            # queue reschedules it. Messages delivered while we were
+            # working on it were coalesced, so this check happens under
+            # the work queue lock to avoid losing them.
+            if self.work_queue.task_done(sm):
+                LOG.debug('%s has more work, returning to work queue',
+                          sm.resource_id)
+            if self._handovers:
+                self._ack_handovers()
+            else:
+                LOG.debug('%s has no more work', sm.resource_id)
+
     def _shutdown(self):
         """Stop the worker.
         """
@@ -291,13 +324,12 @@ class Worker(object):
             self.notifier.stop()
         # Stop the worker threads
         self._keep_going = False
-        # Drain the task queue by discarding it
+        # Drain the task queue by discarding it, which also wakes up
+        # the threads waiting on it so they exit.
         # FIXME(dhellmann): This could prevent us from deleting
         # routers that need to be deleted.
-        self.work_queue = Queue.Queue()
-        for t in self.threads:
-            LOG.debug('sending stop message to %s', t.getName())
-            self.work_queue.put((None, None))
+        LOG.debug('sending stop message to worker threads')
+        self.work_queue.close()
         # Wait for our threads to finish
         for t in self.threads:
             LOG.debug('waiting for %s to finish', t.getName())
@@ -312,6 +344,8 @@ class Worker(object):
             for trm in self.tenant_managers.values():
                 LOG.debug('stopping tenant manager for %s', trm.tenant_id)
                 trm.shutdown()
+        # Write the statuses still waiting for the status writer.
+        neutron.STATUS_WRITER.flush()
 
     def _get_trms(self, target):
         if target.lower() in commands.WILDCARDS:
@@ -370,20 +404,23 @@ class Worker(object):
 
     def _should_process_message(self, target, message):
         """Determines whether a message should be processed or not."""
-        global_debug, reason = self.db_api.global_debug()
+        global_debug, reason = self.debug_state.global_debug()
         if global_debug:
             LOG.info('Skipping incoming event, cluster in global debug '
                      'mode. (reason: %s)', reason)
             return False
 
         if message.resource.id not in commands.WILDCARDS:
+            had_id = bool(message.resource.id)
             message = self._populate_resource_id(message)
             if not message.resource.id:
                 LOG.info(_LI('Ignoring message with no resource found.'))
                 return False
+            if not had_id and self._forward_to_owner(target, message):
+                return False
 
             should_ignore, reason = \
-                self.db_api.tenant_in_debug(message.resource.tenant_id)
+                self.debug_state.tenant_in_debug(message.resource.tenant_id)
             if should_ignore:
                 LOG.info(
                     'Ignoring message intended for tenant %s in debug mode '
@@ -392,7 +429,7 @@ class Worker(object):
                 )
                 return False
 
-            should_ignore, reason = self.db_api.resource_in_debug(
+            should_ignore, reason = self.debug_state.resource_in_debug(
                 message.resource.id)
             if should_ignore:
                 LOG.info(
@@ -416,6 +453,26 @@ class Worker(object):
 
         return message
 
+    def _forward_to_owner(self, target, message):
+        """Pass on a message that turned out to be for another worker.
+
+        Messages without a resource id go to the worker handling the
+        tenant. If the tenant has been split, the resource we found may be
+        managed by a different worker.
+
+        :returns: True if the message was forwarded.
+        """
+        dispatcher = self.scheduler.dispatcher
+        if not dispatcher.is_split(message.resource.tenant_id):
+            return False
+        tgt = dispatcher.pick_workers(target, message.resource.id)
+        if not tgt or tgt[0]['worker'].name == self.proc_name:
+            return False
+        LOG.debug('Forwarding message for resource %s to worker %s',
+                  message.resource.id, tgt[0]['worker'].name)
+        self.scheduler.forward(tgt[0], target, message)
+        return True
+
     def _ring_balanced(self):
         return self.hash_ring_mgr.balanced
 
@@ -454,15 +511,69 @@ class Worker(object):
             self._dispatch_command(target, message)
         elif message.crud == event.REBALANCE:
             self._rebalance(message)
+        elif message.crud == event.REDISTRIBUTE:
+            self._redistribute(message)
         else:
+            # Drop any cached Neutron lookups the notification makes stale
+            # before deciding what to do with it.
+            resource = message.resource
+            router_id = tenant_id = None
+            if (resource.driver == drivers.router.Router.RESOURCE_NAME and
+                    resource.id not in commands.WILDCARDS):
+                router_id = resource.id
+            if resource.tenant_id not in commands.WILDCARDS:
+                tenant_id = resource.tenant_id
+            self._context.neutron.invalidate_cache(
+                message.body, router_id, tenant_id)
             message = self._should_process_message(target, message)
             if not message:
                 return
+            if self._is_health_check(target, message):
+                self._start_health_sweep(target, message)
+                return
             # This is an update command for the router, so deliver it
             # to the state machine.
             with self.lock:
                 self._deliver_message(target, message)
 
+    def _is_health_check(self, target, message):
+        return (message.crud == event.POLL and
+                cfg.CONF.health_probe_threads > 0 and
+                target in commands.WILDCARDS and
+                message.resource.id in commands.WILDCARDS)
+
+    def _start_health_sweep(self, target, message):
+        """Probe all of our appliances in the background.
+
+        Probing can take up to the liveness timeout, so it runs in its own
+        thread to keep this one receiving messages.
+        """
+        sweep = self._health_sweep_thread
+        if sweep is not None and sweep.is_alive():
+            LOG.info(_LI('previous health check still running, skipping'))
+            return
+        with self.lock:
+            sms = []
+            for trm in self._get_trms(target):
+                sms.extend(trm.get_all_state_machines())
+        self._health_sweep_thread = threading.Thread(
+            name='HealthSweep',
+            target=self._health_sweep,
+            args=(sms, message),
+        )
+        self._health_sweep_thread.setDaemon(True)
+        self._health_sweep_thread.start()
+
+    def _health_sweep(self, sms, message):
+        changed = self.health_prober.find_changed(sms)
+        # Deliver like the message thread does, skipping the state
+        # machines given up while the appliances were being probed.
+        with self.lock:
+            managed = self._get_all_state_machines()
+            for sm in changed:
+                if sm in managed and sm.send_message(message):
+                    self._add_resource_to_work_queue(sm, message.crud)
+
     def _find_state_machine_by_resource_id(self, resource_id):
         for trm in self.tenant_managers.values():
             sm = trm.get_state_machine_by_resource_id(resource_id)
@@ -475,7 +586,7 @@ class Worker(object):
             sms.update(trm.get_all_state_machines())
         return sms
 
-    def _repopulate(self):
+    def _repopulate(self, resources=None, old_ring=None):
         """Repopulate local state machines given the new DHT
 
         After the hash ring has been rebalanced, this ensures the workers'
@@ -483,36 +594,69 @@ class Worker(object):
         current layout of the ring. We also consult the dispatcher to ensure
         we're creating state machines on the correct worker process.  This
         also cleans up state machines that are no longer mapped here.
+
+        :param resources: The resource inventory shared with the rebalance
+                          event. Fetched from the drivers when missing.
+        :param old_ring: The ring before the rebalance. When given, only
+                         resources that moved to or away from this host
+                         are looked at.
         """
         LOG.debug('Running post-rebalance repopulate for worker %s',
                   self.proc_name)
-        for resource in populate.repopulate():
-            target_hosts = self.hash_ring_mgr.ring.get_hosts(
-                resource.id)
-            if self.host not in target_hosts:
+        if resources is None:
+            resources = populate.repopulate()
+        ids = [r.id for r in resources]
+        target_hosts = self.hash_ring_mgr.ring.get_hosts_bulk(ids)
+        if old_ring is not None:
+            old_hosts = old_ring.get_hosts_bulk(ids)
+            resources = [
+                r for r in resources
+                if ((self.host in old_hosts[r.id]) !=
+                    (self.host in target_hosts[r.id]))
+            ]
+            LOG.debug('%d of %d resources changed owner in the rebalance',
+                      len(resources), len(ids))
+
+        for resource in resources:
+            if self.host not in target_hosts[resource.id]:
                 tid = _normalize_uuid(resource.tenant_id)
                 if tid in self.tenant_managers:
                     trm = self.tenant_managers[tid]
                     trm.unmanage_resource(resource.id)
-                    continue
+                continue
 
-            tgt = self.scheduler.dispatcher.pick_workers(
-                resource.tenant_id)[0]
+            self._place_resource(resource)
 
-            if tgt['worker'].name != self.proc_name:
-                # Typically, state machine creation doesn't happen until the
-                # dispatcher has scheduled a msg to a single worker. rebalances
-                # are scheduled to all workers so we need to consult the
-                # dispatcher here to avoid creating state machines in all
-                # workers.
-                continue
+    def _place_resource(self, resource):
+        """Manage a resource here if the dispatcher sends its messages here.
 
-            for trm in self._get_trms(resource.tenant_id):
-                # creates a state machine if one does not exist.
-                e = event.Event(resource=resource, crud=None, body={})
-                trm.get_state_machines(e, self._context)
+        Typically, state machine creation doesn't happen until the
+        dispatcher has scheduled a msg to a single worker. Rebalances and
+        redistributions are scheduled to all workers so we need to consult
+        the dispatcher here to avoid creating state machines in all
+        workers.
+        """
+        tgt = self.scheduler.dispatcher.pick_workers(
+            resource.tenant_id, resource.id)[0]
+
+        if tgt['worker'].name != self.proc_name:
+            tid = _normalize_uuid(resource.tenant_id)
+            if tid in self.tenant_managers:
+                self.tenant_managers[tid].unmanage_resource(resource.id)
+            return
+
+        for trm in self._get_trms(resource.tenant_id):
+            # creates a state machine if one does not exist.
+            e = event.Event(resource=resource, crud=None, body={})
+            trm.get_state_machines(e, self._context)
 
     def _rebalance(self, message):
+        # Keep the old ring around so we only have to look at the resources
+        # whose owner changed.
+        old_ring = None
+        if self.hash_ring_mgr.balanced:
+            old_ring = self.hash_ring_mgr.ring
+
         # rebalance the ring with the new membership.
         self.hash_ring_mgr.rebalance(message.body.get('members'))
 
@@ -531,7 +675,8 @@ class Worker(object):
         orig_sms = self._get_all_state_machines()
 
         # rebuild the TRMs and SMs based on new ownership
-        self._repopulate()
+        self._repopulate(resources=message.body.get('resources'),
+                         old_ring=old_ring)
 
         # TODO(adam_g): Replace the UPDATE with a POST_REBALANCE commnand
         # that triggers a driver method instead of generic update.
@@ -543,13 +688,107 @@ class Worker(object):
             LOG.debug('Sending post-rebalance update for %s',
                       sm.resource_id)
             if sm.send_message(post_rebalance):
-                self._add_resource_to_work_queue(sm)
+                self._add_resource_to_work_queue(sm, event.UPDATE)
 
         # NOTE(adam_g): If somethings queued up on a SM, it means the SM
         # is currently executing something thats probably long running
         # (ie a create).  We should add some smarts here to transfer the
         # currently executing task to the new owner
 
+    def _redistribute(self, message):
+        """Follow the scheduler's decision to split or merge tenants.
+
+        The scheduler splits a tenant when the worker handling it falls
+        behind, placing each of its resources on the worker picked by
+        resource id, and merges it back once its load drops. It first asks
+        every worker to release the tenant's state machines that no longer
+        belong to it, holding the tenant's messages until all of them have
+        acknowledged, then sends the tenant's resources so that each worker
+        starts managing the ones that moved to it.
+        """
+        body = message.body
+        self.scheduler.dispatcher.set_split_tenants(
+            body.get('split_tenants', []))
+        tenants = set(_normalize_uuid(t) for t in body.get('tenants', []))
+        if 'handover' in body:
+            self._release_tenants(tenants, body['handover'])
+        elif tenants:
+            self._place_tenants(tenants, body.get('resources'))
+
+    def _release_tenants(self, tenants, handover):
+        """Give up the state machines of tenants that moved away.
+
+        The handover is acknowledged once the updates already under way
+        for the released state machines are done, so that the new owner
+        does not start working on a resource this worker is still
+        changing.
+        """
+        dispatcher = self.scheduler.dispatcher
+        released = []
+        with self.lock:
+            for tenant_id in tenants:
+                trm = self.tenant_managers.get(tenant_id)
+                if trm is None:
+                    continue
+                for sm in list(trm.get_all_state_machines()):
+                    tgt = dispatcher.pick_workers(tenant_id, sm.resource_id)
+                    if tgt and tgt[0]['worker'].name == self.proc_name:
+                        continue
+                    trm.unmanage_resource(sm.resource_id)
+                    released.append(sm.resource_id)
+        LOG.debug('Released %d resources of tenants %s on worker %s',
+                  len(released), ', '.join(sorted(tenants)), self.proc_name)
+        # Resources in debug mode stay marked in progress without being
+        # worked on.
+        busy = set(r for r in released
+                   if self.work_queue.is_in_progress(r) and
+                   not self.debug_state.resource_in_debug(r)[0])
+        with self._handover_lock:
+            self._handovers.append((handover, busy))
+        self._ack_handovers()
+
+    def _ack_handovers(self):
+        """Acknowledge the handovers whose released resources are idle."""
+        done = []
+        with self._handover_lock:
+            pending = []
+            for handover, busy in self._handovers:
+                if any(self.work_queue.is_in_progress(r) for r in busy):
+                    pending.append((handover, busy))
+                else:
+                    done.append(handover)
+            self._handovers = pending
+        for handover in done:
+            self.scheduler.handover_done(handover, self.proc_name)
+
+    def _place_tenants(self, tenants, resources=None):
+        """Start managing the resources of tenants that moved here.
+
+        :param resources: The inventory shared with the redistribute
+                          event. Fetched from the drivers when missing.
+        """
+        LOG.debug('Redistributing resources of tenants %s on worker %s',
+                  ', '.join(sorted(tenants)), self.proc_name)
+        if resources is None:
+            resources = populate.repopulate()
+        resources = [r for r in resources
+                     if _normalize_uuid(r.tenant_id) in tenants]
+        if cfg.CONF.coordination.enabled:
+            target_hosts = self.hash_ring_mgr.ring.get_hosts_bulk(
+                [r.id for r in resources])
+            resources = [r for r in resources
+                         if self.host in target_hosts[r.id]]
+
+        with self.lock:
+            orig_sms = self._get_all_state_machines()
+            for resource in resources:
+                self._place_resource(resource)
+            for sm in (self._get_all_state_machines() - orig_sms):
+                update = event.Event(resource=sm.resource, crud=event.UPDATE,
+                                     body={})
+                if sm.send_message(update):
+                    self._add_resource_to_work_queue(sm, event.UPDATE)
+
     def _should_process_command(self, message):
         command = message.body['command']
 
@@ -623,6 +862,7 @@ class Worker(object):
                 LOG.info(_LI('Placing resource %s in debug mode (reason: %s)'),
                          resource_id, reason)
                 self.db_api.enable_resource_debug(resource_id, reason)
+                self.debug_state.invalidate()
 
         elif (instructions['command'] == commands.RESOURCE_MANAGE or
               instructions['command'] == commands.ROUTER_MANAGE):
@@ -634,18 +874,13 @@ class Worker(object):
                 return
             try:
                 self.db_api.disable_resource_debug(resource_id)
+                self.debug_state.invalidate()
                 LOG.info(_LI('Resuming management of resource %s'),
                          resource_id)
             except KeyError:
                 pass
-            try:
-                self._resource_locks[resource_id].release()
+            if self.work_queue.release(resource_id):
                 LOG.info(_LI('Unlocked resource %s'), resource_id)
-            except KeyError:
-                pass
-            except threading.ThreadError:
-                # Already unlocked, that's OK.
-                pass
 
         elif instructions['command'] in EVENT_COMMANDS:
             resource_id = instructions.get('resource_id')
@@ -703,11 +938,13 @@ class Worker(object):
                 LOG.info(_LI('Placing tenant %s in debug mode (reason: %s)'),
                          tenant_id, reason)
                 self.db_api.enable_tenant_debug(tenant_id, reason)
+                self.debug_state.invalidate()
 
         elif instructions['command'] == commands.TENANT_MANAGE:
             tenant_id = instructions['tenant_id']
             try:
                 self.db_api.disable_tenant_debug(tenant_id)
+                self.debug_state.invalidate()
                 LOG.info(_LI('Resuming management of tenant %s'), tenant_id)
             except KeyError:
                 pass
@@ -718,9 +955,11 @@ class Worker(object):
             if enable == 1:
                 LOG.info('Enabling global debug mode (reason: %s)', reason)
                 self.db_api.enable_global_debug(reason)
+                self.debug_state.invalidate()
             elif enable == 0:
                 LOG.info('Disabling global debug mode')
                 self.db_api.disable_global_debug()
+                self.debug_state.invalidate()
             else:
                 LOG.warning('Unrecognized global debug command: %s',
                             instructions)
@@ -745,33 +984,22 @@ class Worker(object):
                 # Add the message to the state machine's inbox. If
                 # there is already a thread working on the router,
                 # that thread will pick up the new work when it is
-                # done with the current job. The work queue lock is
-                # acquired before asking the state machine if it has
-                # more work, so this block of code won't be executed
-                # at the same time as the thread trying to decide if
-                # the router is done.
+                # done with the current job. The work queue checks
+                # whether the state machine has more work under its
+                # own lock, so the message is delivered before the
+                # thread can decide the router is done.
                 if sm.send_message(message):
-                    self._add_resource_to_work_queue(sm)
+                    self._add_resource_to_work_queue(sm, message.crud)
 
-    def _add_resource_to_work_queue(self, sm):
+    def _add_resource_to_work_queue(self, sm, action=None):
         """Queue up the state machine by resource name.
 
-        The work queue lock should be held before calling this method.
+        Repeated requests for a state machine that is already queued or
+        being worked on are coalesced into a single entry.
         """
-        l = self._resource_locks[sm.resource_id]
-        locked = l.acquire(False)
-        if locked:
-            self.work_queue.put(sm)
-        else:
+        if not self.work_queue.put(sm, action):
             LOG.debug('%s is already in the work queue', sm.resource_id)
 
-    def _release_resource_lock(self, sm):
-        try:
-            self._resource_locks[sm.resource_id].release()
-        except threading.ThreadError:
-            # Already unlocked, that's OK.
-            pass
-
     def report_status(self, show_config=True):
         if show_config:
             cfg.CONF.log_opt_values(LOG, INFO)